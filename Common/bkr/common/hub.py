@@ -62,6 +62,9 @@ def __init__(self, conf, client_type=None, logger=None, transport=None,
             self._transport = transport
         else:
             transport_args = {'timeout': timeout}
+            if self._conf.get('CONNECTION_POOL_SIZE'):
+                # keep connections to the hub open between calls
+                transport_args['pool_size'] = self._conf['CONNECTION_POOL_SIZE']
             if self._hub_url.startswith("https://"):
                 TransportClass = retry_request_decorator(SafeCookieTransport)
                 if hasattr(ssl, 'create_default_context') and self._conf.get('CA_CERT'):
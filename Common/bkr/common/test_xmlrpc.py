@@ -5,9 +5,11 @@
 # (at your option) any later version.
 
 import socket
+import threading
 import unittest
 
 import six
+from six.moves import xmlrpc_client, xmlrpc_server
 
 if six.PY2:
     from bkr.common import xmlrpc2 as xmlrpc_interface
@@ -105,3 +107,53 @@ def test_complete_failure(self):
                           failures = self.DEFAULT_RETRY_COUNT + 1)
         expected = list(range(self.DEFAULT_RETRY_COUNT, 0, -1))
         self.assertEqual(self.get_retry_counts(), expected)
+
+
+class KeepAliveRequestHandler(xmlrpc_server.SimpleXMLRPCRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = xmlrpc_server.SimpleXMLRPCServer(('127.0.0.1', 0),
+                requestHandler=KeepAliveRequestHandler, logRequests=False)
+        self.server.daemon_threads = True
+        self.server.register_function(lambda x: x * 2, 'double')
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:%s/' % self.server.server_address[1]
+
+    def make_proxy(self, **kwargs):
+        transport = xmlrpc_interface.CookieTransport(**kwargs)
+        self.addCleanup(transport.close)
+        return transport, xmlrpc_client.ServerProxy(self.url, transport=transport)
+
+    def test_connections_are_reused(self):
+        transport, proxy = self.make_proxy(pool_size=2)
+        for i in range(3):
+            self.assertEqual(proxy.double(i), i * 2)
+        # faults are complete responses, so the connection can still be used
+        self.assertRaises(xmlrpc_client.Fault, proxy.nonexistent)
+        self.assertEqual(transport.connection_stats['opened'], 1)
+        self.assertEqual(transport.connection_stats['reused'], 3)
+
+    def test_idle_connections_expire(self):
+        transport, proxy = self.make_proxy(pool_size=2, pool_idle_timeout=-1)
+        proxy.double(1)
+        proxy.double(2)
+        self.assertEqual(transport.connection_stats['opened'], 2)
+        self.assertEqual(transport.connection_stats['expired'], 1)
+
+    def test_no_pool(self):
+        transport, proxy = self.make_proxy()
+        proxy.double(1)
+        proxy.double(2)
+        self.assertEqual(transport.connection_stats['opened'], 2)
+        self.assertEqual(transport.connection_stats['reused'], 0)
@@ -165,6 +165,12 @@ class CookieTransport(xmlrpclib.Transport):
     >>> client = xmlrpclib.ServerProxy("http://<server>/xmlrpc", transport=CookieTransport())
 
     For https:// connections use SafeCookieTransport() instead.
+
+    If pool_size is given, up to that many connections to the server are
+    kept open after each request and reused for later requests, as long as
+    they have been idle for no more than pool_idle_timeout seconds. The
+    number of connections opened, reused, expired and discarded is kept in
+    connection_stats.
     """
 
     _use_datetime = False # fix for python 2.5+
@@ -173,6 +179,11 @@ class CookieTransport(xmlrpclib.Transport):
     def __init__(self, *args, **kwargs):
         cookiejar = kwargs.pop("cookiejar", None)
         self.timeout = kwargs.pop("timeout", 0)
+        self.pool_size = kwargs.pop("pool_size", 0)
+        self.pool_idle_timeout = kwargs.pop("pool_idle_timeout", 10)
+        self._idle_connections = {}  # host -> list of (connection, idle since)
+        self._pool_lock = threading.Lock()
+        self.connection_stats = dict(opened=0, reused=0, expired=0, discarded=0)
         self.proxy_config = self._get_proxy(**kwargs)
         self.no_proxy = os.environ.get("no_proxy", "").lower().split(',')
 
@@ -255,10 +266,16 @@ def make_connection(self, host):
             CONNECTION_LOCK.release()
             return conn
 
+        if self.pool_size:
+            conn = self._get_idle_connection(host)
+            if conn is not None:
+                return conn
+
         CONNECTION_LOCK.acquire()
         # this disables connection caching which causes a race condition when running in threads
         self._connection = (None, None)
         conn = xmlrpclib.Transport.make_connection(self, host)
+        self.connection_stats["opened"] += 1
         CONNECTION_LOCK.release()
 
         if self.timeout:
@@ -266,6 +283,50 @@ def make_connection(self, host):
 
         return conn
 
+    def _get_idle_connection(self, host):
+        """
+        Returns an idle connection to host from the pool, or None if there is
+        none which is likely to still be open.
+        """
+        now = time.time()
+        with self._pool_lock:
+            idle = self._idle_connections.get(host, [])
+            while idle:
+                conn, idle_since = idle.pop()
+                if now - idle_since <= self.pool_idle_timeout:
+                    self.connection_stats["reused"] += 1
+                    return conn
+                conn.close()
+                self.connection_stats["expired"] += 1
+        return None
+
+    def _release_connection(self, host, conn, response):
+        """
+        Puts the connection back in the pool if its response has been read,
+        unless the server is closing it or the pool is already full.
+        """
+        if not self.pool_size:
+            return
+        with self._pool_lock:
+            idle = self._idle_connections.setdefault(host, [])
+            if (response.isclosed() and not response.will_close
+                    and conn.sock is not None and len(idle) < self.pool_size):
+                idle.append((conn, time.time()))
+                return
+            self.connection_stats["discarded"] += 1
+        conn.close()
+
+    def close_idle_connections(self):
+        with self._pool_lock:
+            idle_connections, self._idle_connections = self._idle_connections, {}
+        for idle in idle_connections.values():
+            for conn, idle_since in idle:
+                conn.close()
+
+    def close(self):
+        xmlrpclib.Transport.close(self)
+        self.close_idle_connections()
+
     def send_cookies(self, connection, cookie_request):
         """
         Add cookies to the header.
@@ -383,7 +444,10 @@ def _single_request(self, host, handler, request_body, verbose=0):
             if response.status == 200:
                 self.verbose = verbose
                 self._save_cookies(response.msg, cookie_request)
-                return self.parse_response(response)
+                try:
+                    return self.parse_response(response)
+                finally:
+                    self._release_connection(host, h, response)
         except xmlrpclib.Fault:
             raise
         except Exception:
@@ -430,6 +494,9 @@ def send_request(self, connection, handler, request_body):
     def send_host(self, connection, host):
         return xmlrpclib.SafeTransport.send_host(self, connection, host)
 
+    def close(self):
+        return CookieTransport.close(self)
+
     def make_connection(self, host):
         host.lower()
 
@@ -448,9 +515,15 @@ def make_connection(self, host):
 
             return conn
 
+        if self.pool_size:
+            conn = self._get_idle_connection(host)
+            if conn is not None:
+                return conn
+
         CONNECTION_LOCK.acquire()
         self._connection = (None, None)
         conn = xmlrpclib.SafeTransport.make_connection(self, host)
+        self.connection_stats["opened"] += 1
         if self.timeout:
             conn.timeout = self.timeout
         CONNECTION_LOCK.release()
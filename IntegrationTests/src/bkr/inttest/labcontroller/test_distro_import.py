@@ -1224,6 +1224,7 @@ def dry_run_import_trees(self, additional_import_args):
         # check logging is working correctly
         self.assertIn('Dry Run only', stderr)
         self.assertIn('Attempting to import: ', stderr)
+        self.assertRegexpMatches(stderr, r'Checked \d+ URLs')
         # return dumped JSON tree info
         return trees
 
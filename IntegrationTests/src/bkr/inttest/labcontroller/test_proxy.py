@@ -12,8 +12,9 @@
 import copy
 from base64 import b64encode
 import xmlrpclib
+import httplib
 import lxml.etree, lxml.html
-from urlparse import urljoin
+from urlparse import urljoin, urlparse
 import requests
 import time
 from nose.plugins.skip import SkipTest
@@ -22,6 +23,7 @@
         LogRecipeTask, LogRecipeTaskResult, RecipeTask, RecipeTaskResult
 from bkr.labcontroller.proxy import ProxyHelper
 from bkr.labcontroller.config import get_conf
+from bkr.labcontroller.log_storage import compress_log
 from bkr.inttest import data_setup
 from bkr.inttest.assertions import assert_datetime_within
 from bkr.inttest.labcontroller import LabControllerTestCase, processes, \
@@ -1140,6 +1142,85 @@ def test_GET_nonexistent_log(self):
         response = requests.get(log_url)
         self.assertEquals(response.status_code, 404)
 
+    def test_GET_log_range(self):
+        log_url = '%srecipes/%s/logs/GET-log-range' % (self.get_proxy_url(),
+                self.recipe.id)
+        response = requests.put(log_url, data='0123456789')
+        self.assertEquals(response.status_code, 204)
+        response = requests.get(log_url, headers={'Range': 'bytes=4-'})
+        self.assertEquals(response.status_code, 206)
+        self.assertEquals(response.headers['Content-Range'], 'bytes 4-9/10')
+        self.assertEquals(response.content, '456789')
+        response = requests.get(log_url, headers={'Range': 'bytes=2-3'})
+        self.assertEquals(response.status_code, 206)
+        self.assertEquals(response.content, '23')
+        # nothing new to tail
+        response = requests.get(log_url, headers={'Range': 'bytes=10-'})
+        self.assertEquals(response.status_code, 416)
+        self.assertEquals(response.headers['Content-Range'], 'bytes */10')
+
+    def test_GET_log_conditional(self):
+        log_url = '%srecipes/%s/logs/GET-log-conditional' % (
+                self.get_proxy_url(), self.recipe.id)
+        response = requests.put(log_url, data='a' * 10)
+        self.assertEquals(response.status_code, 204)
+        response = requests.get(log_url)
+        self.assertEquals(response.status_code, 200)
+        etag = response.headers['ETag']
+        response = requests.get(log_url, headers={'If-None-Match': etag})
+        self.assertEquals(response.status_code, 304)
+        response = requests.put(log_url, data='b' * 10,
+                headers={'Content-Range': 'bytes 10-19/20'})
+        self.assertEquals(response.status_code, 204)
+        response = requests.get(log_url, headers={'If-None-Match': etag})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.content, 'a' * 10 + 'b' * 10)
+        # If-Range with a stale entity tag gets the whole file
+        response = requests.get(log_url,
+                headers={'Range': 'bytes=10-', 'If-Range': etag})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.content, 'a' * 10 + 'b' * 10)
+
+    def test_GET_log_gzip(self):
+        log_url = '%srecipes/%s/logs/GET-log-gzip.log' % (
+                self.get_proxy_url(), self.recipe.id)
+        content = 'a line of console output\n' * 1000
+        response = requests.put(log_url, data=content)
+        self.assertEquals(response.status_code, 204)
+        response = requests.get(log_url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.headers['Content-Encoding'], 'gzip')
+        self.assertEquals(response.content, content) # decoded by requests
+        response = requests.get(log_url, headers={'Accept-Encoding': 'identity'})
+        self.assertEquals(response.status_code, 200)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEquals(response.headers['Content-Length'], str(len(content)))
+        self.assertEquals(response.content, content)
+
+    def test_GET_compressed_log(self):
+        log_url = '%srecipes/%s/logs/GET-compressed-log.log' % (
+                self.get_proxy_url(), self.recipe.id)
+        local_log_path = '%s/recipes/%s+/%s/GET-compressed-log.log' % (
+                get_conf().get('CACHEPATH'), self.recipe.id // 1000, self.recipe.id)
+        content = 'a line of console output\n' * 1000
+        response = requests.put(log_url, data=content)
+        self.assertEquals(response.status_code, 204)
+        self.assertNotEquals(compress_log(local_log_path, 0), None)
+        response = requests.get(log_url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.headers['Content-Encoding'], 'gzip')
+        self.assertEquals(response.content, content) # decoded by requests
+        response = requests.get(log_url, headers={'Accept-Encoding': 'identity'})
+        self.assertEquals(response.status_code, 200)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEquals(response.content, content)
+        # writing to it again restores it
+        response = requests.put(log_url, data='more\n', headers={
+                'Content-Range': 'bytes %d-%d/%d' % (len(content),
+                    len(content) + 4, len(content) + 5)})
+        self.assertEquals(response.status_code, 204)
+        self.assertEquals(open(local_log_path, 'r').read(), content + 'more\n')
+
     # https://bugzilla.redhat.com/show_bug.cgi?id=961300
     def test_PUT_empty_log(self):
         upload_url = '%srecipes/%s/logs/empty-log' % (self.get_proxy_url(),
@@ -1162,18 +1243,43 @@ def test_large_xmlrpc_request_is_rejected(self):
         except xmlrpclib.ProtocolError as e:
             self.assertEquals(e.errcode, 413)
 
-    # https://bugzilla.redhat.com/show_bug.cgi?id=1003454
-    def test_large_PUT_request_is_rejected(self):
+    # Log uploads are streamed to disk, so they are not subject to the 10MB
+    # request limit (unlike XML-RPC, see above).
+    def test_large_PUT_request_is_streamed(self):
         upload_url = '%srecipes/%s/logs/asdf' % (self.get_proxy_url(),
                 self.recipe.id)
+        local_log_dir = '%s/recipes/%s+/%s/' % (get_conf().get('CACHEPATH'),
+                self.recipe.id // 1000, self.recipe.id)
+        size = 1024 * 1024 * 10 + 1
         # No specified data content-type
-        response = requests.put(upload_url, data='a' * (1024 * 1024 * 10 + 1))
-        self.assertEquals(response.status_code, 413)
+        response = requests.put(upload_url, data='a' * size)
+        self.assertEquals(response.status_code, 204)
+        self.assertEquals(os.path.getsize(os.path.join(local_log_dir, 'asdf')), size)
         # specify data content-type
-        response = requests.put(upload_url, data='a' * (1024 * 1024 * 10 + 1),
+        response = requests.put(upload_url, data='b' * size,
                                 headers={'content-type': 'application/x-url-encoded'})
-        self.assertEquals(response.status_code, 413)
+        self.assertEquals(response.status_code, 204)
+        with open(os.path.join(local_log_dir, 'asdf')) as f:
+            self.assertEquals(f.read(10), 'b' * 10)
 
+    def test_PUT_larger_than_max_size_is_rejected(self):
+        upload_path = '/recipes/%s/logs/too-large' % self.recipe.id
+        local_log_dir = '%s/recipes/%s+/%s/' % (get_conf().get('CACHEPATH'),
+                self.recipe.id // 1000, self.recipe.id)
+        max_size = get_conf().get('LOG_UPLOAD_MAX_SIZE', 10 * 1024 ** 3)
+        # The request is rejected before its body is read, so we don't
+        # need to send one.
+        conn = httplib.HTTPConnection(urlparse(self.get_proxy_url()).netloc)
+        conn.putrequest('PUT', upload_path)
+        conn.putheader('Content-Length', str(max_size + 1))
+        conn.endheaders()
+        response = conn.getresponse()
+        conn.close()
+        self.assertEquals(response.status, 413)
+        self.assertFalse(os.path.exists(os.path.join(local_log_dir, 'too-large')))
+        with session.begin():
+            session.refresh(self.recipe)
+            self.assertNotIn(u'too-large', [log.filename for log in self.recipe.logs])
 
     # https://bugzilla.redhat.com/show_bug.cgi?id=1293007
     def test_max_logs_per_recipe_limit_is_enforced(self):
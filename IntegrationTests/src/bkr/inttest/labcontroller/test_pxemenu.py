@@ -64,6 +64,25 @@ def test_skip_distro_tree_for_which_image_cannot_be_fetched(self):
         menu = open(os.path.join(self.tftp_dir, 'ipxe', 'beaker_menu')).read()
         self.assertNotIn('menu SuperBadWindows10', menu)
 
+    def test_changed_images_are_fetched_again(self):
+        with session.begin():
+            lc = self.get_lc()
+            tag = u'test_changed_images'
+            distro_tree = data_setup.create_distro_tree(
+                    osmajor=u'PinkUshankaLinux8', osminor=u'1',
+                    distro_tags=[tag],
+                    arch=u'x86_64', lab_controllers=[lc],
+                    urls=[u'http://localhost:19998/'])
+        write_menus(self.tftp_dir, tags=[tag], xml_filter=None)
+        kernel_path = os.path.join(self.tftp_dir, 'distrotrees',
+                str(distro_tree.id), 'kernel')
+        self.assertEquals(open(kernel_path).read(), 'lol')
+        vmlinuz_path = os.path.join(self.distro_dir, 'pxeboot/vmlinuz')
+        self.addCleanup(lambda: open(vmlinuz_path, 'w').write('lol'))
+        open(vmlinuz_path, 'w').write('a new kernel')
+        write_menus(self.tftp_dir, tags=[tag], xml_filter=None)
+        self.assertEquals(open(kernel_path).read(), 'a new kernel')
+
     def test_pxelinux_menu(self):
         with session.begin():
             lc = self.get_lc()
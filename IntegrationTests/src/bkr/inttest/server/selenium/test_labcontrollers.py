@@ -828,6 +828,57 @@ def test_abort_commands(self):
             for command in system.command_queue:
                 self.assertEqual(CommandStatus.aborted, command.status)
 
+    def test_mark_commands(self):
+        with session.begin():
+            system = data_setup.create_system(lab_controller=self.lc,
+                    status=SystemStatus.automated)
+            system.action_power(u'on')
+            system.action_power(u'off')
+            on_command, off_command = sorted(system.command_queue,
+                    key=lambda c: c.id)
+        errors = self.server.labcontrollers.mark_commands([
+            {'id': on_command.id, 'status': 'running'},
+            {'id': off_command.id, 'status': 'running'},
+            {'id': on_command.id, 'status': 'completed', 'power_queue_wait': 0.5,
+             'power_runtime': 2.0, 'power_attempts': 1},
+            {'id': off_command.id, 'status': 'failed', 'message': u'needs moar powa',
+             'system_broken': False},
+            {'id': on_command.id, 'status': 'running'},
+            {'id': 0, 'status': 'running'},
+        ])
+        self.assertEquals(errors[:4], ['', '', '', ''])
+        self.assertIn('already run', errors[4])
+        self.assertIn('Invalid command ID', errors[5])
+        with session.begin():
+            session.expire_all()
+            self.assertEquals(on_command.status, CommandStatus.completed)
+            self.assertEquals(off_command.status, CommandStatus.failed)
+            self.assertEquals(off_command.error_message, u'needs moar powa')
+            self.assertEquals(system.status, SystemStatus.automated)
+
+    def test_has_new_queued_commands(self):
+        self.assertFalse(self.server.labcontrollers.has_new_queued_commands([]))
+        with session.begin():
+            system = data_setup.create_system(lab_controller=self.lc)
+            system.action_power(u'on')
+            command = system.command_queue[0]
+        self.assertTrue(self.server.labcontrollers.has_new_queued_commands([]))
+        # commands the lab controller already knows about are ignored
+        self.assertFalse(self.server.labcontrollers.has_new_queued_commands(
+                [command.id]))
+
+    def test_has_new_queued_commands_obeys_max_running_commands_limit(self):
+        with session.begin():
+            for _ in xrange(15):
+                system = data_setup.create_system(lab_controller=self.lc)
+                system.action_power(action=u'on', service=u'testdata')
+        commands = self.server.labcontrollers.get_queued_command_details()
+        self.assertEquals(len(commands), 10, commands)
+        # Commands beyond the limit are not returned by
+        # get_queued_command_details, so they are not new either.
+        self.assertFalse(self.server.labcontrollers.has_new_queued_commands(
+                [command['id'] for command in commands]))
+
     def test_failure_in_configure_netboot_aborts_recipe(self):
         with session.begin():
             job = data_setup.create_job()
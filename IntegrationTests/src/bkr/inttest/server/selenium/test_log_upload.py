@@ -41,3 +41,38 @@ def test_register_recipe_log(self):
             self.assertEquals(self.recipe.logs[0].path, u'/')
             self.assertEquals(self.recipe.logs[0].filename, u'log.txt')
             self.assertEquals(self.recipe.logs[0].server, u'http://elsewhere/log.txt')
+
+    def test_register_files_in_batch(self):
+        with session.begin():
+            recipetask = self.recipe.tasks[0]
+            recipetask.logs = []
+            finished_job = data_setup.create_completed_job()
+            finished_recipe = finished_job.recipesets[0].recipes[0]
+            finished_result = finished_recipe.tasks[0].results[0]
+        self.server.auth.login_password(self.lc.user.user_name, 'logmein')
+        errors = self.server.recipes.register_files([
+            dict(type='recipe', id=str(self.recipe.id), server='http://myserver/',
+                 path='/', filename='log.txt', basepath=''),
+            dict(type='task', id=str(recipetask.id), server='http://myserver/',
+                 path='debug', filename='TESTOUT.log', basepath=''),
+            dict(type='recipe', id=str(finished_recipe.id), server='http://myserver/',
+                 path='/', filename='late.txt', basepath=''),
+            dict(type='result', id=str(finished_result.id), server='http://myserver/',
+                 path='/', filename='late.txt', basepath=''),
+            dict(type='task', id='notatask', server='http://myserver/',
+                 path='/', filename='bogus.txt', basepath=''),
+            dict(type='result', id=None, server='http://myserver/',
+                 path='/', filename='bogus.txt', basepath=''),
+        ])
+        self.assertEquals(errors[:2], ['', ''])
+        self.assertIn('Cannot register file for finished recipe', errors[2])
+        self.assertIn('Cannot register file for finished task', errors[3])
+        self.assertIn('Invalid task ID', errors[4])
+        self.assertIn('Invalid result ID', errors[5])
+        with session.begin():
+            session.refresh(self.recipe)
+            session.refresh(recipetask)
+            self.assertEquals([(log.path, log.filename) for log in self.recipe.logs],
+                    [(u'/', u'log.txt')])
+            self.assertEquals([(log.path, log.filename) for log in recipetask.logs],
+                    [(u'debug', u'TESTOUT.log')])
@@ -56,6 +56,17 @@ def test_by_log_server_skips_deleted_recipes(self):
         result = self.server.recipes.by_log_server(self.lc.fqdn)
         self.assertEqual(result, [])
 
+    def test_by_log_server_pages_after_recipe(self):
+        with session.begin():
+            finish_time = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+            recipe_ids = [data_setup.create_completed_job(lab_controller=self.lc,
+                    finish_time=finish_time).recipesets[0].recipes[0].id
+                    for _ in range(3)]
+        result = self.server.recipes.by_log_server(self.lc.fqdn, 2, 0)
+        self.assertEqual(result, recipe_ids[:2])
+        result = self.server.recipes.by_log_server(self.lc.fqdn, 2, recipe_ids[1])
+        self.assertEqual(result, recipe_ids[2:])
+
     def test_install_done_updates_resource_fqdn(self):
         with session.begin():
             distro_tree = data_setup.create_distro_tree()
@@ -122,6 +133,27 @@ def test_change_files(self):
                 self.assert_(log.server.startswith('http://archive.example.com/beaker-logs/'), log.server)
                 self.assert_(log.basepath.startswith('/var/www/html/beaker-logs/'), log.basepath)
 
+    def test_change_files_batch(self):
+        with session.begin():
+            recipes = [data_setup.create_completed_job().recipesets[0].recipes[0]
+                       for i in range(2)]
+        result = self.server.recipes.change_files_batch(
+                [recipes[0].id, 'notarecipe', recipes[1].id, 0, None],
+                'http://archive.example.com/beaker-logs',
+                '/var/www/html/beaker-logs')
+        self.assertEquals(result[0], '')
+        self.assertIn('Invalid recipe ID', result[1])
+        self.assertEquals(result[2], '')
+        self.assertIn('Invalid recipe ID', result[3])
+        self.assertIn('Invalid recipe ID', result[4])
+        with session.begin():
+            session.expire_all()
+            for recipe in recipes:
+                self.assertEquals(recipe.log_server, 'archive.example.com')
+                for log in recipe.all_logs():
+                    self.assert_(log.server.startswith('http://archive.example.com/beaker-logs/'), log.server)
+                    self.assert_(log.basepath.startswith('/var/www/html/beaker-logs/'), log.basepath)
+
     def test_gets_logs(self):
         with session.begin():
             system = data_setup.create_system(lab_controller=self.lc)
@@ -136,3 +136,42 @@ def test_task_roles_visible_between_hosts_and_guests(self):
             self.assertEquals(
                     self.server.recipes.tasks.peer_roles(recipe.tasks[0].id),
                     expected_peer_roles)
+
+    def test_watchdog_changes(self):
+        with session.begin():
+            recipe = data_setup.create_recipe()
+            data_setup.create_job_for_recipes([recipe])
+            system = data_setup.create_system(lab_controller=self.lc)
+            data_setup.mark_recipe_running(recipe, system=system)
+            other_lab_recipe = data_setup.create_recipe()
+            data_setup.create_job_for_recipes([other_lab_recipe])
+            data_setup.mark_recipe_running(other_lab_recipe)
+        self.server.auth.login_password(self.lc.user.user_name, u'logmein')
+        # first call returns all watchdogs for the lab
+        result = self.server.recipes.tasks.watchdog_changes(None)
+        self.assertTrue(result['resync'])
+        self.assertEquals([c['recipe_id'] for c in result['changes']], [recipe.id])
+        change = result['changes'][0]
+        self.assertEquals(change['recipe_set_id'], recipe.recipeset.id)
+        self.assertEquals(change['system'], system.fqdn)
+        self.assertEquals(change['is_virt_recipe'], False)
+        self.assertGreater(change['expires_in'], 0)
+        cursor = result['cursor']
+        with session.begin():
+            recipe = recipe.query.get(recipe.id)
+            recipe.extend(-1)
+        result = self.server.recipes.tasks.watchdog_changes(cursor)
+        self.assertFalse(result['resync'])
+        self.assertEquals(result['changes'][-1]['recipe_id'], recipe.id)
+        self.assertLess(result['changes'][-1]['expires_in'], 0)
+        cursor = result['cursor']
+        with session.begin():
+            data_setup.mark_recipe_complete(recipe, only=True)
+        result = self.server.recipes.tasks.watchdog_changes(cursor)
+        self.assertFalse(result['resync'])
+        self.assertEquals(result['changes'][-1]['recipe_id'], recipe.id)
+        self.assertEquals(result['changes'][-1]['kill_time'], None)
+        # a cursor which cannot be understood means starting again
+        result = self.server.recipes.tasks.watchdog_changes('garbage')
+        self.assertTrue(result['resync'])
+        self.assertEquals(result['changes'], [])
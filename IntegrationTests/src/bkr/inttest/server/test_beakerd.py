@@ -18,7 +18,7 @@
         Provision, TaskPriority, RecipeSet, RecipeTaskResult, Task, SystemPermission,\
         MachineRecipe, GuestRecipe, LabControllerDistroTree, DistroTree, \
         TaskResult, Command, CommandStatus, GroupMembershipType, \
-        RecipeVirtStatus, Arch
+        RecipeVirtStatus, Arch, WatchdogChange
 from bkr.server.installopts import InstallOptions
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.sql import not_
@@ -29,8 +29,9 @@
 from bkr.inttest.assertions import assert_datetime_within, \
         assert_durations_not_overlapping, wait_for_condition
 from bkr.server.tools import beakerd
+from bkr.server.eligibility import EligibilityIndex
 from bkr.server.jobs import Jobs
-from bkr.server import dynamic_virt
+from bkr.server import dynamic_virt, wakeup
 from bkr.server.model import OSMajor
 from bkr.server.model.installation import RenderedKickstart
 from bkr.inttest.assertions import assert_datetime_within
@@ -1129,6 +1130,179 @@ def test_recipe_no_longer_has_access(self):
             picked_system = job.recipesets[0].recipes[0].resource.system
             self.assertEqual(picked_system, system2)
 
+    def test_eligibility_index_picks_highest_priority_runnable_recipe(self):
+        with session.begin():
+            system = data_setup.create_system(lab_controller=self.lab_controller)
+            system.user = data_setup.create_user()
+            host_requires = (u'<hostRequires><hostname op="=" value="%s"/></hostRequires>'
+                    % system.fqdn)
+            jobs = []
+            for priority in [TaskPriority.normal, TaskPriority.high, TaskPriority.urgent]:
+                job = data_setup.create_job(priority=priority)
+                job.recipesets[0].recipes[0]._host_requires = host_requires
+                jobs.append(job)
+            normal_job, high_job, urgent_job = jobs
+        with patch.object(beakerd, '_eligibility_index', EligibilityIndex()):
+            beakerd.process_new_recipes()
+            beakerd.update_dirty_jobs()
+            beakerd.queue_processed_recipesets()
+            beakerd.update_dirty_jobs()
+            with session.begin():
+                for job in jobs:
+                    self.assertEqual(Job.by_id(job.id).status, TaskStatus.queued)
+                # Cancelled outside of beakerd, so the index is now stale.
+                Job.by_id(urgent_job.id).cancel()
+                System.query.get(system.id).user = None
+            beakerd.update_dirty_jobs()
+            beakerd.schedule_pending_systems()
+            beakerd.update_dirty_jobs()
+            with session.begin():
+                self.assertEqual(Job.by_id(high_job.id).status, TaskStatus.scheduled)
+                self.assertEqual(Job.by_id(normal_job.id).status, TaskStatus.queued)
+                self.assertEqual(len(beakerd._eligibility_index), 1)
+
+    def test_committed_work_wakes_up_beakerd(self):
+        received = []
+        with patch.object(wakeup, '_local_handler', received.append):
+            with session.begin():
+                system = data_setup.create_system(lab_controller=self.lab_controller)
+                system.user = data_setup.create_user()
+            del received[:]
+            with session.begin():
+                data_setup.create_job()
+            self.assertIn(wakeup.NEW_RECIPES, received[-1])
+            with session.begin():
+                System.query.get(system.id).user = None
+            self.assertEqual(received[-1], set([wakeup.PENDING_SYSTEMS]))
+            # Nothing is sent for rolled back transactions.
+            del received[:]
+            session.begin()
+            data_setup.create_job()
+            session.flush()
+            session.rollback()
+            session.close()
+            self.assertEqual(received, [])
+
+    def test_priority_change_reorders_eligibility_index(self):
+        with session.begin():
+            system = data_setup.create_system(lab_controller=self.lab_controller)
+            system.user = data_setup.create_user()
+            host_requires = (u'<hostRequires><hostname op="=" value="%s"/></hostRequires>'
+                    % system.fqdn)
+            jobs = []
+            for priority in [TaskPriority.normal, TaskPriority.high]:
+                job = data_setup.create_job(priority=priority)
+                job.recipesets[0].recipes[0]._host_requires = host_requires
+                jobs.append(job)
+            normal_job, high_job = jobs
+        with patch.object(beakerd, '_eligibility_index', EligibilityIndex()), \
+                patch.object(wakeup, '_local_handler', lambda phases: None), \
+                patch.object(wakeup, '_local_reindex_handler',
+                    beakerd.reindex_recipesets):
+            beakerd.process_new_recipes()
+            beakerd.update_dirty_jobs()
+            beakerd.queue_processed_recipesets()
+            beakerd.update_dirty_jobs()
+            with session.begin():
+                # Changed outside of beakerd's own transitions.
+                recipeset = Job.by_id(normal_job.id).recipesets[0]
+                recipeset.priority = TaskPriority.urgent
+                recipeset_id = recipeset.id
+                System.query.get(system.id).user = None
+            self.assertIn(recipeset_id, beakerd._eligibility_index_dirty)
+            # As at the start of the next pass
+            beakerd.refresh_eligibility_index()
+            beakerd.schedule_pending_systems()
+            beakerd.update_dirty_jobs()
+            with session.begin():
+                self.assertEqual(Job.by_id(normal_job.id).status, TaskStatus.scheduled)
+                self.assertEqual(Job.by_id(high_job.id).status, TaskStatus.queued)
+
+    def test_wakeup_datagram_carries_recipesets_to_reindex(self):
+        phases, recipeset_ids = wakeup._decode(
+                wakeup._encode(set([wakeup.NEW_RECIPES]), set([1, 2])))
+        self.assertEqual(phases, set([wakeup.NEW_RECIPES]))
+        self.assertEqual(recipeset_ids, set([1, 2]))
+        phases, recipeset_ids = wakeup._decode(
+                wakeup._encode(set(), set(range(2000))))
+        self.assertEqual(recipeset_ids, None)
+
+    def test_old_watchdog_changes_are_purged(self):
+        with session.begin():
+            recipe = data_setup.create_recipe()
+            data_setup.create_job_for_recipes([recipe])
+            data_setup.mark_recipe_running(recipe)
+            old_change = WatchdogChange(lab_controller=recipe.recipeset.lab_controller,
+                    recipe=recipe, kill_time=None,
+                    created=datetime.datetime.utcnow() - datetime.timedelta(days=2))
+            session.add(old_change)
+            session.flush()
+            change_ids = [change.id for change in
+                    WatchdogChange.query.filter_by(recipe=recipe)]
+            self.assertIn(old_change.id, change_ids)
+        beakerd.purge_watchdog_changes()
+        with session.begin():
+            remaining_ids = [change.id for change in
+                    WatchdogChange.query.filter_by(recipe=recipe)]
+            self.assertNotIn(old_change.id, remaining_ids)
+            self.assertEquals(len(remaining_ids), len(change_ids) - 1)
+
+    def test_requested_phases_do_not_interrupt_dirty_jobs(self):
+        with session.begin():
+            jobs = [data_setup.create_job() for _ in range(3)]
+            for job in jobs:
+                job._mark_dirty()
+        # As when a commit during the pass wakes up beakerd
+        beakerd.request_phases([wakeup.PENDING_SYSTEMS])
+        self.addCleanup(beakerd._take_requested_phases)
+        beakerd.update_dirty_jobs()
+        with session.begin():
+            for job in jobs:
+                self.assertFalse(Job.by_id(job.id).is_dirty)
+
+    def test_shard_work_keeps_items_with_shared_keys_together(self):
+        shards = beakerd.shard_work(['a', 'b', 'c', 'd', 'e'],
+                [[1], [2], [1, 3], [3], [4]], 3)
+        self.assertEqual(shards, [['a', 'c', 'd'], ['b'], ['e']])
+
+    def test_recipes_are_scheduled_by_several_workers(self):
+        with session.begin():
+            distro_tree = data_setup.create_distro_tree(lab_controllers=[self.lab_controller])
+            jobs = []
+            for _ in range(6):
+                system = data_setup.create_system(lab_controller=self.lab_controller)
+                job = data_setup.create_job(distro_tree=distro_tree)
+                job.recipesets[0].recipes[0]._host_requires = (
+                        u'<hostRequires><hostname op="=" value="%s"/></hostRequires>'
+                        % system.fqdn)
+                jobs.append(job)
+        with patch.object(beakerd, '_scheduler_workers', lambda: 3), \
+                patch.object(beakerd, '_worker_executor', None):
+            beakerd.process_new_recipes()
+            beakerd.update_dirty_jobs()
+            beakerd.queue_processed_recipesets()
+            beakerd.update_dirty_jobs()
+            beakerd._worker_executor.shutdown()
+        with session.begin():
+            for job in jobs:
+                self.assertEqual(Job.by_id(job.id).status, TaskStatus.scheduled)
+
+    def test_busy_guest_allocation_lock_is_waited_for_outside_transaction(self):
+        attempts = []
+        def allocate(item_id):
+            attempts.append(getattr(beakerd._worker_state, 'holds_guest_lock', False))
+            beakerd._hold_guest_allocation_lock()
+        beakerd._guest_allocation_lock.acquire()
+        releaser = threading.Timer(0.1, beakerd._guest_allocation_lock.release)
+        releaser.start()
+        with patch.object(beakerd, '_scheduler_workers', lambda: 3):
+            self.assertTrue(beakerd._run_in_transaction(allocate, 1))
+        releaser.join()
+        # The first attempt found the lock busy and was rolled back, the second
+        # already held it when its transaction began.
+        self.assertEqual(attempts, [False, True])
+        self.assertFalse(beakerd._guest_allocation_lock.locked())
+
     # https://bugzilla.redhat.com/show_bug.cgi?id=826379
     def test_recipe_install_options_can_remove_system_options(self):
         with session.begin():
@@ -1669,6 +1843,36 @@ def test_bz1120052(self):
             for recipe in job.all_recipes:
                 self.assertEquals(recipe.tasks[0].results[-1].log, expected_msg)
 
+    def test_multihost_candidates_are_pruned_to_feasible_assignments(self):
+        # LC has 3 systems: A, B, C, all currently reserved.
+        # RS has 3 recipes:
+        #     R0 -> [A]
+        #     R1 -> [A, B]
+        #     R2 -> [B, C]
+        # The only way to run them all at once is R0 on A, R1 on B and R2 on
+        # C, so the other candidates are removed.
+        with session.begin():
+            lc = data_setup.create_labcontroller()
+            systems = [data_setup.create_system(lab_controller=lc) for _ in range(3)]
+            for system in systems:
+                data_setup.create_manual_reservation(system)
+            system_a, system_b, system_c = systems
+            job = data_setup.create_job(num_recipes=3)
+            for recipe, candidates in zip(job.recipesets[0].recipes,
+                    [[system_a], [system_a, system_b], [system_b, system_c]]):
+                recipe._host_requires = (u'<hostRequires><or>%s</or></hostRequires>'
+                        % ''.join('<hostname value="%s"/>' % system.fqdn
+                                  for system in candidates))
+        beakerd.process_new_recipes()
+        beakerd.update_dirty_jobs()
+        beakerd.queue_processed_recipesets()
+        beakerd.update_dirty_jobs()
+        with session.begin():
+            job = Job.query.get(job.id)
+            self.assertEquals(job.recipesets[0].status, TaskStatus.queued)
+            self.assertEquals([recipe.systems for recipe in job.recipesets[0].recipes],
+                    [[System.query.get(system.id)] for system in systems])
+
     def test_priority_is_bumped_when_recipe_matches_one_system(self):
         with session.begin():
             system = data_setup.create_system(lab_controller=self.lab_controller)
@@ -1694,6 +1898,52 @@ def test_priority_is_bumped_when_recipe_matches_one_system(self):
             self.assertEquals(activity_entry.old_value, u'Low')
             self.assertEquals(activity_entry.new_value, u'Medium')
 
+    def test_recipes_with_same_host_requires_are_matched_together(self):
+        with session.begin():
+            system_a = data_setup.create_system(lab_controller=self.lab_controller)
+            system_b = data_setup.create_system(lab_controller=self.lab_controller)
+            owner = data_setup.create_user()
+            distro_tree = data_setup.create_distro_tree(
+                    lab_controllers=[self.lab_controller])
+            jobs = []
+            # Same filter, differing only in formatting, should share a group
+            for host_requires in [
+                    '<hostRequires><hostname op="=" value="%s"/></hostRequires>',
+                    '<hostRequires>\n  <hostname value="%s" op="="/>\n</hostRequires>']:
+                recipe = data_setup.create_recipe(distro_tree=distro_tree)
+                recipe._host_requires = host_requires % system_a.fqdn
+                jobs.append(data_setup.create_job_for_recipes([recipe],
+                        owner=owner, priority=TaskPriority.low))
+            recipe = data_setup.create_recipe(distro_tree=distro_tree)
+            recipe._host_requires = (
+                    '<hostRequires><hostname op="=" value="%s"/></hostRequires>'
+                    % system_b.fqdn)
+            jobs.append(data_setup.create_job_for_recipes([recipe], owner=owner))
+            recipe = data_setup.create_recipe(distro_tree=distro_tree)
+            recipe._host_requires = (
+                    '<hostRequires><hostname op="=" value="nonexistent.invalid"/>'
+                    '</hostRequires>')
+            jobs.append(data_setup.create_job_for_recipes([recipe], owner=owner))
+            recipe_ids = [job.recipesets[0].recipes[0].id for job in jobs]
+        groups = beakerd.group_new_recipes(recipe_ids)
+        self.assertIn([recipe_ids[0], recipe_ids[1]], groups)
+        self.assertEqual(len(groups), 3)
+        beakerd.process_new_recipes()
+        beakerd.update_dirty_jobs()
+        with session.begin():
+            for job in jobs[:2]:
+                job = Job.query.get(job.id)
+                self.assertEqual(job.status, TaskStatus.processed)
+                self.assertEqual(job.recipesets[0].recipes[0].systems,
+                        [System.query.get(system_a.id)])
+                # bumped once per recipe, same as when matched individually
+                self.assertEqual(job.recipesets[0].priority, TaskPriority.medium)
+            job = Job.query.get(jobs[2].id)
+            self.assertEqual(job.recipesets[0].recipes[0].systems,
+                    [System.query.get(system_b.id)])
+            job = Job.query.get(jobs[3].id)
+            self.assertEqual(job.status, TaskStatus.aborted)
+
     def test_installation_table_parameters_filled_out_at_provisioning_time(self):
         with session.begin():
             lc = data_setup.create_labcontroller()
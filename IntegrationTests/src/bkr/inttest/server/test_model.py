@@ -33,7 +33,7 @@
         RecipeTask, RecipeTaskResult, DeclarativeMappedObject, OSVersion, \
         RecipeReservationRequest, ReleaseAction, SystemPool, CommandStatus, \
         GroupMembershipType, RecipeSetComment, Power, LogRecipeTask, \
-        LogRecipeTaskResult
+        LogRecipeTaskResult, WatchdogChange
 
 from bkr.server.bexceptions import BeakerException
 from sqlalchemy.sql import not_
@@ -984,6 +984,21 @@ def test_command_completion_metrics(self, mock_metrics):
         for counter in counters:
             mock_metrics.increment.assert_any_call(counter)
 
+    @patch('bkr.server.model.inventory.metrics')
+    def test_power_timing_metrics(self, mock_metrics):
+        lc = data_setup.create_labcontroller(fqdn=u'whitehouse.gov')
+        system = data_setup.create_system(lab_controller=lc, arch=u'i386')
+        data_setup.configure_system_power(system, power_type=u'ilo')
+        command = system.action_power(action=u'on', service=u'testdata')
+        session.flush()
+        command.record_power_timings(1.5, 20.0, 3)
+        mock_metrics.timing.assert_any_call(
+                'durations.power_command_queue_wait.by_power_type.ilo', 1.5)
+        mock_metrics.timing.assert_any_call(
+                'durations.power_command_runtime.by_lab.whitehouse_gov', 20.0)
+        mock_metrics.increment.assert_any_call(
+                'counters.power_command_retries.all', 2)
+
 class TestJob(DatabaseTestCase):
 
     def setUp(self):
@@ -1343,6 +1358,24 @@ def test_exclude_dirty_job_from_expired(self):
         expired_watchdogs = Watchdog.by_status(status=u'expired').all()
         self.assertNotIn(recipe.watchdog, expired_watchdogs)
 
+    def test_only_real_kill_time_changes_are_recorded(self):
+        recipe = data_setup.create_recipe()
+        data_setup.create_job_for_recipes([recipe])
+        data_setup.mark_recipe_scheduled(recipe)
+        session.flush()
+        # a new watchdog without a kill time has not changed
+        self.assertEquals(WatchdogChange.query.filter_by(recipe=recipe).count(), 0)
+        recipe.extend(600)
+        session.flush()
+        self.assertEquals(WatchdogChange.query.filter_by(recipe=recipe).count(), 1)
+        session.expire(recipe.watchdog)
+        kill_time = recipe.watchdog.kill_time
+        session.expire(recipe.watchdog)
+        # setting the same kill time on a watchdog which is not loaded yet
+        recipe.watchdog.kill_time = kill_time
+        session.flush()
+        self.assertEquals(WatchdogChange.query.filter_by(recipe=recipe).count(), 1)
+
 
 class DistroTreeTest(DatabaseTestCase):
 
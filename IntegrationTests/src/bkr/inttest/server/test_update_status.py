@@ -95,6 +95,28 @@ def test_abort_recipe_bubbles_status_to_job(self):
         # Verify that the whole job shows aborted now.
         self.assertEquals(job.status, TaskStatus.aborted)
 
+    def test_task_counts_are_aggregated_per_recipe(self):
+        job = data_setup.create_job(num_recipes=2, num_tasks=3)
+        data_setup.mark_job_running(job)
+        first, second = job.recipesets[0].recipes
+        first.tasks[0].pass_(u'/', 0, u'')
+        first.tasks[0].stop()
+        first.tasks[1].start()
+        first.tasks[1].fail(u'/', 0, u'')
+        first.tasks[1].stop()
+        second.tasks[0].warn(u'/', 0, u'')
+        second.tasks[0].stop()
+        job.update_status()
+        self.assertEquals((first.ptasks, first.ftasks, first.wtasks), (1, 1, 0))
+        self.assertEquals((second.ptasks, second.ftasks, second.wtasks), (0, 0, 1))
+        self.assertEquals((job.ptasks, job.ftasks, job.wtasks), (1, 1, 1))
+        self.assertEquals(first.tasks[1].result, TaskResult.fail)
+        self.assertEquals(first.result, TaskResult.fail)
+        self.assertEquals(second.result, TaskResult.warn)
+        self.assertEquals(job.result, TaskResult.fail)
+        self.assertEquals(first.status, TaskStatus.running)
+        self.assertEquals(job.status, TaskStatus.running)
+
     # https://bugzilla.redhat.com/show_bug.cgi?id=903935
     def test_finished_recipe_with_unstarted_guests(self):
         # host completes, but guest never started
@@ -0,0 +1,117 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Micro-benchmark for the console log scanning done by beaker-watchdog.
+
+Recorded console logs are fed through the sanitizing and panic/install
+failure detection done by ConsoleLogHelper.process_log(), in blocks of the
+same size the watchdog reads, once using a search per pattern per line (as
+beaker-watchdog used to) and once using MultiPatternMatcher. For example,
+using the sample logs from the integration tests:
+
+    python -m bkr.labcontroller.console_benchmark \\
+        IntegrationTests/src/bkr/inttest/labcontroller/install-failure-logs/*
+
+Since the samples are short and end in a failure, each log is padded with
+ordinary boot messages (--padding lines) to resemble a busy console.
+"""
+
+import re
+import sys
+import time
+from optparse import OptionParser
+from bkr.labcontroller.config import get_conf
+from bkr.labcontroller.proxy import ConsoleLogHelper, InstallFailureDetector, \
+        MultiPatternMatcher, replace_with_blanks, _strip_control_chars_table
+
+PADDING_LINE = ('[   12.345678] \033[1mkworker/u16:2\033[0m: scsi 0:0:0:0: '
+        'Direct-Access     ATA      QEMU HARDDISK    2.5+ PQ: 0 ANSI: 5\r\n')
+
+strip_ansi = re.compile("(\033\[[0-9;\?]*[ABCDHfsnuJKmhr])")
+ascii_control_chars = map(chr, range(0, 32) + [127])
+strip_cntrl = re.compile('[%s]' % re.escape(''.join(
+        c for c in ascii_control_chars if c not in '\t\n')))
+
+def scan_per_pattern(blocks, patterns):
+    matches = []
+    incomplete_line = ''
+    for block in blocks:
+        block = strip_ansi.sub(replace_with_blanks, block)
+        block = strip_cntrl.sub(' ', block)
+        lines = (incomplete_line + block).split('\n')
+        incomplete_line = lines.pop()
+        for line in lines:
+            for pattern in patterns:
+                if pattern.search(line):
+                    matches.append(line)
+                    break
+    return matches
+
+def scan_prefiltered(blocks, matcher):
+    matches = []
+    incomplete_line = ''
+    for block in blocks:
+        block = strip_ansi.sub(replace_with_blanks, block)
+        block = block.translate(_strip_control_chars_table)
+        lines = (incomplete_line + block).split('\n')
+        incomplete_line = lines.pop()
+        for line in matcher.candidate_lines('\n'.join(lines)):
+            if matcher.search(line):
+                matches.append(line)
+    return matches
+
+def split_blocks(data, blocksize):
+    return [data[i:i + blocksize] for i in range(0, len(data), blocksize)]
+
+def best_time(func, args, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def main():
+    parser = OptionParser(usage='usage: %prog [options] CONSOLE_LOG...',
+            description='Benchmark console log panic/install failure detection')
+    parser.add_option('--padding', type='int',
+            help='ordinary lines to add before each log [default: %default]')
+    parser.add_option('--repeat', type='int',
+            help='take the best of this many runs [default: %default]')
+    parser.set_defaults(padding=20000, repeat=5)
+    opts, args = parser.parse_args()
+    if not args:
+        parser.error('Specify one or more recorded console logs')
+
+    patterns = [re.compile(get_conf().get('PANIC_REGEX'))] + \
+            InstallFailureDetector().patterns
+    matcher = MultiPatternMatcher(patterns)
+    total_bytes = 0
+    total_old = total_new = 0.0
+    for filename in args:
+        data = PADDING_LINE * opts.padding + open(filename, 'rb').read()
+        blocks = split_blocks(data, ConsoleLogHelper.blocksize)
+        old, old_matches = best_time(scan_per_pattern, (blocks, patterns), opts.repeat)
+        new, new_matches = best_time(scan_prefiltered, (blocks, matcher), opts.repeat)
+        if old_matches != new_matches:
+            sys.stderr.write('%s: matches differ: %r != %r\n'
+                    % (filename, old_matches, new_matches))
+            return 1
+        sys.stdout.write('%-40s %8.3f MB %8.3f s %8.3f s %6.1fx\n' % (
+                filename[-40:], len(data) / 1e6, old, new, old / new))
+        total_bytes += len(data)
+        total_old += old
+        total_new += new
+    sys.stdout.write('\n%d patterns, %0.1f MB: per-pattern %0.1f MB/s, '
+            'prefiltered %0.1f MB/s (%0.1fx)\n' % (len(patterns), total_bytes / 1e6,
+            total_bytes / 1e6 / total_old, total_bytes / 1e6 / total_new,
+            total_old / total_new))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,9 +12,13 @@
 import getopt
 import urlparse
 from optparse import OptionParser, OptionGroup
+import urllib
 import urllib2
+import httplib
 import logging
 import socket
+import threading
+from multiprocessing.pool import ThreadPool
 import copy
 from bkr.log import log_to_stream
 from bkr.common.bexceptions import BX
@@ -24,7 +28,7 @@
 import dnf
 import uuid
 
-def url_exists(url):
+def _urlopen_exists(url):
     try:
         urllib2.urlopen(url)
     except urllib2.URLError:
@@ -38,6 +42,131 @@ def url_exists(url):
             raise
     return True
 
+class UrlProber(object):
+    """
+    Checks whether URLs exist, remembering the answer for the rest of the
+    import. HTTP URLs are checked with HEAD requests, over connections which
+    each thread keeps open and reuses. Other URLs (and HTTP URLs which go
+    through a proxy) are fetched with urllib2 instead.
+    """
+
+    max_redirects = 5
+
+    def __init__(self, workers=8, timeout=60):
+        self.workers = workers
+        self.timeout = timeout
+        self.results = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.pool = None
+        self.probes = 0
+        self.cached = 0
+        self.probe_time = 0.0
+
+    def exists(self, url):
+        with self.lock:
+            if url in self.results:
+                self.cached += 1
+                return self.results[url]
+        start = time.time()
+        result = self._probe(url, self.max_redirects)
+        with self.lock:
+            self.results[url] = result
+            self.probes += 1
+            self.probe_time += time.time() - start
+        return result
+
+    def prefetch(self, urls):
+        """
+        Checks the given URLs at the same time, so that later calls to
+        exists() for them are answered straight away.
+        """
+        with self.lock:
+            urls = [url for url in set(urls) if url not in self.results]
+        if len(urls) <= 1 or self.workers <= 1:
+            for url in urls:
+                self.exists(url)
+            return
+        if self.pool is None:
+            self.pool = ThreadPool(self.workers)
+        self.pool.map(self.exists, urls)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def _probe(self, url, redirects):
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        if (scheme not in ('http', 'https')
+                or (urllib.getproxies().get(scheme)
+                    and not urllib.proxy_bypass(netloc))):
+            return _urlopen_exists(url)
+        if query:
+            path = '%s?%s' % (path, query)
+        response = self._head(scheme, netloc, path or '/')
+        if response is None:
+            return False
+        if response.status in (405, 501):
+            # HEAD is not supported
+            return _urlopen_exists(url)
+        if response.status in (301, 302, 303, 307, 308):
+            location = response.getheader('Location')
+            if location and redirects > 0:
+                return self._probe(urlparse.urljoin(url, location), redirects - 1)
+            return False
+        return 200 <= response.status < 300
+
+    def _head(self, scheme, netloc, path):
+        # Returns None if the server cannot be reached.
+        connections = getattr(self.local, 'connections', None)
+        if connections is None:
+            connections = self.local.connections = {}
+        conn = connections.pop((scheme, netloc), None)
+        if conn is not None:
+            try:
+                response = self._request(conn, path)
+            except (socket.error, httplib.HTTPException):
+                # The server closed the connection since we last used it.
+                conn.close()
+                conn = None
+        if conn is None:
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                conn = httplib.HTTPConnection(netloc, timeout=self.timeout)
+            try:
+                response = self._request(conn, path)
+            except (socket.error, httplib.HTTPException), e:
+                # Unreachable, like a URLError from urllib2
+                logging.debug('Could not check %s://%s%s: %s', scheme, netloc,
+                        path, e)
+                conn.close()
+                return None
+        if response.will_close:
+            conn.close()
+        else:
+            connections[(scheme, netloc)] = conn
+        return response
+
+    def _request(self, conn, path):
+        conn.request('HEAD', path)
+        response = conn.getresponse()
+        response.read()
+        return response
+
+    def log_summary(self):
+        logging.debug('Checked %s URLs, taking %.3f seconds each on average, '
+                'and answered %s more checks from cache', self.probes,
+                self.probe_time / (self.probes or 1), self.cached)
+
+#: Used for every URL checked during this import.
+url_prober = UrlProber()
+
+def url_exists(url):
+    return url_prober.exists(url)
+
 def is_rhel8_alpha(parser):
     result = False
     try:
@@ -290,6 +419,8 @@ def get_arches(self):
         """ Return a list of arches
         """
         specific_arches = self.options.arch
+        url_prober.prefetch(os.path.join(self.parser.url, x)
+                for x in (specific_arches or self.arches))
         if specific_arches:
             return filter(lambda x: url_exists(os.path.join(self.parser.url,x)) \
                       and x, [arch for arch in specific_arches])
@@ -301,6 +432,7 @@ def get_os_dir(self, arch):
         """ Return path to os directory
         """
         base_path = os.path.join(self.parser.url, arch)
+        url_prober.prefetch(os.path.join(base_path, x) for x in self.os_dirs)
         try:
             os_dir = filter(lambda x: url_exists(os.path.join(base_path, x)) \
                             and x, self.os_dirs)[0]
@@ -693,6 +825,37 @@ def find_repos(self, repo_base, rpath, variant, arch):
 
         return repos
 
+    def prefetch_repos(self):
+        """
+        Checks every repo listed in .composeinfo for the variants and arches
+        being imported at the same time, rather than one by one for each tree.
+        """
+        urls = []
+        def add_variant(variant, arch, os_dir, rpath):
+            for sub_variant in self.parser.get('variant-%s' % variant,
+                    'variants', '').split(','):
+                if sub_variant:
+                    add_variant(sub_variant, arch, os_dir, rpath)
+            # same as find_repos, addons are picked up from .treeinfo
+            if self.parser.get('variant-%s' % variant, 'type', '') == 'addon':
+                return
+            section = 'variant-%s.%s' % (variant, arch)
+            for key in ['repository', 'debuginfo']:
+                path = self.parser.get(section, key, '')
+                if path:
+                    urls.append(os.path.join(self.parser.url, os_dir, rpath,
+                            path, 'repodata'))
+        for variant in self.get_variants():
+            for arch in self.get_arches(variant):
+                os_dir = self.parser.get('variant-%s.%s' % (variant, arch),
+                        'os_dir', '')
+                if not os_dir:
+                    continue
+                rpath = os.path.join(*['..' for i in range(0,
+                                                len(os_dir.split('/')))])
+                add_variant(variant, arch, os_dir, rpath)
+        url_prober.prefetch(urls)
+
     def _guess_appstream_repos(self, rpath, arch, repo_base):
         """Iterate over possible layouts to guess which one fits and return a list of repositories."""
         repo_layout = {
@@ -719,6 +882,8 @@ def _guess_appstream_repos(self, rpath, arch, repo_base):
         }
 
         appstream_repos = []
+        url_prober.prefetch(os.path.join(repo_base, repos[0][2], 'repodata')
+                for repos in repo_layout.values())
         for dirname, repos in repo_layout.items():
             url = os.path.join(repo_base, repos[0][2], 'repodata')
             logging.debug('Trying to import %s', repos[0][2])
@@ -737,6 +902,7 @@ def process(self, urls, options):
         self.options = options
         self.scheduler = SchedulerProxy(self.options)
         self.distro_trees = []
+        self.prefetch_repos()
         for variant in self.get_variants():
             for arch in self.get_arches(variant):
                 os_dir = self.parser.get('variant-%s.%s' %
@@ -961,6 +1127,8 @@ def find_common_repos(self, repo_base, arch):
                        '../../optional/%s/os' % arch),
                      ]
         repos = []
+        url_prober.prefetch(os.path.join(repo_base, repo[2], 'repodata')
+                for repo in repo_paths)
         for repo in repo_paths:
             if url_exists(os.path.join(repo_base, repo[2], 'repodata')):
                 repos.append(dict(
@@ -1035,6 +1203,7 @@ def is_importer_for(cls, url, options=None):
         return parser
 
     def get_kernel_path(self):
+        url_prober.prefetch(os.path.join(self.parser.url, x) for x in self.kernels)
         try:
             return filter(lambda x: url_exists(os.path.join(self.parser.url,x)) \
                           and x, [kernel for kernel in self.kernels])[0]
@@ -1042,6 +1211,7 @@ def get_kernel_path(self):
             raise BX('%s no kernel found: %s' % (self.parser.url, e))
 
     def get_initrd_path(self):
+        url_prober.prefetch(os.path.join(self.parser.url, x) for x in self.initrds)
         try:
             return filter(lambda x: url_exists(os.path.join(self.parser.url,x)) \
                           and x, [initrd for initrd in self.initrds])[0]
@@ -1107,6 +1277,8 @@ def find_repos(self, *args, **kw):
                        'addon',
                        'Workstation'),
                      ]
+        url_prober.prefetch(os.path.join(self.parser.url, repo[2], 'repodata')
+                for repo in repo_paths)
         for repo in repo_paths:
             if url_exists(os.path.join(self.parser.url,repo[2],'repodata')):
                 repos.append(dict(
@@ -1209,6 +1381,8 @@ def find_repos(self):
                       ('distro', 'distro', '.'),
                      ]
         repos = []
+        url_prober.prefetch(os.path.join(self.parser.url, repo[2], 'repodata')
+                for repo in repo_paths)
         for repo in repo_paths:
             if url_exists(os.path.join(self.parser.url,repo[2],'repodata')):
                 repos.append(dict(
@@ -1261,6 +1435,8 @@ def find_common_repos(self, repo_base, arch):
                        '../debug'),
                       ]
         repos = []
+        url_prober.prefetch(os.path.join(repo_base, repo[2], 'repodata')
+                for repo in repo_paths)
         for repo in repo_paths:
             if url_exists(os.path.join(repo_base, repo[2], 'repodata')):
                 repos.append(dict(
@@ -1285,6 +1461,8 @@ def find_repos(self):
                        'fedora',
                        '../../../Everything/%s/os' % self.tree['arch'])]
 
+        url_prober.prefetch(os.path.join(self.parser.url, repo[2], 'repodata')
+                for repo in repo_paths)
         for repo in repo_paths:
             if url_exists(os.path.join(self.parser.url,repo[2],'repodata')):
                 repos.append(dict(
@@ -2012,6 +2190,10 @@ def main():
                       help="show debug messages")
     parser.add_option('--dry-run', action='store_true',
             help='Do not actually add any distros to beaker')
+    parser.add_option("--probe-workers",
+                      type=int,
+                      default=8,
+                      help="Number of URLs to check for at the same time [default: %default]")
     parser.add_option("-q", "--quiet",
                       action='store_true',
                       default=False,
@@ -2096,6 +2278,8 @@ def main():
         sys.exit(2)
     if opts.dry_run:
         logging.info('Dry Run only, no data will be sent to beaker')
+    url_prober.workers = opts.probe_workers
+    start = time.time()
     exit_status = []
     try:
         build = Build(primary_url, options=opts)
@@ -2108,6 +2292,10 @@ def main():
     except (xmlrpclib.Fault,BX), err:
         logging.critical(err)
         sys.exit(127)
+    finally:
+        url_prober.close()
+        logging.debug('Import took %.1f seconds', time.time() - start)
+        url_prober.log_summary()
     if opts.run_jobs:
         logging.info('running jobs.')
         build.run_jobs()
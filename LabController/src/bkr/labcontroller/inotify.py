@@ -0,0 +1,193 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Watches the console log directory with inotify, so that beaker-watchdog can
+read console output as soon as it is written instead of polling every file.
+
+The inotify calls are made through ctypes to avoid an extra dependency. If
+inotify is not usable (or the directory does not exist yet) the watcher is
+simply inactive, and the monitors fall back to polling.
+"""
+
+import os
+import errno
+import struct
+import ctypes
+import ctypes.util
+import logging
+from collections import defaultdict
+import gevent, gevent.socket
+
+logger = logging.getLogger(__name__)
+
+IN_MODIFY = 0x00000002
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_CLOEXEC = 02000000
+IN_NONBLOCK = 04000
+
+_event_header = struct.Struct('iIII')
+
+_libc = None
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return _libc
+
+def _check(result):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+class Inotify(object):
+    """
+    A non-blocking inotify instance, read cooperatively under gevent.
+    """
+
+    def __init__(self):
+        libc = _get_libc()
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not supported')
+        self.fd = _check(libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+
+    def add_watch(self, path, mask):
+        return _check(_get_libc().inotify_add_watch(self.fd, path, mask))
+
+    def read_events(self):
+        """
+        Waits for events and returns them as a list of (wd, mask, name).
+        """
+        while True:
+            gevent.socket.wait_read(self.fd)
+            try:
+                data = os.read(self.fd, 65536)
+                break
+            except OSError, e:
+                if e.errno not in (errno.EAGAIN, errno.EINTR):
+                    raise
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _event_header.unpack_from(data, offset)
+            offset += _event_header.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class ConsoleLogWatcher(object):
+    """
+    Watches the console log directory with a single inotify watch. Callbacks
+    subscribed for a system are called with the full path of any file
+    starting with its FQDN (the same files utils.get_console_files() finds)
+    which is created or written to. They are called with None if events may
+    have been missed, in which case the subscriber should rescan everything.
+
+    Subscriptions are dropped if the watcher stops. The generation attribute
+    is incremented every time it starts, so that subscribers can tell when
+    they need to subscribe again.
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.active = False
+        self.generation = 0
+        self._start_failed = False
+        self._inotify = None
+        self._greenlet = None
+        self._subscribers = defaultdict(set)
+
+    def start(self):
+        """
+        Starts watching the directory. Returns False if that is not possible,
+        in which case it can be tried again later.
+        """
+        if self.active:
+            return True
+        try:
+            self._inotify = Inotify()
+            self._inotify.add_watch(self.directory,
+                    IN_MODIFY | IN_CREATE | IN_MOVED_TO)
+        except (OSError, IOError), e:
+            # Only warn the first time, since we are retried on every poll.
+            log = logger.debug if self._start_failed else logger.warning
+            log('Cannot watch console logs in %s with inotify, '
+                    'polling instead: %s', self.directory, e)
+            self._start_failed = True
+            self.close()
+            return False
+        logger.info('Watching console logs in %s with inotify', self.directory)
+        self._start_failed = False
+        self.active = True
+        self.generation += 1
+        self._greenlet = gevent.spawn(self._run, self._inotify)
+        return True
+
+    def subscribe(self, system_name, callback):
+        self._subscribers[system_name].add(callback)
+
+    def unsubscribe(self, system_name, callback):
+        callbacks = self._subscribers.get(system_name)
+        if callbacks is not None:
+            callbacks.discard(callback)
+            if not callbacks:
+                del self._subscribers[system_name]
+
+    def _notify(self, name):
+        # Any prefix of the file name could be a subscribed FQDN.
+        path = os.path.join(self.directory, name)
+        for i in range(1, len(name) + 1):
+            for callback in list(self._subscribers.get(name[:i], ())):
+                callback(path)
+
+    def _notify_all(self):
+        for callbacks in list(self._subscribers.values()):
+            for callback in list(callbacks):
+                callback(None)
+
+    def _run(self, inotify):
+        try:
+            while True:
+                for wd, mask, name in inotify.read_events():
+                    if mask & IN_Q_OVERFLOW:
+                        logger.warning('Console log events overflowed, rescanning')
+                        self._notify_all()
+                    elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                        logger.warning('Console log directory %s went away, '
+                                'polling until it is watched again', self.directory)
+                        return
+                    elif name:
+                        self._notify(name)
+        except Exception:
+            logger.exception('Error watching console logs, polling instead')
+        finally:
+            # We may have been killed by close(), and even started again since.
+            if self._inotify is inotify:
+                self._notify_all()
+                self.close()
+
+    def close(self):
+        self.active = False
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+        if self._greenlet is not None and self._greenlet is not gevent.getcurrent():
+            self._greenlet.kill(block=False)
+        self._greenlet = None
+        self._subscribers.clear()
@@ -0,0 +1,263 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Write-behind journal for task status changes reported by harnesses.
+
+When HARNESS_JOURNAL_DIR is set, beaker-proxy does not make harnesses wait
+for the server to record task status changes. Each change is appended to
+a journal file for its recipe and flushed to disk before the harness gets its
+response. A greenlet for the recipe then replays the recipe's changes to the
+server in order, retrying for as long as the server cannot be reached or fails
+to record it. If the server rejects a change because it can never be
+recorded (the task does not exist or has already finished), the harness is
+told on its next call for the recipe.
+
+Each journal file is named after its recipe ID and holds one JSON object per
+line. The number of entries already replayed is kept next to it, in a file
+with the .replayed suffix, and both files are removed once the whole journal
+has been replayed.
+"""
+
+import os
+import errno
+import json
+import socket
+import httplib
+import logging
+import xmlrpclib
+import gevent
+import gevent.event
+import gevent.lock
+
+logger = logging.getLogger(__name__)
+
+REPLAYED_SUFFIX = '.replayed'
+
+#: Faults from the server which mean it will never accept the change. The
+#: server turns every error into a fault, including ones which may go away
+#: (database deadlocks and lock wait timeouts), so anything else is retried.
+REJECTIONS = ('Cannot restart finished task',
+              'Cannot change status for finished task',
+              'Invalid task ID',
+              'No watchdog exists for recipe',
+              'was never started')
+
+def is_rejection(fault):
+    return any(message in fault.faultString for message in REJECTIONS)
+
+
+def _write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+class HarnessJournal(object):
+
+    def __init__(self, path, hub, log_storage, concurrency=10,
+            max_retry_delay=60):
+        self.path = path
+        self.hub = hub
+        self.log_storage = log_storage
+        self.max_retry_delay = max_retry_delay
+        # Limits how many recipes are replayed at once, so that a backlog
+        # built up while the server was down does not all arrive at once.
+        self.replay_slots = gevent.lock.BoundedSemaphore(concurrency)
+        self.pending = {} #: recipe ID -> list of changes not replayed yet
+        self.replayed = {} #: recipe ID -> number of changes already replayed
+        self.drained = {} #: recipe ID -> Event set when nothing is pending
+        self.failures = {} #: recipe ID -> message from the server rejecting a change
+        self.replayers = {} #: recipe ID -> greenlet replaying its changes
+        self.stopping = False
+
+    def accepts(self, recipe_id):
+        return str(recipe_id).isdigit()
+
+    def _journal_path(self, recipe_id):
+        return os.path.join(self.path, recipe_id)
+
+    def start(self):
+        """
+        Loads any changes left in the journal by a previous run and starts
+        replaying them.
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        for name in os.listdir(self.path):
+            if self.accepts(name):
+                self._load(name)
+
+    def _load(self, recipe_id):
+        journal_path = self._journal_path(recipe_id)
+        with open(journal_path, 'r+') as f:
+            data = f.read()
+            if data and not data.endswith('\n'):
+                # The last change was not completely written, so it was never
+                # acknowledged to the harness.
+                logger.warning('Discarding incomplete entry at the end of %s',
+                        journal_path)
+                data = data[:data.rfind('\n') + 1]
+                f.truncate(len(data))
+        changes = [json.loads(line) for line in data.splitlines()]
+        try:
+            with open(journal_path + REPLAYED_SUFFIX) as f:
+                replayed = int(f.read())
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            replayed = 0
+        logger.info('Replaying %s changes for recipe %s left in the journal',
+                len(changes) - replayed, recipe_id)
+        self.pending[recipe_id] = changes[replayed:]
+        self.replayed[recipe_id] = replayed
+        self.drained[recipe_id] = gevent.event.Event()
+        self._ensure_replaying(recipe_id)
+
+    def append(self, recipe_id, change):
+        """
+        Adds a task status change to the journal for the recipe. The change
+        is on disk when this returns.
+        """
+        recipe_id = str(recipe_id)
+        assert self.accepts(recipe_id)
+        journal_path = self._journal_path(recipe_id)
+        created = not os.path.exists(journal_path)
+        fd = os.open(journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            _write_all(fd, json.dumps(change) + '\n')
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        if created:
+            dir_fd = os.open(self.path, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        self.pending.setdefault(recipe_id, []).append(change)
+        self.replayed.setdefault(recipe_id, 0)
+        self.drained.setdefault(recipe_id, gevent.event.Event())
+        self._ensure_replaying(recipe_id)
+
+    def wait_drained(self, recipe_id, timeout=None):
+        """
+        Waits until every change for the recipe has been replayed. Returns
+        False if that did not happen within timeout seconds.
+        """
+        drained = self.drained.get(str(recipe_id))
+        if drained is None:
+            return True
+        return drained.wait(timeout)
+
+    def take_failure(self, recipe_id):
+        """
+        Returns the message from the server rejecting the last change for the
+        recipe which it rejected, if it has not been returned already.
+        """
+        return self.failures.pop(str(recipe_id), None)
+
+    def _ensure_replaying(self, recipe_id):
+        if recipe_id not in self.replayers and not self.stopping:
+            self.replayers[recipe_id] = gevent.spawn(self._replay, recipe_id)
+
+    def _replay(self, recipe_id):
+        delay = 1
+        relogin = False
+        try:
+            while self.pending[recipe_id] and not self.stopping:
+                change = self.pending[recipe_id][0]
+                try:
+                    with self.replay_slots:
+                        if relogin:
+                            logger.debug('Session expired, re-authenticating')
+                            self.hub._login()
+                        self._send(change)
+                except xmlrpclib.Fault, fault:
+                    if 'Anonymous access denied' in fault.faultString and not relogin:
+                        relogin = True
+                        continue
+                    if not is_rejection(fault):
+                        logger.warning('Server failed to record %s status for task %s '
+                                'in recipe %s (%s), retrying in %s seconds',
+                                change['status'], change['task_id'], recipe_id,
+                                fault.faultString, delay)
+                        gevent.sleep(delay)
+                        delay = min(delay * 2, self.max_retry_delay)
+                        continue
+                    logger.error('Server rejected %s status for task %s in recipe %s: %s',
+                            change['status'], change['task_id'], recipe_id,
+                            fault.faultString)
+                    self.failures[recipe_id] = fault.faultString
+                except Exception, e:
+                    if isinstance(e, (socket.error, httplib.HTTPException,
+                            xmlrpclib.ProtocolError)):
+                        logger.warning('Failed to send %s status for task %s in '
+                                'recipe %s (%s), retrying in %s seconds',
+                                change['status'], change['task_id'], recipe_id,
+                                e, delay)
+                    else:
+                        logger.exception('Error sending %s status for task %s in '
+                                'recipe %s, retrying in %s seconds',
+                                change['status'], change['task_id'], recipe_id,
+                                delay)
+                    gevent.sleep(delay)
+                    delay = min(delay * 2, self.max_retry_delay)
+                    continue
+                delay = 1
+                relogin = False
+                self.pending[recipe_id].pop(0)
+                self.replayed[recipe_id] += 1
+                # Even after the last change, in case we stop before the
+                # journal is removed.
+                self._write_replayed(recipe_id)
+            if not self.pending[recipe_id]:
+                self._remove(recipe_id)
+        finally:
+            del self.replayers[recipe_id]
+
+    def _send(self, change):
+        task_id = change['task_id']
+        status = change['status']
+        if status != 'running':
+            self.log_storage.flush_registrations(finishing=('task', task_id))
+        if status == 'running':
+            self.hub.recipes.tasks.start(task_id)
+        elif status == 'completed':
+            self.hub.recipes.tasks.stop(task_id, 'stop')
+        elif status == 'aborted':
+            self.hub.recipes.tasks.stop(task_id, 'abort', change.get('message'))
+
+    def _write_replayed(self, recipe_id):
+        replayed_path = self._journal_path(recipe_id) + REPLAYED_SUFFIX
+        with open(replayed_path + '.tmp', 'w') as f:
+            f.write('%d\n' % self.replayed[recipe_id])
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(replayed_path + '.tmp', replayed_path)
+
+    def _remove(self, recipe_id):
+        # Nothing here yields to other greenlets, so no change can be
+        # appended between checking the journal is empty and removing it.
+        journal_path = self._journal_path(recipe_id)
+        for path in [journal_path, journal_path + REPLAYED_SUFFIX]:
+            try:
+                os.unlink(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        del self.pending[recipe_id]
+        del self.replayed[recipe_id]
+        self.drained.pop(recipe_id).set()
+
+    def stop(self, timeout=10):
+        """
+        Stops replaying, giving changes which are being sent up to timeout
+        seconds to finish. The rest are replayed when the journal is next
+        started.
+        """
+        self.stopping = True
+        replayers = self.replayers.values()
+        gevent.joinall(replayers, timeout=timeout)
+        gevent.killall(replayers)
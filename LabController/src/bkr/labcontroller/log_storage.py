@@ -8,8 +8,140 @@
 
 import os, os.path
 import errno
+import fcntl
+import gzip
+import logging
+import mimetypes
+import time
+import xmlrpclib
+from collections import OrderedDict
+import gevent, gevent.lock
 from bkr.common.helpers import makedirs_ignore
 
+logger = logging.getLogger(__name__)
+
+#: Logs which have not been written to for a while can be compressed in the
+#: cache by compress_log(). The compressed copy replaces the original, under
+#: the same name with this suffix added. The suffix doubles as a marker, so
+#: logs which were uploaded already gzipped are never mistaken for it.
+COMPRESSED_SUFFIX = '.beaker.gz'
+
+def is_compressible(path):
+    """
+    Returns True if the log at path is worth compressing, based on its name.
+    """
+    content_type, encoding = mimetypes.guess_type(path)
+    return encoding is None and (content_type is None
+            or content_type.startswith('text/'))
+
+def stored_path(path):
+    """
+    Returns the path of the file where the log at path is stored, which is
+    the compressed copy if it has been compressed, or None if neither exists.
+    """
+    if os.path.exists(path):
+        return path
+    if os.path.exists(path + COMPRESSED_SUFFIX):
+        return path + COMPRESSED_SUFFIX
+    return None
+
+def _try_lock(f):
+    """
+    Takes an exclusive lock on the open file f without blocking. Returns
+    False if someone else holds it.
+    """
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except IOError, e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        return False
+
+def _lock(f):
+    """
+    Takes an exclusive lock on the open file f, cooperatively waiting for
+    the current holder (if any) to release it.
+    """
+    while not _try_lock(f):
+        gevent.sleep(0.1)
+
+def compress_log(path, min_age, min_size=4096, blocksize=65536):
+    """
+    Replaces the log at path with a gzip compressed copy, if it has not been
+    modified for at least min_age seconds. Returns the number of bytes saved,
+    or None if the log was left alone. Logs smaller than min_size would not
+    take up any less space on disk.
+
+    Writers hold a lock on the log while it is open (see LogFile), so a log
+    which is being written to is skipped. Once the compressed copy is in
+    place the original is removed, while still holding the lock. A writer
+    waiting for the lock notices that and restores the log before writing.
+    Readers do not lock, but at every point at least one of the two files
+    has the complete log.
+    """
+    if path.endswith((COMPRESSED_SUFFIX, '.tmp')) or not is_compressible(path):
+        return None
+    try:
+        f = open(path, 'r')
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    with f:
+        if not _try_lock(f):
+            return None
+        st = os.fstat(f.fileno())
+        if st.st_nlink == 0 or st.st_size < min_size \
+                or time.time() - st.st_mtime < min_age:
+            return None
+        compressed_path = path + COMPRESSED_SUFFIX
+        tmp_path = compressed_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as tmp:
+                gz = gzip.GzipFile(filename='', mode='wb', fileobj=tmp,
+                        mtime=int(st.st_mtime))
+                while True:
+                    data = f.read(blocksize)
+                    if not data:
+                        break
+                    gz.write(data)
+                gz.close()
+                tmp.flush()
+                os.fsync(tmp.fileno())
+                compressed_size = os.fstat(tmp.fileno()).st_size
+            os.chmod(tmp_path, st.st_mode & 0777)
+            # Keep the modification time, which is the Last-Modified time
+            # of the log when it is served.
+            os.utime(tmp_path, (st.st_atime, st.st_mtime))
+            os.rename(tmp_path, compressed_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        os.unlink(path)
+    return st.st_size - compressed_size
+
+def decompress_log(compressed_path, dest_path, blocksize=65536):
+    """
+    Writes the decompressed contents of the log compressed at compressed_path
+    to a new file at dest_path, with the same permissions and modification
+    time.
+    """
+    st = os.stat(compressed_path)
+    gz = gzip.open(compressed_path, 'rb')
+    try:
+        with open(dest_path, 'wb') as dest:
+            while True:
+                data = gz.read(blocksize)
+                if not data:
+                    break
+                dest.write(data)
+    finally:
+        gz.close()
+    os.chmod(dest_path, st.st_mode & 0777)
+    os.utime(dest_path, (st.st_atime, st.st_mtime))
+
 class LogFile(object):
 
     def __init__(self, path, register_func, create=True):
@@ -20,41 +152,117 @@ def __init__(self, path, register_func, create=True):
     def __repr__(self):
         return '%s(%r)' % (self.__class__.__name__, self.path)
 
+    @property
+    def compressed_path(self):
+        """
+        Absolute path where the log is stored if it has been compressed.
+        """
+        return self.path + COMPRESSED_SUFFIX
+
+    def open_stored(self):
+        """
+        Opens the log for reading as it is stored. Returns a tuple of the open
+        file and a boolean, which is True if the file is gzip compressed.
+        """
+        # The log may be compressed or restored in between the two attempts,
+        # but not twice.
+        for path, compressed in [(self.path, False),
+                (self.compressed_path, True), (self.path, False)]:
+            try:
+                return open(path, 'r'), compressed
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), self.path)
+
     def open_ro(self):
         """
         If you just want to read the log, call this instead of entering the context manager.
+        Compressed logs are decompressed as they are read.
+        """
+        f, compressed = self.open_stored()
+        if compressed:
+            return gzip.GzipFile(fileobj=f, mode='rb')
+        return f
+
+    def _restore(self):
+        """
+        Decompresses the log back to its original path, if it has been
+        compressed and not already restored.
         """
-        return open(self.path, 'r')
+        try:
+            compressed = open(self.compressed_path, 'r')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        with compressed:
+            _lock(compressed)
+            if os.path.exists(self.path):
+                # someone else restored it while we were waiting
+                return
+            st = os.fstat(compressed.fileno())
+            tmp_path = self.path + '.restore.tmp'
+            with open(tmp_path, 'wb') as tmp:
+                gz = gzip.GzipFile(fileobj=compressed, mode='rb')
+                while True:
+                    data = gz.read(65536)
+                    if not data:
+                        break
+                    tmp.write(data)
+                tmp.flush()
+                os.fsync(tmp.fileno())
+            os.chmod(tmp_path, st.st_mode & 0777)
+            os.rename(tmp_path, self.path)
+            os.unlink(self.compressed_path)
+        logger.debug('Restored compressed log %s', self.path)
 
     def __enter__(self):
         makedirs_ignore(os.path.dirname(self.path), 0755)
-        created = False
-        if self.create:
-            try:
-                # stdio does not have any mode string which corresponds to this 
-                # combination of flags, so we have to use raw os.open :-(
-                fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0644)
-                created = True
-            except (OSError, IOError), e:
-                if e.errno != errno.EEXIST:
-                    raise
+        while True:
+            if not os.path.exists(self.path):
+                self._restore()
+            created = False
+            if self.create:
+                try:
+                    # stdio does not have any mode string which corresponds to this 
+                    # combination of flags, so we have to use raw os.open :-(
+                    fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0644)
+                    created = True
+                except (OSError, IOError), e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                    fd = os.open(self.path, os.O_RDWR)
+            else:
                 fd = os.open(self.path, os.O_RDWR)
-        else:
-            fd = os.open(self.path, os.O_RDWR)
-        try:
-            self.f = os.fdopen(fd, 'r+')
-        except Exception:
-            os.close(fd)
-            raise
-        try:
-            if created:
-                # first time we have touched this file, need to register it
-                self.register_func()
-            return self
-        except Exception:
-            self.f.close()
-            del self.f
-            raise
+            try:
+                self.f = os.fdopen(fd, 'r+')
+            except Exception:
+                os.close(fd)
+                raise
+            try:
+                # Keep the log from being compressed while we have it open.
+                _lock(self.f)
+                if os.fstat(fd).st_nlink == 0:
+                    # It was compressed while we were waiting for the lock.
+                    self.f.close()
+                    del self.f
+                    continue
+                if created and os.path.exists(self.compressed_path):
+                    # It was compressed in between, and we have raced the
+                    # restore. Start again so that it is restored.
+                    self.f.close()
+                    del self.f
+                    os.unlink(self.path)
+                    continue
+                if created:
+                    # first time we have touched this file, need to register it
+                    self.register_func()
+                return self
+            except Exception:
+                self.f.close()
+                del self.f
+                raise
 
     def __exit__(self, type, value, traceback):
         self.f.close()
@@ -72,6 +280,26 @@ def update_chunk(self, data, offset):
         self.f.write(data)
         self.f.flush()
 
+    def update_chunk_from_stream(self, stream, offset, length, blocksize=65536):
+        """
+        Like update_chunk(), but copies length bytes from the file-like
+        stream a block at a time, so that large chunks are never held in
+        memory. Returns the number of bytes written, which is less than length
+        if the stream ended early.
+        """
+        if offset < 0:
+            raise ValueError('Offset cannot be negative')
+        self.f.seek(offset, os.SEEK_SET)
+        written = 0
+        while written < length:
+            data = stream.read(min(blocksize, length - written))
+            if not data:
+                break
+            self.f.write(data)
+            written += len(data)
+        self.f.flush()
+        return written
+
 class LogStorage(object):
 
     """
@@ -80,14 +308,47 @@ class LogStorage(object):
     The old XML-RPC API doesn't include the recipe ID with the task or result 
     upload calls. So for now, everything is stored flat. Eventually it would be 
     nice to arrange things hierarchically with everything under recipe instead.
+
+    Each new log file has to be registered with the server. If
+    registration_delay is non-zero, only the first file for each recipe, task
+    or result is registered while its upload is being handled (so uploads for
+    a finished one still fail straight away). Later files are queued and
+    registered in batches at most that many seconds later. The recipe, task
+    or result may also be finished by something other than this proxy (the
+    watchdog, or a user cancelling the job), so after registration_ttl
+    seconds its next file is registered straight away again.
+
+    Callers must call flush_registrations() before passing on anything which
+    could finish a recipe or task, so that every queued file is registered
+    (or fails to register) while the recipe is still running, as it would
+    have been without batching. If a queued file fails to register, the error
+    is raised to the next upload which creates a file for the same recipe,
+    task or result.
     """
 
-    def __init__(self, base_dir, base_url, hub):
+    #: Maximum number of files registered in one call to the server.
+    max_registration_batch = 500
+    #: Maximum number of recipes, tasks and results remembered as having
+    #: registered files, or as having failed to.
+    max_registration_entities = 10000
+    #: Seconds after registering a file straight away for a recipe, task or
+    #: result before its files are registered straight away again.
+    registration_ttl = 30
+
+    def __init__(self, base_dir, base_url, hub, registration_delay=0):
         self.base_dir = base_dir
         if not base_url.endswith('/'):
             base_url += '/' # really it is always a directory
         self.base_url = base_url
         self.hub = hub
+        self.registration_delay = registration_delay
+        self._pending_registrations = OrderedDict()
+        self._registered_entities = OrderedDict() #: key -> time registered
+        self._entity_parents = OrderedDict() #: task or result key -> parent keys
+        self._registration_errors = OrderedDict()
+        self._registration_lock = gevent.lock.Semaphore()
+        self._flush_scheduled = False
+        self._bulk_registration = True
 
     def recipe(self, recipe_id, path, create=True):
         path = os.path.normpath(path.lstrip('/'))
@@ -98,12 +359,12 @@ def recipe(self, recipe_id, path, create=True):
         recipe_base_url = '%srecipes/%s+/%s/' % (self.base_url,
                 recipe_id[:-3] or '0', recipe_id)
         return LogFile(os.path.join(recipe_base_dir, path),
-                lambda: self.hub.recipes.register_file(recipe_base_url,
-                    recipe_id, os.path.dirname(path), os.path.basename(path),
+                lambda: self._register('recipe', recipe_id, recipe_base_url,
+                    os.path.dirname(path), os.path.basename(path),
                     recipe_base_dir),
                 create=create)
 
-    def task(self, task_id, path, create=True):
+    def task(self, task_id, path, create=True, recipe_id=None):
         path = os.path.normpath(path.lstrip('/'))
         if path.startswith('../'):
             raise ValueError('Upload path not allowed: %s' % path)
@@ -112,12 +373,12 @@ def task(self, task_id, path, create=True):
         task_base_url = '%stasks/%s+/%s/' % (self.base_url,
                 task_id[:-3] or '0', task_id)
         return LogFile(os.path.join(task_base_dir, path),
-                lambda: self.hub.recipes.tasks.register_file(task_base_url,
-                    task_id, os.path.dirname(path), os.path.basename(path),
-                    task_base_dir),
+                lambda: self._register('task', task_id, task_base_url,
+                    os.path.dirname(path), os.path.basename(path),
+                    task_base_dir, parents=[('recipe', recipe_id)]),
                 create=create)
 
-    def result(self, result_id, path, create=True):
+    def result(self, result_id, path, create=True, recipe_id=None, task_id=None):
         path = os.path.normpath(path.lstrip('/'))
         if path.startswith('../'):
             raise ValueError('Upload path not allowed: %s' % path)
@@ -126,7 +387,153 @@ def result(self, result_id, path, create=True):
         result_base_url = '%sresults/%s+/%s/' % (self.base_url,
                 result_id[:-3] or '0', result_id)
         return LogFile(os.path.join(result_base_dir, path),
-                lambda: self.hub.recipes.tasks.register_result_file(result_base_url,
-                    result_id, os.path.dirname(path), os.path.basename(path),
-                    result_base_dir),
+                lambda: self._register('result', result_id, result_base_url,
+                    os.path.dirname(path), os.path.basename(path),
+                    result_base_dir,
+                    parents=[('recipe', recipe_id), ('task', task_id)]),
                 create=create)
+
+    def compress_logs(self, paths, min_age):
+        """
+        Compresses each of the logs at the given paths which has not been
+        written to for at least min_age seconds. Returns a tuple of the number
+        of logs compressed and the number of bytes saved.
+        """
+        count = saved = 0
+        for path in paths:
+            try:
+                result = compress_log(path, min_age)
+            except (IOError, OSError):
+                logger.exception('Error compressing log %s', path)
+                continue
+            if result is not None:
+                count += 1
+                saved += result
+        return count, saved
+
+    def _remember(self, entities, key, value):
+        entities.pop(key, None)
+        entities[key] = value
+        while len(entities) > self.max_registration_entities:
+            entities.popitem(last=False)
+
+    def _register(self, log_type, entity_id, server, path, filename, basepath,
+            parents=()):
+        error = self._registration_errors.get((log_type, entity_id))
+        if error is not None:
+            # An earlier file failed to register, so this one would too.
+            raise xmlrpclib.Fault(1, error)
+        registered = self._registered_entities.get((log_type, entity_id))
+        if not self.registration_delay or registered is None or \
+                time.time() - registered >= self.registration_ttl:
+            self._register_one(log_type, entity_id, server, path, filename, basepath)
+            if self.registration_delay:
+                self._remember(self._registered_entities, (log_type, entity_id),
+                        time.time())
+                # Remember which recipe and task it belongs to, if the
+                # caller knows, so that finishing them forgets it too.
+                parents = frozenset((parent_type, str(parent_id))
+                        for parent_type, parent_id in parents
+                        if parent_id is not None)
+                if parents:
+                    self._remember(self._entity_parents, (log_type, entity_id),
+                            parents)
+            return
+        self._pending_registrations[(log_type, entity_id, path, filename)] = \
+                dict(type=log_type, id=entity_id, server=server, path=path,
+                     filename=filename, basepath=basepath)
+        if len(self._pending_registrations) >= self.max_registration_batch:
+            gevent.spawn(self._flush_in_background)
+        else:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            gevent.spawn_later(self.registration_delay, self._flush_in_background)
+
+    def _register_one(self, log_type, entity_id, server, path, filename, basepath):
+        if log_type == 'recipe':
+            self.hub.recipes.register_file(server, entity_id, path, filename,
+                    basepath)
+        elif log_type == 'task':
+            self.hub.recipes.tasks.register_file(server, entity_id, path,
+                    filename, basepath)
+        else:
+            self.hub.recipes.tasks.register_result_file(server, entity_id,
+                    path, filename, basepath)
+
+    def _register_batch(self, registrations):
+        """
+        Returns a list with the error message for each registration which
+        failed, or an empty string.
+        """
+        if self._bulk_registration:
+            try:
+                return self.hub.recipes.register_files(registrations)
+            except xmlrpclib.Fault, fault:
+                if 'not implemented by this server' in fault.faultString:
+                    logger.info('Server cannot register files in batches, '
+                            'registering them one at a time')
+                    self._bulk_registration = False
+                else:
+                    # Find out which file the server is choking on.
+                    logger.warning('Error registering log files in a batch, '
+                            'registering them one at a time: %s', fault.faultString)
+        errors = []
+        for r in registrations:
+            try:
+                self._register_one(r['type'], r['id'], r['server'], r['path'],
+                        r['filename'], r['basepath'])
+            except xmlrpclib.Fault, fault:
+                errors.append(fault.faultString)
+            else:
+                errors.append('')
+        return errors
+
+    def _flush_in_background(self):
+        self._flush_scheduled = False
+        try:
+            self.flush_registrations()
+        except Exception:
+            logger.exception('Error registering log files, will retry')
+
+    def flush_registrations(self, finishing=None):
+        """
+        Registers every queued file with the server. If the server cannot be
+        reached, the files stay queued and the exception is raised.
+
+        If finishing is given, as a tuple of log type ('recipe', 'task' or
+        'result') and ID, the next file for it will be registered straight
+        away again so that the upload fails if it has finished. The same goes
+        for its tasks and results, where the caller said which recipe or task
+        they belong to.
+        """
+        if finishing is not None:
+            finishing = (finishing[0], str(finishing[1]))
+            self._registered_entities.pop(finishing, None)
+            for key, parents in self._entity_parents.items():
+                if finishing in parents:
+                    self._registered_entities.pop(key, None)
+                    del self._entity_parents[key]
+        with self._registration_lock:
+            keys = list(self._pending_registrations)
+            for start in range(0, len(keys), self.max_registration_batch):
+                batch = [(key, self._pending_registrations.pop(key))
+                        for key in keys[start:start + self.max_registration_batch]
+                        if key in self._pending_registrations]
+                try:
+                    errors = self._register_batch([r for key, r in batch])
+                except Exception:
+                    for key, registration in batch:
+                        self._pending_registrations.setdefault(key, registration)
+                    self._schedule_flush()
+                    raise
+                for (key, registration), error in zip(batch, errors):
+                    if not error:
+                        continue
+                    logger.warning('Failed to register log file %s: %s',
+                            os.path.join(registration['basepath'],
+                                registration['path'], registration['filename']),
+                            error)
+                    self._remember(self._registration_errors, key[:2], error)
@@ -22,6 +22,7 @@
 from bkr.common.helpers import RepeatTimer
 from bkr.labcontroller.proxy import Proxy, ProxyHTTP
 from bkr.labcontroller.config import get_conf, load_conf
+from bkr.labcontroller import sendfile
 from bkr.log import log_to_stream, log_to_syslog
 import logging
 logger = logging.getLogger(__name__)
@@ -122,15 +123,24 @@ def __init__(self, proxy):
                  methods=['HEAD', 'GET'],
                  endpoint=(self.proxy_http, 'healthz'))
         ])
+        # These stream the request body to disk and apply their own limit.
+        self.streaming_endpoints = [(self.proxy_http, 'do_recipe_log'),
+                (self.proxy_http, 'do_task_log'),
+                (self.proxy_http, 'do_result_log')]
 
     @LimitedRequest.application
     def __call__(self, req):
         try:
-            # Limit request data in all cases.
-            if req.max_content_length is not None and \
+            if req.path in ('/', '/RPC2', '/server'):
+                endpoint = None
+            else:
+                endpoint, args = self.url_map.bind_to_environ(req.environ).match()
+            # Limit request data in all cases, except log uploads.
+            if endpoint not in self.streaming_endpoints and \
+                req.max_content_length is not None and \
                 req.content_length > req.max_content_length:
                     raise RequestEntityTooLarge()
-            if req.path in ('/', '/RPC2', '/server'):
+            if endpoint is None:
                 if req.method == 'POST':
                     # XML-RPC
                     if req.mimetype != 'text/xml':
@@ -145,7 +155,7 @@ def __call__(self, req):
                 else:
                     return MethodNotAllowed()
             else:
-                (obj, attr), args = self.url_map.bind_to_environ(req.environ).match()
+                obj, attr = endpoint
                 if obj is self.proxy:
                     # pseudo-XML-RPC
                     result = getattr(obj, attr)(**args)
@@ -162,6 +172,24 @@ def read_request(self, raw_requestline):
         self.close_connection = True
         return result
 
+    def get_environ(self):
+        environ = super(WSGIHandler, self).get_environ()
+        environ['wsgi.file_wrapper'] = sendfile.FileWrapper
+        return environ
+
+    def process_result(self):
+        # Cached logs are sent with sendfile(2) rather than read into memory.
+        if (isinstance(self.result, sendfile.FileWrapper)
+                and isinstance(self.result.filelike, sendfile.FileRange)
+                and self.command == 'GET'
+                and sendfile.sendfile_available()):
+            self.write('') # sends the headers
+            if not self.response_use_chunked:
+                self.response_length += sendfile.send_range(self.socket,
+                        self.result.filelike)
+                return
+        super(WSGIHandler, self).process_result()
+
 # decorator to log uncaught exceptions in the WSGI application
 def log_failed_requests(func):
     def _log_failed_requests(environ, start_response):
@@ -192,8 +220,13 @@ def main_loop(proxy=None, conf=None):
     login.daemon = True
     login.start()
 
+    application = WSGIApplication(proxy)
+    journal = application.proxy_http.journal
+    if journal is not None:
+        journal.start()
+
     server = gevent.wsgi.WSGIServer(('::', 8000),
-            log_failed_requests(WSGIApplication(proxy)),
+            log_failed_requests(application),
             handler_class=WSGIHandler, spawn=gevent.pool.Pool())
     server.stop_timeout = None
     server.start()
@@ -202,6 +235,12 @@ def main_loop(proxy=None, conf=None):
         shutting_down.wait()
     finally:
         server.stop()
+        if journal is not None:
+            journal.stop()
+        try:
+            proxy.log_storage.flush_registrations()
+        except Exception:
+            logger.exception('Error registering log files before shutting down')
         login.stop()
 
 def main():
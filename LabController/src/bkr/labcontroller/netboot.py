@@ -10,11 +10,14 @@
 import logging
 import tempfile
 import shutil
+import hashlib
+import json
 from contextlib import contextmanager
 import collections
 from cStringIO import StringIO
 import urllib
 import urllib2
+import gevent.event
 from bkr.labcontroller.config import get_conf
 from bkr.common.helpers import (atomically_replaced_file, makedirs_ignore,
                                 siphon, unlink_ignore, atomic_link, atomic_symlink)
@@ -102,6 +105,143 @@ def copy_default_loader_images():
             '/usr/share/syslinux/menu.c32')
 
 
+# Images which are not fetched by beaker-pxemenu are downloaded into a cache
+# shared by all systems (if IMAGE_CACHE_SIZE is set), named after the hash of
+# their URL, and hard-linked from there into each system's images directory.
+# Each cached image is revalidated before it is used, using its ETag or
+# Last-Modified time, or its size if the server gives neither. When the cache
+# grows beyond IMAGE_CACHE_SIZE bytes, the least recently used images are
+# evicted (systems still using them keep their links).
+
+#: Downloads in progress, by cache path. Anyone else who wants the same image
+#: waits for the result instead of downloading it again.
+_image_downloads = {}
+
+
+def get_image_cache_dir():
+    return os.path.join(get_tftp_root(), 'cache')
+
+
+def _read_image_metadata(path):
+    try:
+        with open(path + '.json') as f:
+            return json.load(f)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    except ValueError:
+        pass
+    return None
+
+
+def _same_image(cached, current):
+    if cached.get('etag') and current.get('etag'):
+        return cached['etag'] == current['etag']
+    if cached.get('last_modified') and current.get('last_modified'):
+        return (cached['last_modified'] == current['last_modified']
+                and cached.get('size') == current.get('size'))
+    if cached.get('size') is not None:
+        return cached['size'] == current.get('size')
+    return False
+
+
+def _refresh_cached_image(url, path, timeout):
+    """
+    Downloads the image at url to path, unless the copy already there is up
+    to date.
+    """
+    cached = None
+    request = urllib2.Request(url)
+    if os.path.exists(path):
+        cached = _read_image_metadata(path)
+    if cached:
+        if cached.get('etag'):
+            request.add_header('If-None-Match', cached['etag'])
+        if cached.get('last_modified'):
+            request.add_header('If-Modified-Since', cached['last_modified'])
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+    except urllib2.HTTPError as e:
+        if cached and e.code == 304:
+            logger.debug('Cached image %s is up to date', url)
+            os.utime(path, None)
+            return
+        raise
+    try:
+        info = response.info()
+        length = info.get('Content-Length')
+        current = dict(url=url, etag=info.get('ETag'),
+                last_modified=info.get('Last-Modified'),
+                size=int(length) if length else None)
+        if cached and _same_image(cached, current):
+            logger.debug('Cached image %s is up to date', url)
+            os.utime(path, None)
+            return
+        logger.debug('Downloading image %s into cache', url)
+        with atomically_replaced_file(path) as dest:
+            siphon(response, dest)
+    finally:
+        response.close()
+    with atomically_replaced_file(path + '.json') as dest:
+        json.dump(current, dest)
+
+
+def evict_cached_images(cache_dir, max_size, keep=None):
+    """
+    Removes the least recently used images from the cache until the rest
+    add up to no more than max_size bytes. The image at keep is never removed.
+    """
+    entries = []
+    total = 0
+    for name in os.listdir(cache_dir):
+        if name.startswith('.') or name.endswith('.json'):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+        total += st.st_size
+    for mtime, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        if path == keep:
+            continue
+        logger.debug('Evicting cached image %s', path)
+        unlink_ignore(path + '.json')
+        unlink_ignore(path)
+        total -= size
+
+
+def cached_image(url, max_size, timeout=None):
+    """
+    Returns the path of an up to date copy of the image at url in the image
+    cache, downloading it if necessary.
+    """
+    cache_dir = get_image_cache_dir()
+    path = os.path.join(cache_dir, hashlib.sha1(url).hexdigest())
+    download = _image_downloads.get(path)
+    if download is not None:
+        logger.debug('Waiting for download of image %s in progress', url)
+        return download.get()
+    download = _image_downloads[path] = gevent.event.AsyncResult()
+    try:
+        makedirs_ignore(cache_dir, 0o755)
+        _refresh_cached_image(url, path, timeout)
+        evict_cached_images(cache_dir, max_size, keep=path)
+    except Exception as e:
+        download.set_exception(e)
+        raise
+    else:
+        download.set(path)
+        return path
+    finally:
+        del _image_downloads[path]
+
+
 def fetch_images(distro_tree_id, kernel_url, initrd_url, fqdn):
     """
     Creates references to kernel and initrd files at:
@@ -130,18 +270,21 @@ def fetch_images(distro_tree_id, kernel_url, initrd_url, fqdn):
         # No luck there, so try something else...
 
     timeout = get_conf().get('IMAGE_FETCH_TIMEOUT')
-    logger.debug('Fetching kernel %s for %s', kernel_url, fqdn)
-    with atomically_replaced_file(os.path.join(images_dir, 'kernel')) as dest:
-        try:
-            siphon(urllib2.urlopen(kernel_url, timeout=timeout), dest)
-        except Exception as e:
-            raise ImageFetchingError(kernel_url, distro_tree_id, e)
-    logger.debug('Fetching initrd %s for %s', initrd_url, fqdn)
-    with atomically_replaced_file(os.path.join(images_dir, 'initrd')) as dest:
-        try:
-            siphon(urllib2.urlopen(initrd_url, timeout=timeout), dest)
-        except Exception as e:
-            raise ImageFetchingError(initrd_url, distro_tree_id, e)
+    cache_size = get_conf().get('IMAGE_CACHE_SIZE', 0)
+    for name, url in [('kernel', kernel_url), ('initrd', initrd_url)]:
+        logger.debug('Fetching %s %s for %s', name, url, fqdn)
+        if cache_size:
+            try:
+                atomic_link(cached_image(url, cache_size, timeout=timeout),
+                        os.path.join(images_dir, name))
+            except Exception as e:
+                raise ImageFetchingError(url, distro_tree_id, e)
+            continue
+        with atomically_replaced_file(os.path.join(images_dir, name)) as dest:
+            try:
+                siphon(urllib2.urlopen(url, timeout=timeout), dest)
+            except Exception as e:
+                raise ImageFetchingError(url, distro_tree_id, e)
 
 
 def have_images(fqdn):
@@ -16,9 +16,10 @@
 import pkg_resources
 import subprocess
 import xmlrpclib
+from contextlib import contextmanager
 from daemon import pidfile
 from optparse import OptionParser
-import gevent, gevent.hub, gevent.socket, gevent.event, gevent.monkey
+import gevent, gevent.hub, gevent.socket, gevent.event, gevent.monkey, gevent.lock
 from bkr.labcontroller.exceptions import ShutdownException
 from bkr.log import log_to_stream, log_to_syslog
 from bkr.common.helpers import SensitiveUnicode, total_seconds
@@ -29,13 +30,72 @@
 
 logger = logging.getLogger(__name__)
 
+class PowerExecutor(object):
+    """
+    Limits how many power scripts run at once, in total (max_concurrent) and
+    for each power type (max_concurrent_by_type, a dict of power type name to
+    limit). Zero means no limit. Commands against the same power address are
+    already run one at a time, see CommandQueuePoller.poll().
+    """
+
+    def __init__(self, max_concurrent=0, max_concurrent_by_type=None):
+        self.slots = None
+        if max_concurrent:
+            self.slots = gevent.lock.BoundedSemaphore(max_concurrent)
+        self.type_slots = {}
+        for power_type, limit in (max_concurrent_by_type or {}).iteritems():
+            if limit:
+                self.type_slots[power_type] = gevent.lock.BoundedSemaphore(limit)
+
+    @contextmanager
+    def slot(self, power_type):
+        """
+        Waits until a script for the given power type can run, and holds its
+        place while it does.
+        """
+        # The power type's slot is taken first, so that commands waiting for
+        # a busy power type do not hold up the others.
+        semaphores = [semaphore for semaphore in
+                [self.type_slots.get(power_type), self.slots]
+                if semaphore is not None]
+        acquired = []
+        try:
+            for semaphore in semaphores:
+                semaphore.acquire()
+                acquired.append(semaphore)
+            yield
+        finally:
+            for semaphore in reversed(acquired):
+                semaphore.release()
+
+
 class CommandQueuePoller(ProxyHelper):
 
+    # Between polls (every SLEEP_TIME seconds), we ask the server whether new
+    # commands have been queued, first after new_commands_check_interval
+    # seconds and then backing off exponentially. Command status changes are
+    # gathered for status_batch_delay seconds and sent to the server together.
+    # Older servers support neither, so we fall back to sleeping and to
+    # marking commands one at a time.
+
+    #: Seconds to wait before first checking for new commands after a poll.
+    new_commands_check_interval = 2
+    #: Seconds to wait for other status changes before sending one.
+    status_batch_delay = 0.5
+    #: Maximum number of status changes sent in one call to the server.
+    max_status_batch = 500
+
     def __init__(self, *args, **kwargs):
         super(CommandQueuePoller, self).__init__(*args, **kwargs)
         self.commands = {} #: dict of (id -> command info) for running commands
         self.greenlets = {} #: dict of (command id -> greenlet which is running it)
         self.last_command_datetime = {} # Last time a command was run against a system.
+        self.check_supported = True #: False if the server cannot check for new commands
+        self.mark_commands_supported = True #: False if the server cannot mark in batches
+        self._pending_marks = [] #: list of (status change, AsyncResult for its outcome)
+        self._marks_flush_scheduled = False
+        self.power_executor = PowerExecutor(self.conf.get('POWER_MAX_CONCURRENT', 0),
+                self.conf.get('POWER_MAX_CONCURRENT_BY_TYPE', {}))
 
     def get_queued_commands(self):
         try:
@@ -67,17 +127,113 @@ def get_running_command_ids(self):
                 raise
         return ids
 
+    def has_new_commands(self):
+        known_command_ids = list(self.commands)
+        try:
+            return self.hub.labcontrollers.has_new_queued_commands(known_command_ids)
+        except xmlrpclib.Fault as fault:
+            if 'Anonymous access denied' in fault.faultString:
+                logger.debug('Session expired, re-authenticating')
+                self.hub._login()
+                return self.hub.labcontrollers.has_new_queued_commands(known_command_ids)
+            raise
+
+    def wait_for_commands(self, timeout):
+        """
+        Waits up to timeout seconds for new commands to be queued. Returns True
+        if there are new commands to poll for.
+        """
+        deadline = time.time() + timeout
+        interval = self.new_commands_check_interval
+        while self.check_supported:
+            remaining = deadline - time.time()
+            if remaining <= interval:
+                break
+            gevent.sleep(interval)
+            interval *= 2
+            try:
+                if self.has_new_commands():
+                    return True
+            except xmlrpclib.Fault as fault:
+                if 'not implemented by this server' not in fault.faultString:
+                    raise
+                logger.info('Server cannot check for new queued commands, '
+                        'polling every %s seconds instead', timeout)
+                self.check_supported = False
+        gevent.sleep(max(0, deadline - time.time()))
+        return False
+
+    def _mark_command(self, change):
+        if not self.mark_commands_supported:
+            return self._mark_command_now(change)
+        outcome = gevent.event.AsyncResult()
+        self._pending_marks.append((change, outcome))
+        if len(self._pending_marks) >= self.max_status_batch:
+            gevent.spawn(self._flush_marks)
+        elif not self._marks_flush_scheduled:
+            self._marks_flush_scheduled = True
+            gevent.spawn_later(self.status_batch_delay, self._flush_marks)
+        # Raises the server's error, if it could not be changed.
+        return outcome.get()
+
+    def _mark_command_now(self, change):
+        if change['status'] == u'running':
+            self.hub.labcontrollers.mark_command_running(change['id'])
+        elif change['status'] == u'completed':
+            self.hub.labcontrollers.mark_command_completed(change['id'])
+        elif change['status'] == u'failed':
+            self.hub.labcontrollers.mark_command_failed(change['id'],
+                    change['message'], change['system_broken'])
+        elif change['status'] == u'aborted':
+            self.hub.labcontrollers.mark_command_aborted(change['id'],
+                    change['message'])
+
+    def _flush_marks(self):
+        self._marks_flush_scheduled = False
+        pending, self._pending_marks = self._pending_marks, []
+        for start in range(0, len(pending), self.max_status_batch):
+            batch = pending[start:start + self.max_status_batch]
+            if self.mark_commands_supported:
+                try:
+                    errors = self.hub.labcontrollers.mark_commands(
+                            [change for change, outcome in batch])
+                except xmlrpclib.Fault as fault:
+                    if 'not implemented by this server' not in fault.faultString:
+                        for change, outcome in batch:
+                            outcome.set_exception(fault)
+                        continue
+                    logger.info('Server cannot mark commands in batches, '
+                            'marking them one at a time')
+                    self.mark_commands_supported = False
+                except Exception as e:
+                    for change, outcome in batch:
+                        outcome.set_exception(e)
+                    continue
+                else:
+                    for (change, outcome), error in zip(batch, errors):
+                        if error:
+                            outcome.set_exception(xmlrpclib.Fault(1, error))
+                        else:
+                            outcome.set(True)
+                    continue
+            for change, outcome in batch:
+                try:
+                    outcome.set(self._mark_command_now(change))
+                except Exception as e:
+                    outcome.set_exception(e)
+
     def mark_command_running(self, id):
-        self.hub.labcontrollers.mark_command_running(id)
+        self._mark_command(dict(id=id, status=u'running'))
 
-    def mark_command_completed(self, id):
-        self.hub.labcontrollers.mark_command_completed(id)
+    def mark_command_completed(self, id, power_stats=None):
+        self._mark_command(dict(id=id, status=u'completed', **(power_stats or {})))
 
-    def mark_command_failed(self, id, message, system_broken):
-        self.hub.labcontrollers.mark_command_failed(id, message, system_broken)
+    def mark_command_failed(self, id, message, system_broken, power_stats=None):
+        self._mark_command(dict(id=id, status=u'failed', message=message,
+                system_broken=system_broken, **(power_stats or {})))
 
     def mark_command_aborted(self, id, message):
-        self.hub.labcontrollers.mark_command_aborted(id, message)
+        self._mark_command(dict(id=id, status=u'aborted', message=message))
 
     def clear_running_commands(self, message):
         self.hub.labcontrollers.clear_running_commands(message)
@@ -85,8 +241,9 @@ def clear_running_commands(self, message):
     def clear_orphaned_commands(self):
         running_command_ids = self.get_running_command_ids()
         orphaned_command_ids = set(running_command_ids).difference(self.commands.keys())
-        for id in orphaned_command_ids:
-            self.mark_command_aborted(id, "Command orphaned, aborting")
+        greenlets = [gevent.spawn(self.mark_command_aborted, id,
+                "Command orphaned, aborting") for id in orphaned_command_ids]
+        gevent.joinall(greenlets, raise_error=True)
 
     def poll(self):
         logger.debug('Clearing orphaned commands')
@@ -154,15 +311,19 @@ def handle(self, command, predecessors):
                     return
         logger.debug('Handling command %r', command)
         self.mark_command_running(command['id'])
+        # Timings of power scripts, sent to the server with the outcome.
+        power_stats = {}
         try:
             if command['action'] in (u'on', u'off', 'interrupt'):
-                handle_power(self.conf, command)
+                handle_power(self.conf, command, self.power_executor, power_stats)
             elif command['action'] == u'reboot':
                 # For backwards compatibility only. The server now splits 
                 # reboots into 'off' followed by 'on'.
-                handle_power(self.conf, dict(command.items() + [('action', u'off')]))
+                handle_power(self.conf, dict(command.items() + [('action', u'off')]),
+                        self.power_executor, power_stats)
                 time.sleep(5)
-                handle_power(self.conf, dict(command.items() + [('action', u'on')]))
+                handle_power(self.conf, dict(command.items() + [('action', u'on')]),
+                        self.power_executor, power_stats)
             elif command['action'] == u'clear_logs':
                 handle_clear_logs(self.conf, command)
             elif command['action'] == u'configure_netboot':
@@ -179,9 +340,9 @@ def handle(self, command, predecessors):
         except Exception, e:
             logger.exception('Error processing command %s', command['id'])
             self.mark_command_failed(command['id'],
-                    '%s: %s' % (e.__class__.__name__, e), True)
+                    '%s: %s' % (e.__class__.__name__, e), True, power_stats)
         else:
-            self.mark_command_completed(command['id'])
+            self.mark_command_completed(command['id'], power_stats)
         finally:
             if quiescent_period:
                 self.last_command_datetime[command['fqdn']] = datetime.datetime.utcnow()
@@ -233,8 +394,20 @@ def handle_configure_netboot(command):
 def handle_clear_netboot(command):
     netboot.clear_all(command['fqdn'])
 
-def handle_power(conf, command):
+def handle_power(conf, command, executor=None, stats=None):
+    """
+    Runs the power script for the command, retrying if it fails. If stats
+    (a dict) is given, the time spent waiting for the executor to run the
+    script (power_queue_wait), the time spent running it (power_runtime),
+    and the number of attempts (power_attempts) are added to it.
+    """
     from bkr.labcontroller.async import MonitoredSubprocess
+    if executor is None:
+        executor = PowerExecutor()
+    if stats is None:
+        stats = {}
+    for key in ['power_queue_wait', 'power_runtime', 'power_attempts']:
+        stats.setdefault(key, 0)
     script = find_power_script(command['power']['type'])
     env = build_power_env(command)
     # We try the command up to 5 times, because some power commands
@@ -250,16 +423,22 @@ def handle_power(conf, command):
                     delay, command['id'])
             if shutting_down.wait(timeout=delay):
                 break
-        logger.debug('Launching power script %s (attempt %s) with env %r',
-                script, attempt, env)
-        # N.B. the timeout value used here affects daemon shutdown time,
-        # make sure the init script is kept up to date!
-        p = MonitoredSubprocess([script], env=env,
-                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                timeout=300)
-        logger.debug('Waiting on power script pid %s', p.pid)
-        p.dead.wait()
-        output = p.stdout_reader.get()
+        queued_at = time.time()
+        with executor.slot(command['power']['type']):
+            started_at = time.time()
+            logger.debug('Launching power script %s (attempt %s) with env %r',
+                    script, attempt, env)
+            # N.B. the timeout value used here affects daemon shutdown time,
+            # make sure the init script is kept up to date!
+            p = MonitoredSubprocess([script], env=env,
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                    timeout=300)
+            logger.debug('Waiting on power script pid %s', p.pid)
+            p.dead.wait()
+            output = p.stdout_reader.get()
+        stats['power_queue_wait'] += started_at - queued_at
+        stats['power_runtime'] += time.time() - started_at
+        stats['power_attempts'] += 1
         if p.returncode == 0 or shutting_down.is_set():
             break
     if p.returncode != 0:
@@ -269,6 +448,9 @@ def handle_power(conf, command):
                     command['power']['passwd'], '********')
         raise ValueError('Power script %s failed after %s attempts with exit status %s:\n%s'
                 % (script, attempt, p.returncode, sanitised_output))
+    logger.debug('Power command %s waited %0.3f seconds to run, and ran for '
+            '%0.3f seconds in %s attempts', command['id'], stats['power_queue_wait'],
+            stats['power_runtime'], stats['power_attempts'])
     # TODO submit complete stdout and stderr?
 
 def shutdown_handler(signum, frame):
@@ -296,7 +478,13 @@ def main_loop(poller=None, conf=None):
             poller.poll()
         except:
             logger.exception('Failed to poll for queued commands')
-        if shutting_down.wait(timeout=conf.get('SLEEP_TIME', 20)):
+        waiter = gevent.spawn(poller.wait_for_commands, conf.get('SLEEP_TIME', 20))
+        gevent.wait([shutting_down, waiter], count=1)
+        if not shutting_down.is_set() and not waiter.successful():
+            logger.error('Failed to wait for queued commands: %r', waiter.exception)
+            shutting_down.wait(timeout=conf.get('SLEEP_TIME', 20))
+        if shutting_down.is_set():
+            waiter.kill()
             gevent.hub.get_hub().join() # let running greenlets terminate
             break
     logger.debug('Exited main provision loop')
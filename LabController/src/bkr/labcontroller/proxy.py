@@ -13,22 +13,34 @@
 import lxml.etree
 import re
 import json
+import string
 import shutil
 import tempfile
 import xmlrpclib
 import subprocess
 import pkg_resources
 import shlex
+import zlib
+import sre_parse
+import sre_constants
+import gevent.event
+import gevent.lock
+from datetime import datetime
 from xml.sax.saxutils import escape as xml_escape, quoteattr as xml_quoteattr
 from werkzeug.wrappers import Response
 from werkzeug.exceptions import BadRequest, NotAcceptable, NotFound, \
-        LengthRequired, UnsupportedMediaType, Conflict
+        LengthRequired, UnsupportedMediaType, Conflict, RequestEntityTooLarge, \
+        ServiceUnavailable
 from werkzeug.utils import redirect
-from werkzeug.http import parse_content_range_header
+from werkzeug.http import parse_content_range_header, is_resource_modified, \
+        quote_etag, http_date
 from werkzeug.wsgi import wrap_file
 from bkr.common.hub import HubProxy
 from bkr.labcontroller.config import get_conf
-from bkr.labcontroller.log_storage import LogStorage
+from bkr.labcontroller.journal import HarnessJournal, is_rejection
+from bkr.labcontroller.log_storage import LogStorage, is_compressible, \
+        stored_path, decompress_log, COMPRESSED_SUFFIX
+from bkr.labcontroller.sendfile import FileRange
 import utils
 try:
     #pylint: disable=E0611
@@ -41,9 +53,17 @@
 def replace_with_blanks(match):
     return ' ' * (match.end() - match.start() - 1) + '\n'
 
+# Replaces ASCII control characters, except tab and newline, with spaces.
+_strip_control_chars_table = string.maketrans(
+        ''.join(chr(c) for c in range(0, 32) + [127] if chr(c) not in '\t\n'),
+        ' ' * 31)
+
 
 class ProxyHelper(object):
 
+    #: Whether new log files are registered with the server in batches,
+    #: see LogStorage.
+    batch_log_registration = False
 
     def __init__(self, conf=None, hub=None, **kwargs):
         self.conf = get_conf()
@@ -67,9 +87,16 @@ def __init__(self, conf=None, hub=None, **kwargs):
         self.log_storage = LogStorage(self.conf.get("CACHEPATH"),
                 "%s://%s/beaker/logs" % (self.conf.get('URL_SCHEME',
                 'http'), self.conf.get_url_domain()),
-                self.hub)
+                self.hub,
+                registration_delay=self.conf.get('LOG_REGISTRATION_DELAY', 0)
+                    if self.batch_log_registration else 0)
 
     def close(self):
+        transport = getattr(self.hub, '_transport', None)
+        if getattr(transport, 'pool_size', 0):
+            logger.info('Connections to the server: %(opened)s opened, '
+                    '%(reused)s reused, %(expired)s expired, %(discarded)s discarded',
+                    transport.connection_stats)
         if sys.version_info >= (2, 7):
             self.hub._hub('close')()
 
@@ -128,6 +155,7 @@ def recipe_stop(self,
             msg to record
         """
         logger.debug("recipe_stop %s", recipe_id)
+        self.log_storage.flush_registrations(finishing=('recipe', recipe_id))
         return self.hub.recipes.stop(recipe_id, stop_type, msg)
 
     def recipeset_stop(self,
@@ -193,12 +221,13 @@ def __init__(self, watchdog, proxy, panic, logfile_name=None):
         self.proxy = proxy
         self.logfile_name = logfile_name if logfile_name is not None else "console.log"
         self.strip_ansi = re.compile("(\033\[[0-9;\?]*[ABCDHfsnuJKmhr])")
-        ascii_control_chars = map(chr, range(0, 32) + [127])
-        keep_chars = '\t\n'
-        strip_control_chars = [c for c in ascii_control_chars if c not in keep_chars]
-        self.strip_cntrl = re.compile('[%s]' % re.escape(''.join(strip_control_chars)))
+        self.strip_cntrl = _strip_control_chars_table
         self.panic_detector = PanicDetector(panic)
         self.install_failure_detector = InstallFailureDetector()
+        # Finds the lines worth feeding to the detectors, so that they do not
+        # have to search every line for every pattern.
+        self.detector_matcher = MultiPatternMatcher(
+                [self.panic_detector.pattern] + self.install_failure_detector.patterns)
         self.where = 0
         self.incomplete_line = ''
 
@@ -210,7 +239,7 @@ def process_log(self, block):
         if self.strip_ansi:
             block = self.strip_ansi.sub(replace_with_blanks, block)
         if self.strip_cntrl:
-            block = self.strip_cntrl.sub(' ', block)
+            block = block.translate(self.strip_cntrl)
         # Check for panics
         # Only feed the panic detector complete lines. If we have read a part
         # of a line, store it in self.incomplete_line and it will be prepended
@@ -222,8 +251,9 @@ def process_log(self, block):
         if len(self.incomplete_line) > self.blocksize * 2:
             lines.append(self.incomplete_line)
             self.incomplete_line = ''
-        if self.panic_detector:
-            for line in lines:
+        if self.panic_detector and not (self.panic_detector.fired
+                and self.install_failure_detector.fired):
+            for line in self.detector_matcher.candidate_lines('\n'.join(lines)):
                 panic_found = self.panic_detector.feed(line)
                 if panic_found:
                     self.proxy.report_panic(self.watchdog, panic_found)
@@ -243,26 +273,53 @@ def process_log(self, block):
             else:
                 raise
 
+    def close(self):
+        pass
+
 
 class ConsoleWatchLogFiles(object):
-    """ Monitor a directory for log files and upload them """
-    def __init__(self, logdir, system_name, watchdog, proxy, panic):
+    """ Monitor a directory for log files and upload them
+
+    If a ConsoleLogWatcher is given and active, only the files it reports as
+    changed are read (and the directory is only listed again when new files
+    appear), and wakeup() is called whenever there is something to read.
+    Otherwise every file is checked on every update.
+    """
+    def __init__(self, logdir, system_name, watchdog, proxy, panic,
+                 watcher=None, wakeup=None):
         self.logdir = os.path.abspath(logdir)
         self.system_name = system_name
         self.watchdog = watchdog
         self.proxy = proxy
         self.panic = panic
-
+        self.watcher = watcher
+        self.wakeup = wakeup
+        self.subscribed_generation = None
+        self.rescan_needed = True
+        self.changed_files = set()
         self.logfiles = {}
-        for filename, logfile_name in utils.get_console_files(
-                console_logs_directory=self.logdir, system_name=self.system_name):
-            logger.info('Watching console log file %s for recipe %s',
-                        filename, self.watchdog['recipe_id'])
-            self.logfiles[filename] = ConsoleWatchFile(
-                log=filename, watchdog=self.watchdog, proxy=self.proxy,
-                panic=self.panic, logfile_name=logfile_name)
+        self._subscribe()
+        self._scan()
 
-    def update(self):
+    def _subscribe(self):
+        if self.watcher is None or not self.watcher.active:
+            return False
+        if self.subscribed_generation != self.watcher.generation:
+            # Subscribe before scanning, so nothing written in between is missed.
+            self.watcher.subscribe(self.system_name, self._console_changed)
+            self.subscribed_generation = self.watcher.generation
+            self.rescan_needed = True
+        return True
+
+    def _console_changed(self, filename):
+        if filename is None or filename not in self.logfiles:
+            self.rescan_needed = True
+        else:
+            self.changed_files.add(filename)
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def _scan(self):
         # Check for any new log files
         for filename, logfile_name in utils.get_console_files(
                 console_logs_directory=self.logdir, system_name=self.system_name):
@@ -272,13 +329,33 @@ def update(self):
                 self.logfiles[filename] = ConsoleWatchFile(
                     log=filename, watchdog=self.watchdog, proxy=self.proxy,
                     panic=self.panic, logfile_name=logfile_name)
+        self.rescan_needed = False
+
+    def update(self):
+        if not self._subscribe():
+            self._scan()
+            console_logs = self.logfiles.values()
+        elif self.rescan_needed:
+            self._scan()
+            self.changed_files.clear()
+            console_logs = self.logfiles.values()
+        else:
+            console_logs = [self.logfiles[filename]
+                            for filename in self.changed_files]
+            self.changed_files.clear()
 
-        # Update all of our log files. If any had updated data return True
+        # Update our log files. If any had updated data return True
         updated = False
-        for console_log in self.logfiles.values():
+        for console_log in console_logs:
             updated |= console_log.update()
         return updated
 
+    def close(self):
+        if self.subscribed_generation is not None and self.watcher.active \
+                and self.subscribed_generation == self.watcher.generation:
+            self.watcher.unsubscribe(self.system_name, self._console_changed)
+        self.subscribed_generation = None
+
 
 class ConsoleWatchFile(ConsoleLogHelper):
 
@@ -289,7 +366,8 @@ def __init__(self, log, watchdog, proxy, panic, logfile_name=None):
 
     def update(self):
         """
-        If the log exists and the file has grown then upload the new piece
+        If the log exists and the file has grown then upload everything which
+        has been written since the last update
         """
         try:
             file = open(self.log, "r")
@@ -298,17 +376,19 @@ def update(self):
                 return False # doesn't exist
             else:
                 raise
+        updated = False
         try:
             file.seek(self.where)
-            block = file.read(self.blocksize)
-            now = file.tell()
+            while True:
+                block = file.read(self.blocksize)
+                if not block:
+                    break
+                self.process_log(block)
+                self.where = file.tell()
+                updated = True
         finally:
             file.close()
-        if not block:
-            return False # nothing new has been read
-        self.process_log(block)
-        self.where = now
-        return True
+        return updated
 
     def truncate(self):
         try:
@@ -352,6 +432,106 @@ def update(self):
         return True
 
 
+def _required_literals(parsed):
+    """
+    Returns a list of strings, at least one of which appears in any match of
+    the parsed regular expression, or None if no such strings were found.
+    Runs of literal characters in the top-level sequence (or in groups and
+    repeats which must match at least once) are considered, and a branch
+    contributes one string for each alternative. The list whose shortest
+    string is longest wins.
+    """
+    best = None
+    run = []
+    candidates = []
+    for op, av in parsed:
+        if op is sre_constants.LITERAL:
+            run.append(chr(av))
+            continue
+        if run:
+            candidates.append([''.join(run)])
+            run = []
+        if op is sre_constants.SUBPATTERN:
+            candidates.append(_required_literals(av[-1]))
+        elif op is sre_constants.BRANCH:
+            alternatives = [_required_literals(branch) for branch in av[1]]
+            if None not in alternatives:
+                candidates.append(sum(alternatives, []))
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] >= 1:
+            candidates.append(_required_literals(av[2]))
+    if run:
+        candidates.append([''.join(run)])
+    for literals in candidates:
+        if literals and (best is None or
+                min(map(len, literals)) > min(map(len, best))):
+            best = literals
+    return best
+
+class MultiPatternMatcher(object):
+    """
+    Finds the lines of a block of text which match any of a list of regular
+    expressions. Python's re module backtracks, so even a single alternation
+    of all the patterns is tried at every position in the text. Instead each
+    pattern is reduced to literal strings, one of which must appear in any
+    match, and the block is scanned for those with str.find() so that the
+    regular expressions only run on the few lines containing one. If a
+    pattern has no usable literal, every line is a candidate.
+    """
+
+    min_literal_length = 3
+
+    def __init__(self, patterns):
+        self.patterns = [re.compile(pattern) for pattern in patterns]
+        self._literals = [] # list of (literal, ignorecase)
+        self._scan_every_line = False
+        for pattern in self.patterns:
+            ignorecase = bool(pattern.flags & re.IGNORECASE)
+            literals = _required_literals(sre_parse.parse(pattern.pattern, pattern.flags))
+            if (not literals or min(map(len, literals)) < self.min_literal_length
+                    or (ignorecase and pattern.flags & (re.LOCALE | re.UNICODE))):
+                self._scan_every_line = True
+                continue
+            for literal in literals:
+                if ignorecase:
+                    literal = literal.lower()
+                self._literals.append((literal, ignorecase))
+
+    def search(self, line):
+        """
+        Returns (index, matched text) for the first pattern which matches the
+        line, or None.
+        """
+        for index, pattern in enumerate(self.patterns):
+            match = pattern.search(line)
+            if match:
+                return index, match.group()
+        return None
+
+    def candidate_lines(self, text):
+        """
+        Returns the lines of the newline-separated text in which search()
+        might find a match, in order.
+        """
+        if self._scan_every_line:
+            return text.split('\n')
+        spans = set()
+        lowered = None
+        for literal, ignorecase in self._literals:
+            if ignorecase:
+                if lowered is None:
+                    lowered = text.lower()
+                haystack = lowered
+            else:
+                haystack = text
+            pos = haystack.find(literal)
+            while pos >= 0:
+                line_end = text.find('\n', pos)
+                if line_end < 0:
+                    line_end = len(text)
+                spans.add((text.rfind('\n', 0, pos) + 1, line_end))
+                pos = haystack.find(literal, line_end + 1)
+        return [text[start:end] for start, end in sorted(spans)]
+
 class PanicDetector(object):
 
     def __init__(self, pattern):
@@ -423,50 +603,167 @@ def feed(self, line):
 
 class LogArchiver(ProxyHelper):
 
-    def transfer_logs(self):
-        transfered = False
-        server = self.conf.get_url_domain()
-        logger.debug('Polling for recipes to be transferred')
+    # If TRANSFER_BATCH_SIZE is set, up to that many recipes are transferred
+    # together: their logs are staged in one tree and copied with one rsync
+    # per group of recipes (TRANSFER_RSYNC_PROCESSES groups, run in parallel)
+    # using --files-from. A recipe whose logs cannot be staged, or whose
+    # group fails to copy, is left for the next poll without affecting
+    # the rest of the batch.
+
+    # If LOG_COMPRESS_AGE is set, every LOG_COMPRESS_INTERVAL seconds the logs
+    # of finished recipes which are still in the cache (as listed by
+    # recipes.by_log_server) are compressed in place, once none of them has
+    # been written to for LOG_COMPRESS_AGE seconds. beaker-proxy serves them
+    # transparently, and restores them if they are written to again.
+
+    #: Number of finished recipes listed per call when compressing logs.
+    compress_batch_size = 500
+
+    def __init__(self, *args, **kwargs):
+        super(LogArchiver, self).__init__(*args, **kwargs)
+        #: False if the server does not support recipes.change_files_batch
+        self.change_files_batch_supported = True
+        self.next_compression = 0
+        #: IDs of finished recipes whose logs have all been compressed
+        self.compressed_recipes = set()
+
+    def _by_log_server(self, *args):
         try:
-            recipe_ids = self.hub.recipes.by_log_server(server)
+            return self.hub.recipes.by_log_server(*args)
         except xmlrpclib.Fault as fault:
             if 'Anonymous access denied' in fault.faultString:
                 logger.debug('Session expired, re-authenticating')
                 self.hub._login()
-                recipe_ids = self.hub.recipes.by_log_server(server)
-            else:
-                raise
+                return self.hub.recipes.by_log_server(*args)
+            raise
+
+    def compress_logs(self):
+        min_age = self.conf.get('LOG_COMPRESS_AGE', 0)
+        if not min_age or time.time() < self.next_compression:
+            return
+        self.next_compression = time.time() + self.conf.get('LOG_COMPRESS_INTERVAL', 3600)
+        logger.debug('Compressing logs of finished recipes idle for %s seconds',
+                min_age)
+        server = self.conf.get_url_domain()
+        count = saved = 0
+        after = 0
+        seen = set()
+        while True:
+            try:
+                recipe_ids = self._by_log_server(server,
+                        self.compress_batch_size, after)
+            except xmlrpclib.Fault as fault:
+                if 'by_log_server() takes' not in fault.faultString:
+                    raise
+                logger.warning('Server cannot list every finished recipe, '
+                        'not compressing logs')
+                return
+            seen.update(recipe_ids)
+            for recipe_id in recipe_ids:
+                if recipe_id in self.compressed_recipes:
+                    continue
+                result = self.compress_recipe_logs(recipe_id, min_age)
+                if result is not None:
+                    count += result[0]
+                    saved += result[1]
+                    self.compressed_recipes.add(recipe_id)
+            if len(recipe_ids) < self.compress_batch_size:
+                break
+            after = recipe_ids[-1]
+        # Forget recipes whose logs have since been transferred.
+        self.compressed_recipes.intersection_update(seen)
+        if count:
+            logger.info('Compressed %s logs, saving %s bytes', count, saved)
+
+    def compress_recipe_logs(self, recipe_id, min_age):
+        """
+        Compresses the cached logs for the finished recipe, unless any of them
+        has been written to in the last min_age seconds. Returns a tuple of
+        the number of logs compressed and the number of bytes saved, or None
+        if they were left alone.
+        """
+        paths = []
+        for mylog in self.hub.recipes.files(recipe_id):
+            path = '%s/%s/%s' % (mylog['basepath'], mylog['path'], mylog['filename'])
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue # already compressed, or missing
+            if time.time() - mtime < min_age:
+                return None
+            paths.append(path)
+        return self.log_storage.compress_logs(paths, min_age)
+
+    def transfer_logs(self):
+        transfered = False
+        server = self.conf.get_url_domain()
+        batch_size = self.conf.get('TRANSFER_BATCH_SIZE', 0)
+        args = (server, batch_size) if batch_size else (server,)
+        logger.debug('Polling for recipes to be transferred')
+        recipe_ids = self._by_log_server(*args)
+        if batch_size:
+            if recipe_ids:
+                self.transfer_batch_logs(recipe_ids)
+            return bool(recipe_ids)
         for recipe_id in recipe_ids:
             transfered = True
             self.transfer_recipe_logs(recipe_id)
         return transfered
 
+    def _stage_recipe_logs(self, recipe_id, tmpdir):
+        """
+        Hard-links the cached logs for the recipe into tmpdir, in the layout
+        they will have on the archive server. Logs which were compressed in
+        the cache are decompressed into tmpdir instead, since the server
+        records them under their original name. Returns the logs which were
+        staged, or None if any of them could not be.
+        """
+        logger.debug('Fetching files list for recipe %s', recipe_id)
+        mylogs = self.hub.recipes.files(recipe_id)
+        trlogs = []
+        logger.debug('Building temporary log tree for transfer under %s', tmpdir)
+        for mylog in mylogs:
+            mysrc = '%s/%s/%s' % (mylog['basepath'], mylog['path'], mylog['filename'])
+            mystored = stored_path(mysrc)
+            if mystored is not None:
+                mydst = '%s/%s/%s/%s' % (tmpdir, mylog['filepath'],
+                                          mylog['path'], mylog['filename'])
+                if not os.path.exists(os.path.dirname(mydst)):
+                    os.makedirs(os.path.dirname(mydst))
+                try:
+                    if mystored == mysrc:
+                        os.link(mystored, mydst)
+                    else:
+                        decompress_log(mystored, mydst)
+                    trlogs.append(mylog)
+                except (IOError, OSError):
+                    logger.exception('Error staging %s as %s', mystored, mydst)
+                    return None
+            else:
+                logger.warn('Recipe %s file %s missing on disk, ignoring',
+                        recipe_id, mysrc)
+        return trlogs
+
+    def _remove_cached_logs(self, trlogs):
+        for mylog in trlogs:
+            mysrc = '%s/%s/%s' % (mylog['basepath'], mylog['path'], mylog['filename'])
+            self.rm(mysrc)
+            self.rm(mysrc + COMPRESSED_SUFFIX)
+            try:
+                self.removedirs('%s/%s' % (mylog['basepath'], mylog['path']))
+            except OSError:
+                # It's ok if it fails, dir may not be empty yet
+                pass
+
     def transfer_recipe_logs(self, recipe_id):
         """ If Cache is turned on then move the recipes logs to their final place
         """
         tmpdir = tempfile.mkdtemp(dir=self.conf.get("CACHEPATH"))
         try:
             # Move logs to tmp directory layout
-            logger.debug('Fetching files list for recipe %s', recipe_id)
-            mylogs = self.hub.recipes.files(recipe_id)
-            trlogs = []
-            logger.debug('Building temporary log tree for transfer under %s', tmpdir)
-            for mylog in mylogs:
-                mysrc = '%s/%s/%s' % (mylog['basepath'], mylog['path'], mylog['filename'])
-                mydst = '%s/%s/%s/%s' % (tmpdir, mylog['filepath'],
-                                          mylog['path'], mylog['filename'])
-                if os.path.exists(mysrc):
-                    if not os.path.exists(os.path.dirname(mydst)):
-                        os.makedirs(os.path.dirname(mydst))
-                    try:
-                        os.link(mysrc,mydst)
-                        trlogs.append(mylog)
-                    except OSError, e:
-                        logger.exception('Error hard-linking %s to %s', mysrc, mydst)
-                        return
-                else:
-                    logger.warn('Recipe %s file %s missing on disk, ignoring',
-                            recipe_id, mysrc)
+            trlogs = self._stage_recipe_logs(recipe_id, tmpdir)
+            if trlogs is None:
+                return
             # rsync the logs to their new home
             rsync_succeeded  = self.rsync('%s/' % tmpdir, '%s' % self.conf.get("ARCHIVE_RSYNC"))
             if not rsync_succeeded:
@@ -475,18 +772,93 @@ def transfer_recipe_logs(self, recipe_id):
             logger.debug('Updating recipe %s file locations on the server', recipe_id)
             self.hub.recipes.change_files(recipe_id, self.conf.get("ARCHIVE_SERVER"),
                                                      self.conf.get("ARCHIVE_BASEPATH"))
-            for mylog in trlogs:
-                mysrc = '%s/%s/%s' % (mylog['basepath'], mylog['path'], mylog['filename'])
-                self.rm(mysrc)
+            self._remove_cached_logs(trlogs)
+        finally:
+            # get rid of our tmpdir.
+            shutil.rmtree(tmpdir)
+
+    def transfer_batch_logs(self, recipe_ids):
+        """
+        Moves the logs for a batch of recipes to the archive server, as if
+        transfer_recipe_logs() had been called for each one.
+        """
+        tmpdir = tempfile.mkdtemp(dir=self.conf.get("CACHEPATH"))
+        try:
+            staged = {} # recipe id -> logs linked into tmpdir
+            for recipe_id in recipe_ids:
                 try:
-                    self.removedirs('%s/%s' % (mylog['basepath'], mylog['path']))
-                except OSError:
-                    # It's ok if it fails, dir may not be empty yet
-                    pass
+                    trlogs = self._stage_recipe_logs(recipe_id, tmpdir)
+                except Exception:
+                    logger.exception('Error staging logs for recipe %s', recipe_id)
+                    continue
+                if trlogs is not None:
+                    staged[recipe_id] = trlogs
+            if not staged:
+                return
+            # Split the recipes into groups, each copied by its own rsync.
+            processes = max(1, self.conf.get('TRANSFER_RSYNC_PROCESSES', 1))
+            ordered = sorted(staged)
+            groups = [ordered[i::processes] for i in range(processes)]
+            groups = [group for group in groups if group]
+            files_lists = []
+            for group in groups:
+                fd, files_from = tempfile.mkstemp(dir=tmpdir, prefix='.files-from-')
+                with os.fdopen(fd, 'w') as f:
+                    for recipe_id in group:
+                        for mylog in staged[recipe_id]:
+                            f.write('%s\n' % os.path.normpath('%s/%s/%s' % (
+                                    mylog['filepath'], mylog['path'],
+                                    mylog['filename'])))
+                files_lists.append(files_from)
+            logger.debug('Transferring logs for %s recipes with %s rsync processes',
+                    len(ordered), len(groups))
+            succeeded = self.rsync_many('%s/' % tmpdir,
+                    '%s' % self.conf.get("ARCHIVE_RSYNC"), files_lists)
+            transferred = [recipe_id
+                    for group, ok in zip(groups, succeeded) if ok
+                    for recipe_id in group]
+            if not transferred:
+                return
+            # if the logs have been transferred then tell the server the new location
+            logger.debug('Updating file locations on the server for recipes %r',
+                    transferred)
+            for recipe_id, error in zip(transferred, self.change_files_batch(transferred)):
+                if error:
+                    logger.error('Failed to update file locations for recipe %s: %s',
+                            recipe_id, error)
+                    continue
+                self._remove_cached_logs(staged[recipe_id])
         finally:
             # get rid of our tmpdir.
             shutil.rmtree(tmpdir)
 
+    def change_files_batch(self, recipe_ids):
+        """
+        Tells the server the new location of the logs for each recipe.
+        Returns a list of error messages (empty if successful), one for each
+        recipe.
+        """
+        server = self.conf.get("ARCHIVE_SERVER")
+        basepath = self.conf.get("ARCHIVE_BASEPATH")
+        if self.change_files_batch_supported:
+            try:
+                return self.hub.recipes.change_files_batch(recipe_ids, server, basepath)
+            except xmlrpclib.Fault as fault:
+                if 'not implemented by this server' not in fault.faultString:
+                    raise
+                logger.info('Server does not support changing files in batches, '
+                        'changing them one recipe at a time instead')
+                self.change_files_batch_supported = False
+        errors = []
+        for recipe_id in recipe_ids:
+            try:
+                self.hub.recipes.change_files(recipe_id, server, basepath)
+            except xmlrpclib.Fault as fault:
+                errors.append(fault.faultString)
+            else:
+                errors.append('')
+        return errors
+
     def rm(self, src):
         """ remove src
         """
@@ -514,6 +886,30 @@ def rsync(self, src, dst):
             return False
         return True
 
+    def rsync_many(self, src, dst, files_lists):
+        """ Run a system rsync command for each list of files (relative to src)
+        at the same time. Returns a list of whether each one succeeded.
+        """
+        processes = []
+        for files_from in files_lists:
+            args = ['rsync'] + shlex.split(self.conf.get('RSYNC_FLAGS', '')) + \
+                    ['--files-from=%s' % files_from, src, dst]
+            logger.debug('Invoking rsync as %r', args)
+            # stderr goes to a file, so that no process blocks on a full pipe
+            # while we wait for another
+            err = tempfile.TemporaryFile()
+            processes.append((subprocess.Popen(args, stderr=err), err))
+        results = []
+        for p, err in processes:
+            p.wait()
+            err.seek(0)
+            if p.returncode != 0:
+                logger.error('Failed to rsync recipe logs from %s to %s\nExit status: %s\n%s',
+                        src, dst, p.returncode, err.read())
+            err.close()
+            results.append(p.returncode == 0)
+        return results
+
     def sleep(self):
         # Sleep between polling
         time.sleep(self.conf.get("SLEEP_TIME", 20))
@@ -523,13 +919,15 @@ class Monitor(ProxyHelper):
          and look for panic/bug/etc..
     """
 
-    def __init__(self, watchdog, obj, *args, **kwargs):
+    def __init__(self, watchdog, obj, console_watcher=None, *args, **kwargs):
         """ Monitor system
         """
         self.watchdog = watchdog
         self.conf = obj.conf
         self.hub = obj.hub
         self.log_storage = obj.log_storage
+        # Set when there is console output waiting to be read.
+        self.console_changed = gevent.event.Event()
         if(self.watchdog['is_virt_recipe']):
             logger.info('Watching OpenStack console for recipe %s', self.watchdog['recipe_id'])
             self.console_watch = ConsoleWatchVirt(
@@ -538,13 +936,18 @@ def __init__(self, watchdog, obj, *args, **kwargs):
             self.console_watch = ConsoleWatchLogFiles(
                 logdir=self.conf['CONSOLE_LOGS'],
                 system_name=self.watchdog['system'], watchdog=self.watchdog,
-                proxy=self, panic=self.conf["PANIC_REGEX"])
+                proxy=self, panic=self.conf["PANIC_REGEX"],
+                watcher=console_watcher, wakeup=self.console_changed.set)
 
     def run(self):
         """ check the logs for new data to upload/or cp
         """
+        self.console_changed.clear()
         return self.console_watch.update()
 
+    def close(self):
+        self.console_watch.close()
+
     def report_panic(self, watchdog, panic_message):
         logger.info('Panic detected for recipe %s on system %s: '
                 'console log contains string %r', watchdog['recipe_id'],
@@ -596,6 +999,9 @@ def report_install_failure(self, watchdog, failure_message):
             self.recipe_stop(recipe.get('id'), 'abort', 'Installation failed')
 
 class Proxy(ProxyHelper):
+
+    batch_log_registration = True
+
     def task_upload_file(self,
                          task_id,
                          path,
@@ -671,6 +1077,7 @@ def install_done(self, recipe_id=None, fqdn=None):
     def install_fail(self, recipe_id=None):
         _debug_id = "(unspecified recipe)" if recipe_id is None else recipe_id
         logger.debug("install_fail for R:%s", _debug_id)
+        self.log_storage.flush_registrations(finishing=('recipe', recipe_id))
         return self.hub.recipes.install_fail(recipe_id)
 
     def postinstall_done(self, recipe_id=None):
@@ -691,6 +1098,7 @@ def task_stop(self,
             stop_type = ['stop', 'abort', 'cancel']
             msg to record if issuing Abort or Cancel """
         logger.debug("task_stop %s", task_id)
+        self.log_storage.flush_registrations(finishing=('task', task_id))
         return self.hub.recipes.tasks.stop(task_id, stop_type, msg)
 
     def result_upload_file(self,
@@ -770,6 +1178,38 @@ class ProxyHTTP(object):
     def __init__(self, proxy):
         self.hub = proxy.hub
         self.log_storage = proxy.log_storage
+        self.log_upload_max_size = proxy.conf.get('LOG_UPLOAD_MAX_SIZE',
+                10 * 1024 ** 3)
+        # Uploads beyond this wait for a slot, which bounds the memory and
+        # disk bandwidth used for uploads at any one time.
+        self.log_upload_slots = gevent.lock.BoundedSemaphore(
+                proxy.conf.get('LOG_UPLOAD_CONCURRENCY', 50))
+        # Task status changes are journalled instead of waiting for the
+        # server, if the journal is enabled. See HarnessJournal.
+        self.journal = None
+        if proxy.conf.get('HARNESS_JOURNAL_DIR'):
+            self.journal = HarnessJournal(proxy.conf['HARNESS_JOURNAL_DIR'],
+                    self.hub, self.log_storage,
+                    concurrency=proxy.conf.get('HARNESS_JOURNAL_CONCURRENCY', 10))
+        self.journal_wait = proxy.conf.get('HARNESS_JOURNAL_WAIT', 60)
+
+    def _wait_for_journal(self, recipe_id):
+        """
+        Waits until the journalled status changes for the recipe have reached
+        the server, so that a call which needs the server's response is
+        handled after them. Raises Conflict if the server rejected one.
+        """
+        if self.journal is None:
+            return
+        if not self.journal.wait_drained(recipe_id, timeout=self.journal_wait):
+            raise ServiceUnavailable('Earlier updates for recipe %s have not '
+                    'reached the server yet' % recipe_id)
+        self._check_journal(recipe_id)
+
+    def _check_journal(self, recipe_id):
+        failure = self.journal.take_failure(recipe_id)
+        if failure:
+            raise Conflict(failure)
 
     def get_recipe(self, req, recipe_id):
         if req.accept_mimetypes.provided and \
@@ -791,6 +1231,7 @@ def post_result(self, req, recipe_id, task_id):
         result = req.form['result'].lower()
         if result not in self._result_types:
             raise BadRequest('Unknown result type %r' % req.form['result'])
+        self._wait_for_journal(recipe_id)
         try:
             result_id = self.hub.recipes.tasks.result(task_id,
                     self._result_types[result],
@@ -815,6 +1256,8 @@ def post_recipe_status(self, req, recipe_id):
         status = req.form['status'].lower()
         if status != 'aborted':
             raise BadRequest('Unknown status %r' % req.form['status'])
+        self._wait_for_journal(recipe_id)
+        self.log_storage.flush_registrations(finishing=('recipe', recipe_id))
         self.hub.recipes.stop(recipe_id, 'abort',
                 req.form.get('message'))
         return Response(status=204)
@@ -822,13 +1265,24 @@ def post_recipe_status(self, req, recipe_id):
     def post_task_status(self, req, recipe_id, task_id):
         if 'status' not in req.form:
             raise BadRequest('Missing "status" parameter')
-        self._update_status(task_id, req.form['status'], req.form.get('message'))
+        self._update_status(recipe_id, task_id, req.form['status'],
+                req.form.get('message'))
         return Response(status=204)
 
-    def _update_status(self, task_id, status, message):
+    def _update_status(self, recipe_id, task_id, status, message):
         status = status.lower()
         if status not in ['running', 'completed', 'aborted']:
             raise BadRequest('Unknown status %r' % status)
+        # Changes for tasks which cannot exist go straight to the server, so
+        # that its error is returned to the harness.
+        if self.journal is not None and self.journal.accepts(recipe_id) \
+                and str(task_id).isdigit():
+            self._check_journal(recipe_id)
+            self.journal.append(recipe_id,
+                    dict(task_id=task_id, status=status, message=message))
+            return
+        if status != 'running':
+            self.log_storage.flush_registrations(finishing=('task', task_id))
         try:
             if status == 'running':
                 self.hub.recipes.tasks.start(task_id)
@@ -840,8 +1294,7 @@ def _update_status(self, task_id, status, message):
             # XXX This has to be completely replaced with JSON response in next major release
             # We don't want to blindly return 500 because of opposite side
             # will try to retry request - which is almost in all situation wrong
-            if ('Cannot restart finished task' in fault.faultString
-                    or 'Cannot change status for finished task' in fault.faultString):
+            if is_rejection(fault):
                 raise Conflict(fault.faultString)
             else:
                 raise
@@ -855,11 +1308,12 @@ def patch_task(self, request, recipe_id, task_id):
             raise UnsupportedMediaType
         if 'status' in data:
             status = data.pop('status')
-            self._update_status(task_id, status, data.pop('message', None))
+            self._update_status(recipe_id, task_id, status, data.pop('message', None))
             # If the caller only wanted to update the status and nothing else,
             # we will avoid making a second XML-RPC call.
             updated = {'status': status}
         if data:
+            self._wait_for_journal(recipe_id)
             updated = self.hub.recipes.tasks.update(task_id, data)
         return Response(status=200, response=json.dumps(updated),
                 content_type='application/json')
@@ -880,12 +1334,14 @@ def post_watchdog(self, req, recipe_id):
         self.hub.recipes.extend(recipe_id, seconds)
         return Response(status=204)
 
-    # XXX should do streaming here, so that clients can send
-    # big files without chunking
+    # The request body is copied straight from the socket to the log file in
+    # blocks, so that clients can send big files without chunking.
 
     def _put_log(self, log_file, req):
         if req.content_length is None:
             raise LengthRequired()
+        if self.log_upload_max_size and req.content_length > self.log_upload_max_size:
+            raise RequestEntityTooLarge()
         content_range = parse_content_range_header(req.headers.get('Content-Range'))
         if content_range:
             # a few sanity checks
@@ -894,15 +1350,19 @@ def _put_log(self, log_file, req):
             if content_range.length and content_range.length < content_range.stop:
                 raise BadRequest('Total length is smaller than range end')
         try:
-            with log_file:
+            with self.log_upload_slots, log_file:
                 if content_range:
                     if content_range.length: # length may be '*' meaning unspecified
                         log_file.truncate(content_range.length)
-                    log_file.update_chunk(req.data, content_range.start)
+                    offset = content_range.start
                 else:
                     # no Content-Range, therefore the request is the whole file
                     log_file.truncate(req.content_length)
-                    log_file.update_chunk(req.data, 0)
+                    offset = 0
+                written = log_file.update_chunk_from_stream(req.stream, offset,
+                        req.content_length)
+                if written < req.content_length:
+                    raise BadRequest('Request body is shorter than Content-Length')
         # XXX need to find a less fragile way to do this
         except xmlrpclib.Fault, fault:
             if 'Cannot register file for finished ' in fault.faultString:
@@ -915,16 +1375,117 @@ def _put_log(self, log_file, req):
                 raise
         return Response(status=204)
 
+    # Logs may still be growing while they are downloaded, so each response
+    # covers the file as it was when the request arrived. Clients tailing
+    # a log can ask for only the new bytes with a Range header, and
+    # revalidate with If-None-Match or If-Modified-Since.
+    # Logs which have been compressed in the cache are not growing any more.
+    # They are sent as they are stored to clients which accept gzip, and
+    # decompressed on the fly for everyone else (ignoring any Range).
+
+    #: Logs smaller than this are not worth compressing.
+    log_gzip_min_size = 1024
+
+    def _gzipped(self, f, length, blocksize=65536):
+        try:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            while length > 0:
+                data = f.read(min(blocksize, length))
+                if not data:
+                    break
+                length -= len(data)
+                data = compressor.compress(data)
+                if data:
+                    yield data
+            yield compressor.flush()
+        finally:
+            f.close()
+
+    def _gunzipped(self, f, blocksize=65536):
+        try:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            while True:
+                data = f.read(blocksize)
+                if not data:
+                    break
+                data = decompressor.decompress(data)
+                if data:
+                    yield data
+            yield decompressor.flush()
+        finally:
+            f.close()
+
     def _get_log(self, log_file, req):
         try:
-            f = log_file.open_ro()
+            f, compressed = log_file.open_stored()
         except IOError, e:
             if e.errno == errno.ENOENT:
                 raise NotFound()
             else:
                 raise
-        return Response(status=200, response=wrap_file(req.environ, f),
-                content_type='text/plain', direct_passthrough=True)
+        try:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            last_modified = datetime.utcfromtimestamp(int(st.st_mtime))
+            etag = '%x-%x-%x' % (st.st_ino, size, int(st.st_mtime * 1000))
+            headers = {'Accept-Ranges': 'none' if compressed else 'bytes',
+                       'Last-Modified': http_date(last_modified)}
+            compressible = compressed or is_compressible(log_file.path)
+            if compressible:
+                headers['Vary'] = 'Accept-Encoding'
+            if compressed:
+                gzip = req.accept_encodings['gzip'] > 0
+            else:
+                gzip = (compressible and not req.range
+                        and size >= self.log_gzip_min_size
+                        and req.accept_encodings['gzip'] > 0)
+            if gzip:
+                # The compressed representation needs its own entity tag.
+                etag += '-gzip'
+            headers['ETag'] = quote_etag(etag)
+            if not is_resource_modified(req.environ, etag=etag,
+                    last_modified=last_modified):
+                f.close()
+                return Response(status=304, headers=headers)
+            if compressed and gzip:
+                headers['Content-Encoding'] = 'gzip'
+                headers['Content-Length'] = str(size)
+                return Response(status=200, headers=headers,
+                        response=wrap_file(req.environ, FileRange(f, 0, size),
+                            buffer_size=65536),
+                        content_type='text/plain', direct_passthrough=True)
+            if compressed:
+                return Response(status=200, headers=headers,
+                        response=self._gunzipped(f),
+                        content_type='text/plain', direct_passthrough=True)
+            if gzip:
+                headers['Content-Encoding'] = 'gzip'
+                return Response(status=200, headers=headers,
+                        response=self._gzipped(f, size),
+                        content_type='text/plain', direct_passthrough=True)
+            start, stop = 0, size
+            status = 200
+            # Multiple ranges are not worth supporting, send the whole file.
+            if req.range and len(req.range.ranges) == 1 and (
+                    'If-Range' not in req.headers
+                    or req.if_range.etag == etag
+                    or (req.if_range.date and req.if_range.date >= last_modified)):
+                byte_range = req.range.range_for_length(size)
+                if byte_range is None:
+                    f.close()
+                    headers['Content-Range'] = 'bytes */%d' % size
+                    return Response(status=416, headers=headers)
+                start, stop = byte_range
+                headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
+                status = 206
+            headers['Content-Length'] = str(stop - start)
+            return Response(status=status, headers=headers,
+                    response=wrap_file(req.environ, FileRange(f, start, stop - start),
+                        buffer_size=65536),
+                    content_type='text/plain', direct_passthrough=True)
+        except Exception:
+            f.close()
+            raise
 
     def do_recipe_log(self, req, recipe_id, path):
         log_file = self.log_storage.recipe(recipe_id, path)
@@ -934,14 +1495,15 @@ def do_recipe_log(self, req, recipe_id, path):
             return self._put_log(log_file, req)
 
     def do_task_log(self, req, recipe_id, task_id, path):
-        log_file = self.log_storage.task(task_id, path)
+        log_file = self.log_storage.task(task_id, path, recipe_id=recipe_id)
         if req.method == 'GET':
             return self._get_log(log_file, req)
         elif req.method == 'PUT':
             return self._put_log(log_file, req)
 
     def do_result_log(self, req, recipe_id, task_id, result_id, path):
-        log_file = self.log_storage.result(result_id, path)
+        log_file = self.log_storage.result(result_id, path,
+                recipe_id=recipe_id, task_id=task_id)
         if req.method == 'GET':
             return self._get_log(log_file, req)
         elif req.method == 'PUT':
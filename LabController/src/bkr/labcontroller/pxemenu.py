@@ -8,10 +8,15 @@
 import os.path
 import re
 import shutil
+import socket
 import sys
+import threading
+import httplib
 import urllib2
 import urlparse
 import xmlrpclib
+from email.utils import parsedate_tz, mktime_tz
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 
 from jinja2 import Environment, PackageLoader
@@ -41,36 +46,193 @@ def _group_distro_trees(distro_trees):
     return grouped
 
 
-def _get_images(tftp_root, distro_tree_id, url, images):
+class ImageFetcher(object):
+    """
+    Fetches images, keeping one connection open to each HTTP server so that it
+    can be reused for the next image. Each thread needs its own ImageFetcher.
+    Images are stored with the server's Last-Modified time as their mtime,
+    so that they can be revalidated with a HEAD request later.
+    """
+
+    max_redirects = 5
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self._connections = {}
+
+    def close(self):
+        for conn in self._connections.values():
+            conn.close()
+        self._connections.clear()
+
+    def _send(self, scheme, netloc, method, path):
+        conn = self._connections.get((scheme, netloc))
+        if conn is None:
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                conn = httplib.HTTPConnection(netloc, timeout=self.timeout)
+            self._connections[(scheme, netloc)] = conn
+        try:
+            conn.request(method, path)
+            return conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            # The server may have closed the connection since we last used it.
+            conn.close()
+            conn.request(method, path)
+            return conn.getresponse()
+
+    def _request(self, method, url):
+        for _ in range(self.max_redirects + 1):
+            parts = urlparse.urlsplit(url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            response = self._send(parts.scheme, parts.netloc, method, path)
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                response.read()
+                url = urlparse.urljoin(url, location)
+                continue
+            if response.status != 200:
+                response.read()
+                raise IOError('HTTP Error %s: %s for %s'
+                              % (response.status, response.reason, url))
+            return response
+        raise IOError('Too many redirects for %s' % url)
+
+    def is_up_to_date(self, url, dest_path):
+        """
+        Returns True if the image at dest_path has the same size as the one at
+        url, and is not older. Only images served over HTTP are checked.
+        """
+        try:
+            st = os.stat(dest_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        if not url.startswith(('http:', 'https:')):
+            return True
+        response = self._request('HEAD', url)
+        response.read()
+        length = response.getheader('Content-Length')
+        if length is not None and int(length) != st.st_size:
+            return False
+        last_modified = _parse_http_date(response.getheader('Last-Modified'))
+        if last_modified is not None and last_modified > st.st_mtime:
+            return False
+        return True
+
+    def fetch(self, url, dest_path):
+        """
+        Downloads the image at url to dest_path. Returns its size.
+        """
+        if not url.startswith(('http:', 'https:')):
+            with atomically_replaced_file(dest_path) as dest:
+                siphon(urllib2.urlopen(url, timeout=self.timeout), dest)
+            return os.path.getsize(dest_path)
+        try:
+            response = self._request('GET', url)
+            with atomically_replaced_file(dest_path) as dest:
+                siphon(response, dest)
+        except Exception:
+            # The connection is in an unknown state now.
+            self.close()
+            raise
+        last_modified = _parse_http_date(response.getheader('Last-Modified'))
+        if last_modified is not None:
+            os.utime(dest_path, (last_modified, last_modified))
+        return os.path.getsize(dest_path)
+
+
+def _parse_http_date(value):
+    if not value:
+        return None
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return mktime_tz(parsed)
+
+
+def _get_images(fetcher, tftp_root, distro_tree_id, url, images):
+    """
+    Returns the number of images fetched and their total size.
+    """
     dest_dir = os.path.join(tftp_root, 'distrotrees', str(distro_tree_id))
     makedirs_ignore(dest_dir, mode=0o755)
+    fetched = size = 0
     for image_type, path in images:
         if image_type in ('kernel', 'initrd'):
             dest_path = os.path.join(dest_dir, image_type)
-            if os.path.isfile(dest_path):
-                print('Skipping existing %s for distro tree %s' % (image_type, distro_tree_id))
+            image_url = urlparse.urljoin(url, path)
+            if fetcher.is_up_to_date(image_url, dest_path):
+                # whole lines at once, since other threads are writing too
+                sys.stdout.write('Skipping existing %s for distro tree %s\n'
+                                 % (image_type, distro_tree_id))
             else:
-                image_url = urlparse.urljoin(url, path)
-                print('Fetching %s %s for distro tree %s' % (image_type, image_url, distro_tree_id))
-                with atomically_replaced_file(dest_path) as dest:
-                    siphon(urllib2.urlopen(image_url), dest)
+                sys.stdout.write('Fetching %s %s for distro tree %s\n'
+                                 % (image_type, image_url, distro_tree_id))
+                size += fetcher.fetch(image_url, dest_path)
+                fetched += 1
+    return fetched, size
+
+
+def _get_images_in_worker(fetcher, tftp_root, distro_tree, url):
+    """
+    Runs _get_images() in a worker thread, using the thread's own fetcher.
+    Returns a tuple of (distro tree, number of images fetched, their size, error).
+    """
+    try:
+        fetched, size = _get_images(fetcher, tftp_root,
+                                    distro_tree['distro_tree_id'], url,
+                                    distro_tree['images'])
+    except (IOError, httplib.HTTPException) as e:
+        return distro_tree, 0, 0, e
+    return distro_tree, fetched, size, None
 
 
-def _get_all_images(tftp_root, distro_trees):
+def _get_all_images(tftp_root, distro_trees, workers=4):
     """
     Fetch all images for the given distro trees and return a new list of distro
     trees for which image can be fetched.
     """
     trees = []
-    for distro_tree in distro_trees:
-        url = _get_url(distro_tree['available'])
-        try:
-            _get_images(tftp_root, distro_tree['distro_tree_id'],
-                        url, distro_tree['images'])
+    fetched_trees = skipped_trees = total_size = 0
+    jobs = [(tftp_root, distro_tree, _get_url(distro_tree['available']))
+            for distro_tree in distro_trees]
+    # Each worker thread creates its own fetcher, and they are all closed
+    # once the pool has finished.
+    local = threading.local()
+    fetchers = []
+    def get_images(args):
+        fetcher = getattr(local, 'fetcher', None)
+        if fetcher is None:
+            fetcher = local.fetcher = ImageFetcher()
+            fetchers.append(fetcher)
+        return _get_images_in_worker(fetcher, *args)
+    pool = ThreadPool(max(1, workers))
+    try:
+        results = pool.imap(get_images, jobs)
+        for distro_tree, fetched, size, error in results:
+            if error is not None:
+                sys.stderr.write('Error fetching images for distro tree %s: %s\n' %
+                                 (distro_tree['distro_tree_id'], error))
+                continue
             trees.append(distro_tree)
-        except IOError as e:
-            sys.stderr.write('Error fetching images for distro tree %s: %s\n' %
-                             (distro_tree['distro_tree_id'], e))
+            if fetched:
+                fetched_trees += 1
+                total_size += size
+            else:
+                skipped_trees += 1
+    finally:
+        pool.close()
+        pool.join()
+        for fetcher in fetchers:
+            fetcher.close()
+    print('Fetched %s bytes of images for %s distro trees, %s distro trees '
+          'were already up to date, %s failed'
+          % (total_size, fetched_trees, skipped_trees, len(distro_trees) - len(trees)))
     return trees
 
 
@@ -87,7 +249,7 @@ def write_menu(menu, template_name, distro_trees):
         menu.write(template.render({'osmajors': osmajors}))
 
 
-def write_menus(tftp_root, tags, xml_filter):
+def write_menus(tftp_root, tags, xml_filter, fetch_workers=4):
     conf = get_conf()
 
     # The order of steps for cleaning images is important,
@@ -117,7 +279,7 @@ def write_menus(tftp_root, tags, xml_filter):
 
     # Fetch images for all the distro trees first.
     print('Fetching images for all the distro trees')
-    distro_trees = _get_all_images(tftp_root, distro_trees)
+    distro_trees = _get_all_images(tftp_root, distro_trees, workers=fetch_workers)
 
     x86_distrotrees = [distro for distro in distro_trees if distro['arch'] in ['x86_64', 'i386']]
     print('Generating PXELINUX menus for %s distro trees' % len(x86_distrotrees))
@@ -189,6 +351,9 @@ def main():
     parser.add_option('--tftp-root', metavar='DIR',
                       default='/var/lib/tftpboot',
                       help='Path to TFTP root directory [default: %default]')
+    parser.add_option('--fetch-workers', metavar='N', type='int', default=4,
+                      help='Fetch images for up to N distro trees at a time '
+                           '[default: %default]')
     parser.add_option('-q', '--quiet', action='store_true',
                       help='Suppress informational output')
     (opts, args) = parser.parse_args()
@@ -196,7 +361,8 @@ def main():
         parser.error('This command does not accept any arguments')
     if opts.quiet:
         os.dup2(os.open('/dev/null', os.O_WRONLY), 1)
-    write_menus(opts.tftp_root, opts.tags, opts.xml_filter)
+    write_menus(opts.tftp_root, opts.tags, opts.xml_filter,
+                fetch_workers=opts.fetch_workers)
     return 0
 
 
@@ -0,0 +1,118 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Zero-copy transmission of cached log files to HTTP clients.
+
+The gevent WSGI server does not provide wsgi.file_wrapper, so beaker-proxy
+supplies its own. When the application returns a FileWrapper around
+a FileRange, the WSGI handler in main.py sends the range straight from the
+file to the socket with sendfile(2) instead of reading it into Python strings
+block by block. The sendfile call is made through ctypes to avoid an extra
+dependency; if it is not usable, the wrapper is iterated as usual.
+"""
+
+import os
+import errno
+import ctypes
+import ctypes.util
+import gevent.socket
+
+_sendfile = None
+def _get_sendfile():
+    global _sendfile
+    if _sendfile is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        # sendfile64 takes a 64-bit offset even on 32-bit platforms.
+        func = getattr(libc, 'sendfile64', None) or getattr(libc, 'sendfile', None)
+        if func is not None:
+            func.argtypes = [ctypes.c_int, ctypes.c_int,
+                    ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+            func.restype = ctypes.c_ssize_t
+        _sendfile = func or False
+    return _sendfile
+
+def sendfile_available():
+    return bool(_get_sendfile())
+
+
+class FileRange(object):
+    """
+    A read-only view of length bytes of an open file, starting at offset.
+    The file is read up to the end of the range even if it has grown since.
+    """
+
+    def __init__(self, f, offset, length):
+        self.f = f
+        self.offset = offset
+        self.remaining = length
+        self.f.seek(offset, os.SEEK_SET)
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if size == 0:
+            return ''
+        data = self.f.read(size)
+        self.offset += len(data)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def close(self):
+        self.f.close()
+
+
+class FileWrapper(object):
+    """
+    Implementation of wsgi.file_wrapper which the WSGI handler can recognise.
+    """
+
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        data = self.filelike.read(self.blksize)
+        if data:
+            return data
+        raise StopIteration()
+
+    def close(self):
+        if hasattr(self.filelike, 'close'):
+            self.filelike.close()
+
+
+def send_range(sock, file_range):
+    """
+    Sends the rest of file_range to the given gevent socket using sendfile(2),
+    cooperatively waiting whenever the socket is not ready. Returns the number
+    of bytes sent, which may be short if the file was truncated underneath us.
+    """
+    sendfile = _get_sendfile()
+    out_fd = sock.fileno()
+    in_fd = file_range.fileno()
+    offset = ctypes.c_int64(file_range.offset)
+    total = 0
+    while file_range.remaining > 0:
+        result = sendfile(out_fd, in_fd, ctypes.byref(offset),
+                file_range.remaining)
+        if result < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EINTR):
+                gevent.socket.wait_write(out_fd)
+                continue
+            raise IOError(err, os.strerror(err))
+        if result == 0:
+            break
+        total += result
+        file_range.offset = offset.value
+        file_range.remaining -= result
+    return total
@@ -0,0 +1,35 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import unittest
+
+from bkr.labcontroller.inotify import ConsoleLogWatcher
+
+
+class TestConsoleLogWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.watcher = ConsoleLogWatcher('/var/consoles')
+        self.notified = []
+        self.watcher.subscribe('host.example.com',
+                lambda path: self.notified.append(path))
+
+    def test_notifies_files_starting_with_fqdn(self):
+        self.watcher._notify('host.example.com')
+        self.watcher._notify('host.example.com-20200101')
+        self.watcher._notify('otherhost.example.com')
+        self.assertEquals(self.notified, ['/var/consoles/host.example.com',
+                '/var/consoles/host.example.com-20200101'])
+
+    def test_notify_all_asks_for_rescan(self):
+        self.watcher._notify_all()
+        self.assertEquals(self.notified, [None])
+
+    def test_unsubscribe(self):
+        callback = lambda path: self.fail('should not be called')
+        self.watcher.subscribe('other.example.com', callback)
+        self.watcher.unsubscribe('other.example.com', callback)
+        self.watcher._notify('other.example.com')
+        self.assertEquals(self.watcher._subscribers.keys(), ['host.example.com'])
@@ -0,0 +1,138 @@
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import os
+import socket
+import shutil
+import tempfile
+import unittest
+import xmlrpclib
+from bkr.labcontroller.journal import HarnessJournal
+
+class FakeTasks(object):
+
+    def __init__(self):
+        self.calls = []
+        self.failures = []
+        self.faults = {}
+
+    def start(self, task_id):
+        self._call('start', task_id)
+
+    def stop(self, task_id, stop_type, msg=None):
+        self._call(stop_type, task_id)
+
+    def _call(self, action, task_id):
+        if self.failures:
+            raise self.failures.pop(0)
+        if (action, task_id) in self.faults:
+            raise xmlrpclib.Fault(1, self.faults[(action, task_id)])
+        self.calls.append((action, task_id))
+
+
+class FakeRecipes(object):
+
+    def __init__(self):
+        self.tasks = FakeTasks()
+
+
+class FakeHub(object):
+
+    def __init__(self):
+        self.recipes = FakeRecipes()
+
+
+class FakeLogStorage(object):
+
+    def flush_registrations(self, finishing=None):
+        pass
+
+
+class HarnessJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='beaker-test-journal')
+        self.addCleanup(shutil.rmtree, self.path)
+        self.hub = FakeHub()
+
+    def make_journal(self):
+        journal = HarnessJournal(self.path, self.hub, FakeLogStorage(),
+                max_retry_delay=0.01)
+        self.addCleanup(journal.stop, timeout=0)
+        return journal
+
+    def test_changes_are_replayed_in_order(self):
+        journal = self.make_journal()
+        journal.append(1, dict(task_id='10', status='running', message=None))
+        journal.append(1, dict(task_id='10', status='completed', message=None))
+        journal.append(1, dict(task_id='11', status='running', message=None))
+        self.assertTrue(os.path.exists(os.path.join(self.path, '1')))
+        self.assertTrue(journal.wait_drained(1, timeout=5))
+        self.assertEquals(self.hub.recipes.tasks.calls,
+                [('start', '10'), ('stop', '10'), ('start', '11')])
+        self.assertEquals(os.listdir(self.path), [])
+
+    def test_retries_while_server_is_unavailable(self):
+        self.hub.recipes.tasks.failures = [socket.error(111, 'Connection refused'),
+                xmlrpclib.ProtocolError('dummy', 503, 'Service Unavailable', {})]
+        journal = self.make_journal()
+        journal.append(1, dict(task_id='10', status='running', message=None))
+        self.assertTrue(journal.wait_drained(1, timeout=5))
+        self.assertEquals(self.hub.recipes.tasks.calls, [('start', '10')])
+
+    def test_retries_while_server_fails_to_record_change(self):
+        self.hub.recipes.tasks.failures = [xmlrpclib.Fault(1,
+                "<class 'sqlalchemy.exc.OperationalError'>:(OperationalError) "
+                "(1213, 'Deadlock found when trying to get lock')")]
+        journal = self.make_journal()
+        journal.append(1, dict(task_id='10', status='completed', message=None))
+        self.assertTrue(journal.wait_drained(1, timeout=5))
+        self.assertEquals(self.hub.recipes.tasks.calls, [('stop', '10')])
+        self.assertEquals(journal.take_failure(1), None)
+
+    def test_rejected_change_is_reported(self):
+        self.hub.recipes.tasks.faults[('stop', '10')] = \
+                'Cannot change status for finished task'
+        journal = self.make_journal()
+        journal.append(1, dict(task_id='10', status='completed', message=None))
+        journal.append(1, dict(task_id='11', status='running', message=None))
+        self.assertTrue(journal.wait_drained(1, timeout=5))
+        self.assertIn('finished task', journal.take_failure(1))
+        self.assertEquals(journal.take_failure(1), None)
+        self.assertEquals(self.hub.recipes.tasks.calls, [('start', '11')])
+
+    def test_change_for_invalid_task_is_reported(self):
+        self.hub.recipes.tasks.faults[('start', '999')] = \
+                "<class 'bkr.server.bexceptions.BX'>:Invalid task ID: 999"
+        journal = self.make_journal()
+        journal.append(1, dict(task_id='999', status='running', message=None))
+        self.assertTrue(journal.wait_drained(1, timeout=5))
+        self.assertIn('Invalid task ID', journal.take_failure(1))
+        self.assertEquals(os.listdir(self.path), [])
+
+    def test_replayed_count_is_saved_after_last_change(self):
+        journal = self.make_journal()
+        journal._remove = lambda recipe_id: None # as if we stopped first
+        journal.append(1, dict(task_id='10', status='completed', message=None))
+        journal.replayers['1'].join()
+        with open(os.path.join(self.path, '1.replayed')) as f:
+            self.assertEquals(f.read(), '1\n')
+
+    def test_journal_is_replayed_after_restart(self):
+        journal = self.make_journal()
+        journal.stopping = True # nothing is replayed
+        journal.append(1, dict(task_id='10', status='running', message=None))
+        journal.append(1, dict(task_id='10', status='completed', message=None))
+        journal.replayed['1'] = 1
+        journal._write_replayed('1')
+        # a change which was being written when we stopped
+        with open(os.path.join(self.path, '1'), 'a') as f:
+            f.write('{"task_id": "11"')
+        journal = self.make_journal()
+        journal.start()
+        self.assertTrue(journal.wait_drained(1, timeout=5))
+        self.assertEquals(self.hub.recipes.tasks.calls, [('stop', '10')])
+        self.assertEquals(os.listdir(self.path), [])
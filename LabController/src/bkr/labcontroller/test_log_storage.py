@@ -4,8 +4,15 @@
 # the Free Software Foundation; either version 2 of the License, or
 # (at your option) any later version.
 
+import os
+import fcntl
 import unittest
-from bkr.labcontroller.log_storage import LogStorage
+import tempfile
+import shutil
+import xmlrpclib
+import StringIO
+import gevent
+from bkr.labcontroller.log_storage import LogStorage, compress_log
 
 def test_log_storage_paths():
     log_storage = LogStorage('/dummy', 'http://dummy/', object())
@@ -29,3 +36,225 @@ def test_log_storage_paths():
     for log_type, id, path, expected in cases:
         actual = getattr(log_storage, log_type)(id, path).path
         assert actual == expected, actual
+
+
+class FakeTasks(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def register_file(self, *args):
+        self.calls.append(('task',) + args)
+
+
+class FakeRecipes(object):
+
+    def __init__(self, batch_errors=None, batch_fault=None):
+        self.tasks = FakeTasks()
+        self.batches = []
+        self.batch_errors = batch_errors
+        self.batch_fault = batch_fault
+
+    def register_files(self, files):
+        if self.batch_fault:
+            raise xmlrpclib.Fault(1, self.batch_fault)
+        self.batches.append(files)
+        return self.batch_errors or [''] * len(files)
+
+
+class FakeHub(object):
+
+    def __init__(self, **kwargs):
+        self.recipes = FakeRecipes(**kwargs)
+
+
+class BatchedRegistrationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp(prefix='beaker-test-log-storage')
+        self.addCleanup(shutil.rmtree, self.base_dir)
+
+    def create_log(self, log_storage, task_id, path):
+        with log_storage.task(task_id, path) as log_file:
+            log_file.update_chunk('data', 0)
+
+    def test_files_are_registered_in_one_call(self):
+        hub = FakeHub()
+        log_storage = LogStorage(self.base_dir, 'http://dummy/', hub,
+                registration_delay=60)
+        self.create_log(log_storage, '1', 'TESTOUT.log')
+        self.create_log(log_storage, '1', 'debug/beah_raw')
+        self.create_log(log_storage, '1', 'debug/avc')
+        self.create_log(log_storage, '1', 'debug/avc') # already registered
+        # The first file for the task is registered straight away
+        self.assertEquals(len(hub.recipes.tasks.calls), 1)
+        self.assertEquals(hub.recipes.tasks.calls[0][2:5], ('1', '', 'TESTOUT.log'))
+        self.assertEquals(hub.recipes.batches, [])
+        log_storage.flush_registrations()
+        self.assertEquals(len(hub.recipes.batches), 1)
+        self.assertEquals([(f['type'], f['id'], f['path'], f['filename'])
+                for f in hub.recipes.batches[0]],
+                [('task', '1', 'debug', 'beah_raw'), ('task', '1', 'debug', 'avc')])
+        log_storage.flush_registrations()
+        self.assertEquals(len(hub.recipes.batches), 1)
+
+    def test_failure_is_raised_for_next_file(self):
+        hub = FakeHub(batch_errors=['Cannot register file for finished task T:1'])
+        log_storage = LogStorage(self.base_dir, 'http://dummy/', hub,
+                registration_delay=60)
+        self.create_log(log_storage, '1', 'TESTOUT.log')
+        self.create_log(log_storage, '1', 'debug/beah_raw')
+        log_storage.flush_registrations()
+        try:
+            self.create_log(log_storage, '1', 'other.log')
+            self.fail('should raise')
+        except xmlrpclib.Fault, fault:
+            self.assertIn('Cannot register file for finished task', fault.faultString)
+        # other tasks are not affected
+        self.create_log(log_storage, '2', 'TESTOUT.log')
+
+    def test_falls_back_to_registering_one_at_a_time(self):
+        hub = FakeHub(batch_fault='XML-RPC method recipes.register_files '
+                'not implemented by this server')
+        log_storage = LogStorage(self.base_dir, 'http://dummy/', hub,
+                registration_delay=60)
+        self.create_log(log_storage, '1', 'TESTOUT.log')
+        self.create_log(log_storage, '1', 'debug/beah_raw')
+        log_storage.flush_registrations()
+        self.assertEquals(len(hub.recipes.tasks.calls), 2)
+        self.assertEquals(hub.recipes.tasks.calls[1][2:5], ('1', 'debug', 'beah_raw'))
+
+    def test_registered_immediately_after_finishing(self):
+        hub = FakeHub()
+        log_storage = LogStorage(self.base_dir, 'http://dummy/', hub,
+                registration_delay=60)
+        self.create_log(log_storage, '1', 'TESTOUT.log')
+        log_storage.flush_registrations(finishing=('task', 1))
+        self.create_log(log_storage, '1', 'debug/beah_raw')
+        self.assertEquals(len(hub.recipes.tasks.calls), 2)
+        self.assertEquals(hub.recipes.batches, [])
+
+    def test_registered_immediately_after_recipe_finishes(self):
+        hub = FakeHub()
+        log_storage = LogStorage(self.base_dir, 'http://dummy/', hub,
+                registration_delay=60)
+        with log_storage.task('1', 'TESTOUT.log', recipe_id='5') as log_file:
+            log_file.update_chunk('data', 0)
+        with log_storage.task('2', 'TESTOUT.log', recipe_id='6') as log_file:
+            log_file.update_chunk('data', 0)
+        log_storage.flush_registrations(finishing=('recipe', 5))
+        self.create_log(log_storage, '1', 'debug/beah_raw')
+        self.create_log(log_storage, '2', 'debug/beah_raw')
+        self.assertEquals([call[2:5] for call in hub.recipes.tasks.calls], [
+                ('1', '', 'TESTOUT.log'), ('2', '', 'TESTOUT.log'),
+                ('1', 'debug', 'beah_raw')])
+
+    def test_registered_immediately_after_ttl(self):
+        hub = FakeHub()
+        log_storage = LogStorage(self.base_dir, 'http://dummy/', hub,
+                registration_delay=60)
+        log_storage.registration_ttl = 0
+        self.create_log(log_storage, '1', 'TESTOUT.log')
+        self.create_log(log_storage, '1', 'debug/beah_raw')
+        self.assertEquals(len(hub.recipes.tasks.calls), 2)
+        self.assertEquals(hub.recipes.batches, [])
+
+    def test_registered_immediately_without_delay(self):
+        hub = FakeHub()
+        log_storage = LogStorage(self.base_dir, 'http://dummy/', hub)
+        self.create_log(log_storage, '1', 'TESTOUT.log')
+        self.assertEquals(len(hub.recipes.tasks.calls), 1)
+
+
+class UpdateChunkFromStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp(prefix='beaker-test-log-storage')
+        self.addCleanup(shutil.rmtree, self.base_dir)
+        self.log_storage = LogStorage(self.base_dir, 'http://dummy/', FakeHub())
+
+    def test_copies_stream_in_blocks(self):
+        log_file = self.log_storage.task('1', 'vmcore')
+        with log_file:
+            log_file.update_chunk('header', 0)
+            written = log_file.update_chunk_from_stream(
+                    StringIO.StringIO('0123456789' * 10 + 'trailing'), 6, 100,
+                    blocksize=7)
+        self.assertEquals(written, 100)
+        self.assertEquals(log_file.open_ro().read(), 'header' + '0123456789' * 10)
+
+    def test_stream_ending_early(self):
+        log_file = self.log_storage.task('1', 'vmcore')
+        with log_file:
+            written = log_file.update_chunk_from_stream(
+                    StringIO.StringIO('short'), 0, 100)
+        self.assertEquals(written, 5)
+
+
+class CompressionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp(prefix='beaker-test-log-storage')
+        self.addCleanup(shutil.rmtree, self.base_dir)
+        self.hub = FakeHub()
+        self.log_storage = LogStorage(self.base_dir, 'http://dummy/', self.hub)
+        self.log_file = self.log_storage.task('1', 'TESTOUT.log')
+        with self.log_file:
+            self.log_file.update_chunk('line\n' * 1000, 0)
+
+    def test_idle_log_is_compressed(self):
+        self.assertEquals(self.log_storage.compress_logs([self.log_file.path], 0)[0], 1)
+        self.assertFalse(os.path.exists(self.log_file.path))
+        self.assertTrue(os.path.exists(self.log_file.compressed_path))
+        self.assertLess(os.path.getsize(self.log_file.compressed_path), 5000)
+        self.assertEquals(self.log_file.open_ro().read(), 'line\n' * 1000)
+        # already compressed
+        self.assertEquals(self.log_storage.compress_logs([self.log_file.path], 0)[0], 0)
+
+    def test_small_log_is_not_compressed(self):
+        log_file = self.log_storage.task('1', 'small.log')
+        with log_file:
+            log_file.update_chunk('data', 0)
+        self.assertEquals(compress_log(log_file.path, 0), None)
+
+    def test_recently_written_log_is_not_compressed(self):
+        self.assertEquals(compress_log(self.log_file.path, 3600), None)
+        self.assertTrue(os.path.exists(self.log_file.path))
+
+    def test_open_log_is_not_compressed(self):
+        with self.log_file:
+            self.assertEquals(compress_log(self.log_file.path, 0), None)
+        self.assertFalse(os.path.exists(self.log_file.compressed_path))
+
+    def test_binary_log_is_not_compressed(self):
+        log_file = self.log_storage.task('1', 'vmcore.gz')
+        with log_file:
+            log_file.update_chunk('data' * 2000, 0)
+        self.assertEquals(compress_log(log_file.path, 0), None)
+
+    def test_writing_restores_log(self):
+        compress_log(self.log_file.path, 0)
+        with self.log_file:
+            self.log_file.update_chunk('more\n', 5000)
+        self.assertFalse(os.path.exists(self.log_file.compressed_path))
+        self.assertEquals(self.log_file.open_ro().read(),
+                'line\n' * 1000 + 'more\n')
+        # it was registered when it was first created, not again
+        self.assertEquals(len(self.hub.recipes.tasks.calls), 1)
+
+    def test_writer_waiting_for_compression(self):
+        def write():
+            with self.log_file:
+                self.log_file.update_chunk('more\n', 5000)
+        # The writer opens the log and waits while someone else has it locked,
+        # then it is compressed as soon as they are done.
+        f = open(self.log_file.path, 'r')
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        writer = gevent.spawn(write)
+        gevent.sleep(0)
+        f.close()
+        self.assertNotEquals(compress_log(self.log_file.path, 0), None)
+        writer.get(timeout=5)
+        self.assertFalse(os.path.exists(self.log_file.compressed_path))
+        self.assertEquals(self.log_file.open_ro().read(),
+                'line\n' * 1000 + 'more\n')
@@ -9,6 +9,7 @@
 import tempfile
 import random
 import shutil
+import gevent
 from bkr.labcontroller import netboot
 from bkr.common.helpers import makedirs_ignore
 
@@ -178,6 +179,81 @@ def test_fetch_twice(self):
         self.assertEquals(os.path.getsize(initrd_path), 8 * 1024 * 1024)
 
 
+class ImageCacheTest(ImagesBaseTestCase):
+
+    def setUp(self):
+        super(ImageCacheTest, self).setUp()
+        self.fake_conf['IMAGE_CACHE_SIZE'] = 100 * 1024 * 1024
+
+    def fetch_images(self, fqdn):
+        netboot.fetch_images(None, 'file://%s' % self.kernel.name,
+                             'file://%s' % self.initrd.name, fqdn)
+        return os.path.join(self.tftp_root, 'images', fqdn, 'kernel')
+
+    def test_images_are_shared(self):
+        first = self.fetch_images(TEST_FQDN)
+        second = self.fetch_images('other.example.invalid')
+        self.assertEquals(os.stat(first).st_ino, os.stat(second).st_ino)
+        self.assertEquals(os.path.getsize(second), 4 * 1024 * 1024)
+        netboot.clear_images(TEST_FQDN)
+        self.check_netboot_cleared("images")
+        self.assertTrue(os.path.exists(second))
+
+    def test_changed_image_is_downloaded_again(self):
+        first = self.fetch_images(TEST_FQDN)
+        self.kernel.seek(0)
+        self.kernel.write('changed')
+        self.kernel.flush()
+        os.utime(self.kernel.name, (0, 0))
+        second = self.fetch_images('other.example.invalid')
+        self.assertNotEquals(os.stat(first).st_ino, os.stat(second).st_ino)
+        self.assertEquals(open(second).read(7), 'changed')
+
+    def test_least_recently_used_images_are_evicted(self):
+        self.fake_conf['IMAGE_CACHE_SIZE'] = 10 * 1024 * 1024
+        kernel_path = self.fetch_images(TEST_FQDN)
+        cached = os.listdir(netboot.get_image_cache_dir())
+        # only the initrd is left in the cache
+        self.assertEquals(len([name for name in cached
+                if not name.endswith('.json')]), 1)
+        self.assertEquals(os.stat(kernel_path).st_nlink, 1)
+        self.assertEquals(os.path.getsize(kernel_path), 4 * 1024 * 1024)
+
+    def test_concurrent_requests_share_one_download(self):
+        downloads = []
+        orig_refresh = netboot._refresh_cached_image
+        def refresh(url, path, timeout):
+            downloads.append(url)
+            gevent.sleep(0.1)
+            orig_refresh(url, path, timeout)
+        netboot._refresh_cached_image = refresh
+        self.addCleanup(setattr, netboot, '_refresh_cached_image', orig_refresh)
+        url = 'file://%s' % self.kernel.name
+        greenlets = [gevent.spawn(netboot.cached_image, url, 100 * 1024 * 1024)
+                for i in range(3)]
+        gevent.joinall(greenlets, raise_error=True)
+        self.assertEquals(downloads, [url])
+        self.assertEquals(len(set(g.value for g in greenlets)), 1)
+
+    def test_failed_download_is_raised_to_everyone(self):
+        downloads = []
+        def refresh(url, path, timeout):
+            downloads.append(url)
+            gevent.sleep(0.1)
+            raise IOError('Connection reset by peer')
+        orig_refresh = netboot._refresh_cached_image
+        netboot._refresh_cached_image = refresh
+        self.addCleanup(setattr, netboot, '_refresh_cached_image', orig_refresh)
+        url = 'file://%s' % self.kernel.name
+        greenlets = [gevent.spawn(netboot.cached_image, url, 100 * 1024 * 1024)
+                for i in range(2)]
+        gevent.joinall(greenlets)
+        self.assertEquals(len(downloads), 1)
+        for greenlet in greenlets:
+            self.assertTrue(isinstance(greenlet.exception, IOError))
+        self.assertEquals(netboot._image_downloads, {})
+
+
 class ArchBasedConfigTest(ImagesBaseTestCase):
     common_categories = ("images", "armlinux", "efigrub",
                          "elilo", "yaboot", "pxelinux", "ipxe")
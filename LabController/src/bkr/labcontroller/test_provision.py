@@ -0,0 +1,123 @@
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import copy
+import unittest
+import xmlrpclib
+import gevent
+from bkr.labcontroller.config import _conf
+from bkr.labcontroller import proxy
+from bkr.labcontroller.provision import CommandQueuePoller, PowerExecutor
+
+class FakeLabControllers(object):
+
+    def __init__(self, batch_supported=True, errors=None, queued_command_ids=None):
+        self.batch_supported = batch_supported
+        self.errors = errors or {}
+        self.queued_command_ids = queued_command_ids
+        self.calls = []
+
+    def mark_commands(self, changes):
+        if not self.batch_supported:
+            raise xmlrpclib.Fault(1, 'XML-RPC method labcontrollers.mark_commands '
+                    'not implemented by this server')
+        self.calls.append(('mark_commands', [c['id'] for c in changes]))
+        return [self.errors.get(c['id'], '') for c in changes]
+
+    def mark_command_running(self, id):
+        self.calls.append(('mark_command_running', id))
+
+    def has_new_queued_commands(self, known_command_ids):
+        if self.queued_command_ids is None:
+            raise xmlrpclib.Fault(1, 'XML-RPC method '
+                    'labcontrollers.has_new_queued_commands not implemented by this server')
+        self.calls.append(('has_new_queued_commands', known_command_ids))
+        return bool(set(self.queued_command_ids).difference(known_command_ids))
+
+
+class FakeHub(object):
+
+    def __init__(self, **kwargs):
+        self.labcontrollers = FakeLabControllers(**kwargs)
+
+
+class CommandStatusBatchingTest(unittest.TestCase):
+
+    def setUp(self):
+        orig_get_conf = proxy.get_conf
+        proxy.get_conf = lambda: copy.copy(_conf)
+        self.addCleanup(setattr, proxy, 'get_conf', orig_get_conf)
+
+    def mark_running(self, poller, ids):
+        greenlets = [gevent.spawn(poller.mark_command_running, id) for id in ids]
+        gevent.joinall(greenlets)
+        return greenlets
+
+    def test_changes_are_sent_in_one_call(self):
+        hub = FakeHub(errors={2: 'Command 2 already run'})
+        poller = CommandQueuePoller(hub=hub)
+        poller.status_batch_delay = 0.01
+        greenlets = self.mark_running(poller, [1, 2, 3])
+        self.assertEquals(hub.labcontrollers.calls, [('mark_commands', [1, 2, 3])])
+        self.assertTrue(greenlets[0].successful())
+        self.assertIn('already run', greenlets[1].exception.faultString)
+        self.assertTrue(greenlets[2].successful())
+
+    def test_falls_back_to_marking_one_at_a_time(self):
+        hub = FakeHub(batch_supported=False)
+        poller = CommandQueuePoller(hub=hub)
+        poller.status_batch_delay = 0.01
+        self.mark_running(poller, [1, 2])
+        self.mark_running(poller, [3])
+        self.assertEquals(hub.labcontrollers.calls, [('mark_command_running', 1),
+                ('mark_command_running', 2), ('mark_command_running', 3)])
+
+    def test_falls_back_to_sleeping(self):
+        poller = CommandQueuePoller(hub=FakeHub())
+        poller.new_commands_check_interval = 0.01
+        self.assertEquals(poller.wait_for_commands(0.1), False)
+        self.assertFalse(poller.check_supported)
+
+    def test_checks_for_new_commands_with_backoff(self):
+        hub = FakeHub(queued_command_ids=[1])
+        poller = CommandQueuePoller(hub=hub)
+        poller.new_commands_check_interval = 0.02
+        poller.commands[1] = {'id': 1}
+        self.assertEquals(poller.wait_for_commands(0.2), False)
+        # checked after 0.02, 0.06 and 0.14 seconds
+        self.assertEquals(hub.labcontrollers.calls,
+                [('has_new_queued_commands', [1])] * 3)
+        hub.labcontrollers.queued_command_ids = [1, 2]
+        self.assertEquals(poller.wait_for_commands(0.2), True)
+
+
+class PowerExecutorTest(unittest.TestCase):
+
+    def run_scripts(self, executor, power_types):
+        running = {'all': 0}
+        peaks = {'all': 0}
+        def script(power_type):
+            with executor.slot(power_type):
+                for key in ['all', power_type]:
+                    running[key] = running.get(key, 0) + 1
+                    peaks[key] = max(peaks.get(key, 0), running[key])
+                gevent.sleep(0.01)
+                for key in ['all', power_type]:
+                    running[key] -= 1
+        gevent.joinall([gevent.spawn(script, power_type)
+                for power_type in power_types], raise_error=True)
+        return peaks
+
+    def test_limits_concurrency(self):
+        executor = PowerExecutor(3, {'apc_snmp': 1})
+        peaks = self.run_scripts(executor, ['apc_snmp'] * 4 + ['ipmilan'] * 4)
+        self.assertEquals(peaks['all'], 3)
+        self.assertEquals(peaks['apc_snmp'], 1)
+
+    def test_unlimited(self):
+        executor = PowerExecutor()
+        peaks = self.run_scripts(executor, ['ipmilan'] * 10)
+        self.assertEquals(peaks['all'], 10)
@@ -3,10 +3,19 @@
 # the Free Software Foundation; either version 2 of the License, or
 # (at your option) any later version.
 
+import os
+import copy
+import shutil
+import tempfile
+import time
 import unittest
+import xmlrpclib
+from distutils.spawn import find_executable
 
 from bkr.labcontroller.config import _conf
-from bkr.labcontroller.proxy import PanicDetector
+from bkr.labcontroller import proxy
+from bkr.labcontroller.log_storage import compress_log, COMPRESSED_SUFFIX
+from bkr.labcontroller.proxy import PanicDetector, MultiPatternMatcher, LogArchiver
 
 
 class TestPanicDetector(unittest.TestCase):
@@ -49,3 +58,150 @@ def test_panic_detector_ignores_false_panic(self):
                             "Panic detector erroneously detected: %r" % (line))
             self.assertIsNone(match,
                             "feed result ( %r ) wasn't NoneType" % (match))
+
+
+class TestMultiPatternMatcher(unittest.TestCase):
+
+    def test_reports_which_pattern_matched(self):
+        matcher = MultiPatternMatcher(['Kernel panic', 'Oops[\s:[]', '(?i)press enter'])
+        self.assertEquals(matcher.search('Oops: 0000 [#1] SMP'), (1, 'Oops:'))
+        self.assertEquals(matcher.search('PRESS ENTER to exit'), (2, 'PRESS ENTER'))
+        self.assertIsNone(matcher.search('nothing to see here'))
+
+    def test_candidate_lines(self):
+        matcher = MultiPatternMatcher(['Kernel panic|Oops[\s:[]',
+                '(?i)Press enter to exit[\\.:]', '(?<=\\| )Exception Occurred(?= \\+)'])
+        text = '\n'.join(['booting', 'Oops[#1]', 'nothing here', 'Kernel panic',
+                'PRESS ENTER TO EXIT:', '| Exception Occurred +', 'Oops'])
+        # Oops without a following character is a candidate but not a match.
+        self.assertEquals(matcher.candidate_lines(text), ['Oops[#1]',
+                'Kernel panic', 'PRESS ENTER TO EXIT:', '| Exception Occurred +', 'Oops'])
+        self.assertEquals(matcher.candidate_lines('all quiet\n'), [])
+
+    def test_every_line_is_candidate_without_literals(self):
+        matcher = MultiPatternMatcher(['Kernel panic', '^[0-9]+$'])
+        self.assertEquals(matcher.candidate_lines('a\nb'), ['a', 'b'])
+
+
+class FakeArchiveRecipes(object):
+
+    def __init__(self, cache, change_errors, finished=()):
+        self.cache = cache
+        self.change_errors = change_errors
+        self.changed = []
+        self.finished = sorted(finished)
+
+    def by_log_server(self, server, limit=50, after=None):
+        return [recipe_id for recipe_id in self.finished
+                if after is None or recipe_id > after][:limit]
+
+    def files(self, recipe_id):
+        if recipe_id == 3:
+            raise xmlrpclib.Fault(1, 'broken')
+        return [dict(basepath='%s/recipes/0+/%s' % (self.cache, recipe_id),
+                     path='/', filename='console.log',
+                     filepath='2026/10/%s' % recipe_id)]
+
+    def change_files_batch(self, recipe_ids, server, basepath):
+        self.changed.extend(recipe_ids)
+        return [self.change_errors.get(recipe_id, '') for recipe_id in recipe_ids]
+
+
+class FakeArchiveHub(object):
+
+    def __init__(self, cache, change_errors, finished=()):
+        self.recipes = FakeArchiveRecipes(cache, change_errors, finished)
+
+
+class TestLogArchiverBatch(unittest.TestCase):
+
+    def setUp(self):
+        if not find_executable('rsync'):
+            raise unittest.SkipTest('rsync is not installed')
+        self.cache = tempfile.mkdtemp(prefix='beaker-test-cache')
+        self.addCleanup(shutil.rmtree, self.cache)
+        self.archive = tempfile.mkdtemp(prefix='beaker-test-archive')
+        self.addCleanup(shutil.rmtree, self.archive)
+        orig_get_conf = proxy.get_conf
+        proxy.get_conf = lambda: copy.copy(_conf)
+        self.addCleanup(setattr, proxy, 'get_conf', orig_get_conf)
+
+    def create_cached_log(self, recipe_id):
+        path = '%s/recipes/0+/%s/console.log' % (self.cache, recipe_id)
+        os.makedirs(os.path.dirname(path))
+        open(path, 'w').write('console output for %s' % recipe_id)
+        return path
+
+    def test_failures_are_isolated(self):
+        cached = dict((recipe_id, self.create_cached_log(recipe_id))
+                for recipe_id in [1, 2, 3, 4])
+        hub = FakeArchiveHub(self.cache, {2: 'Invalid recipe ID: 2'})
+        archiver = LogArchiver(hub=hub, CACHEPATH=self.cache,
+                ARCHIVE_RSYNC='%s/' % self.archive, RSYNC_FLAGS='-r',
+                ARCHIVE_SERVER='http://archive.invalid/beaker',
+                ARCHIVE_BASEPATH='/var/www/html/beaker',
+                TRANSFER_BATCH_SIZE=10, TRANSFER_RSYNC_PROCESSES=2)
+        archiver.transfer_batch_logs([1, 2, 3, 4])
+        # recipe 3 could not be staged, so it is not transferred
+        self.assertEquals(sorted(hub.recipes.changed), [1, 2, 4])
+        for recipe_id in [1, 2, 4]:
+            self.assertEquals(open('%s/2026/10/%s/console.log'
+                    % (self.archive, recipe_id)).read(),
+                    'console output for %s' % recipe_id)
+        # the server did not accept recipe 2, so its logs are left in the cache
+        self.assertFalse(os.path.exists(cached[1]))
+        self.assertTrue(os.path.exists(cached[2]))
+        self.assertTrue(os.path.exists(cached[3]))
+        self.assertFalse(os.path.exists(cached[4]))
+
+    def test_compressed_logs_are_transferred_decompressed(self):
+        cached = self.create_cached_log(1)
+        open(cached, 'w').write('console output\n' * 1000)
+        self.assertNotEquals(compress_log(cached, 0), None)
+        hub = FakeArchiveHub(self.cache, {})
+        archiver = LogArchiver(hub=hub, CACHEPATH=self.cache,
+                ARCHIVE_RSYNC='%s/' % self.archive, RSYNC_FLAGS='-r',
+                ARCHIVE_SERVER='http://archive.invalid/beaker',
+                ARCHIVE_BASEPATH='/var/www/html/beaker',
+                TRANSFER_BATCH_SIZE=10)
+        archiver.transfer_batch_logs([1])
+        self.assertEquals(hub.recipes.changed, [1])
+        self.assertEquals(open('%s/2026/10/1/console.log' % self.archive).read(),
+                'console output\n' * 1000)
+        self.assertFalse(os.path.exists('%s/2026/10/1/console.log.beaker.gz'
+                % self.archive))
+        self.assertFalse(os.path.exists(cached + '.beaker.gz'))
+
+
+class TestLogArchiverCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = tempfile.mkdtemp(prefix='beaker-test-cache')
+        self.addCleanup(shutil.rmtree, self.cache)
+        orig_get_conf = proxy.get_conf
+        proxy.get_conf = lambda: copy.copy(_conf)
+        self.addCleanup(setattr, proxy, 'get_conf', orig_get_conf)
+
+    def create_cached_log(self, recipe_id, age):
+        path = '%s/recipes/0+/%s/console.log' % (self.cache, recipe_id)
+        os.makedirs(os.path.dirname(path))
+        open(path, 'w').write('console output\n' * 1000)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_only_idle_logs_of_finished_recipes_are_compressed(self):
+        finished_idle = self.create_cached_log(1, 3600)
+        finished_recently = self.create_cached_log(2, 0)
+        still_running = self.create_cached_log(4, 3600)
+        another_finished_idle = self.create_cached_log(5, 3600)
+        hub = FakeArchiveHub(self.cache, {}, finished=[1, 2, 5])
+        archiver = LogArchiver(hub=hub, CACHEPATH=self.cache,
+                LOG_COMPRESS_AGE=60)
+        archiver.compress_batch_size = 2
+        archiver.compress_logs()
+        self.assertTrue(os.path.exists(finished_idle + COMPRESSED_SUFFIX))
+        self.assertTrue(os.path.exists(another_finished_idle + COMPRESSED_SUFFIX))
+        self.assertTrue(os.path.exists(finished_recently))
+        self.assertTrue(os.path.exists(still_running))
+        self.assertEquals(archiver.compressed_recipes, set([1, 5]))
@@ -0,0 +1,46 @@
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import socket
+import tempfile
+import unittest
+from bkr.labcontroller.sendfile import FileRange, FileWrapper, send_range, \
+        sendfile_available
+
+class SendfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.f = tempfile.TemporaryFile()
+        self.f.write('0123456789' * 10)
+        self.f.flush()
+
+    def tearDown(self):
+        self.f.close()
+
+    def test_file_range_is_bounded(self):
+        file_range = FileRange(self.f, 5, 12)
+        self.assertEquals(list(FileWrapper(file_range, 5)),
+                ['56789', '01234', '56'])
+        self.assertEquals(file_range.remaining, 0)
+        self.assertEquals(file_range.read(), '')
+
+    def test_send_range(self):
+        if not sendfile_available():
+            raise unittest.SkipTest('sendfile is not available')
+        sender, receiver = socket.socketpair()
+        try:
+            file_range = FileRange(self.f, 95, 5)
+            self.assertEquals(send_range(sender, file_range), 5)
+            self.assertEquals(file_range.remaining, 0)
+            self.assertEquals(receiver.recv(100), '56789')
+            # stops at the end of the file if it was truncated
+            self.f.truncate(50)
+            file_range = FileRange(self.f, 45, 10)
+            self.assertEquals(send_range(sender, file_range), 5)
+            self.assertEquals(receiver.recv(100), '56789')
+        finally:
+            sender.close()
+            receiver.close()
@@ -0,0 +1,61 @@
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import unittest
+from bkr.labcontroller.watchdog import WatchdogState
+
+def change(recipe_id, recipe_set_id, kill_time, expires_in):
+    return dict(recipe_id=recipe_id, recipe_set_id=recipe_set_id,
+            system='system%s.example.invalid' % recipe_id,
+            is_virt_recipe=False, kill_time=kill_time, expires_in=expires_in)
+
+class WatchdogStateTest(unittest.TestCase):
+
+    def test_tracks_changes(self):
+        state = WatchdogState()
+        state.update(dict(cursor='1:0', resync=True, changes=[
+            change(1, 10, '2026-01-01 01:00:00', 3600),
+            change(2, 20, '2026-01-01 01:00:00', 3600),
+        ]), now=1000)
+        self.assertEquals(sorted(w['recipe_id'] for w in state.active(now=1000)),
+                [1, 2])
+        self.assertEquals(state.cursor, '1:0')
+        state.update(dict(cursor='3:0', resync=False, changes=[
+            change(2, 20, None, None),
+        ]), now=1000)
+        self.assertEquals([w['recipe_id'] for w in state.active(now=1000)], [1])
+        # a full list replaces everything
+        state.update(dict(cursor='4:0', resync=True, changes=[
+            change(3, 30, '2026-01-01 01:00:00', 3600),
+        ]), now=1000)
+        self.assertEquals([w['recipe_id'] for w in state.active(now=1000)], [3])
+
+    def test_expiry_is_per_recipe_set(self):
+        state = WatchdogState()
+        state.update(dict(cursor='1:0', resync=True, changes=[
+            change(1, 10, '2026-01-01 00:00:00', -10),
+            change(2, 10, '2026-01-01 01:00:00', 3600),
+        ]), now=1000)
+        # the host recipe is still active while its guest is
+        self.assertEquals(sorted(w['recipe_id'] for w in state.active(now=1000)),
+                [1, 2])
+        self.assertFalse(state.any_expired(now=1000))
+        self.assertEquals(state.active(now=5000), [])
+        self.assertTrue(state.any_expired(now=5000))
+
+    def test_repeated_change_keeps_deadline(self):
+        state = WatchdogState()
+        state.update(dict(cursor='1:0', resync=False, changes=[
+            change(1, 10, '2026-01-01 01:00:00', 3600),
+        ]), now=1000)
+        state.update(dict(cursor='1:0', resync=False, changes=[
+            change(1, 10, '2026-01-01 01:00:00', 3500),
+        ]), now=1200)
+        self.assertEquals(state.watchdogs[1]['deadline'], 4600)
+        state.update(dict(cursor='2:0', resync=False, changes=[
+            change(1, 10, '2026-01-01 02:00:00', 7100),
+        ]), now=1200)
+        self.assertEquals(state.watchdogs[1]['deadline'], 8300)
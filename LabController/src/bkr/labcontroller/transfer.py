@@ -32,7 +32,10 @@ def main_loop(logarchiver, conf=None):
     while True:
         try:
             # Look for logs to transfer if none transfered then sleep
-            if not logarchiver.transfer_logs():
+            transfered = (logarchiver.conf.get('ARCHIVE_SERVER')
+                    and logarchiver.transfer_logs())
+            logarchiver.compress_logs()
+            if not transfered:
                 logarchiver.sleep()
 
             # write to stdout / stderr
@@ -76,7 +79,7 @@ def main():
     if pid_file is None:
         pid_file = conf.get("WPID_FILE", "/var/run/beaker-lab-controller/beaker-transfer.pid")
 
-    if not conf.get('ARCHIVE_SERVER'):
+    if not conf.get('ARCHIVE_SERVER') and not conf.get('LOG_COMPRESS_AGE'):
         sys.stderr.write('Archive server settings are missing from config file\n')
         sys.exit(1)
     # HubProxy will try to log some stuff, even though we 
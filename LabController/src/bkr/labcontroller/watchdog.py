@@ -18,6 +18,7 @@
 from optparse import OptionParser
 import gevent, gevent.hub, gevent.event, gevent.monkey
 from bkr.labcontroller.proxy import ProxyHelper, Monitor
+from bkr.labcontroller.inotify import ConsoleLogWatcher
 from bkr.labcontroller.config import load_conf, get_conf
 from bkr.log import log_to_stream, log_to_syslog
 
@@ -30,6 +31,15 @@
 # For each active watchdog, we also run a separate greenlet which has its own
 # loop to watch the console log and upload it back to Beaker, and also check for
 # kernel panic messages and installation failure messages if requested.
+# Where possible the console log directory is watched with inotify, so those
+# greenlets sleep until their console is written to instead of polling it.
+#
+# Rather than fetching both lists in full each iteration, we keep a local copy
+# of the watchdogs which is updated with only the changes since the last poll
+# (recipes.tasks.watchdog_changes). Active watchdogs come from the local copy.
+# Expiry is worked out locally from the kill times as well, and only if some
+# recipe set appears to have expired do we ask Beaker for the expired list,
+# since Beaker also takes into account jobs which it has not finished updating.
 
 logger = logging.getLogger(__name__)
 
@@ -43,24 +53,122 @@ def shutdown_handler(signum, frame):
     shutting_down.set()
 
 def run_monitor(monitor):
-    while True:
-        updated = monitor.run()
-        # If the console was updated, yield and then check it again immediately.
-        # If the console was not updated, yield and then sleep for SLEEP_TIME.
-        if updated:
+    wake_monitor = lambda event: monitor.console_changed.set()
+    shutting_down.rawlink(wake_monitor)
+    try:
+        while True:
+            updated = monitor.run()
             if shutting_down.is_set():
                 break
-        else:
-            if shutting_down.wait(timeout=monitor.conf.get('SLEEP_TIME', 20)):
-                break
+            # If the console was updated, yield and then check it again immediately.
+            # If the console was not updated, sleep until it is written to
+            # (or for SLEEP_TIME, if it is not being watched with inotify).
+            if not updated:
+                monitor.console_changed.wait(timeout=monitor.conf.get('SLEEP_TIME', 20))
+                if shutting_down.is_set():
+                    break
+    finally:
+        shutting_down.unlink(wake_monitor)
+        monitor.close()
+
+class WatchdogState(object):
+    """
+    Local copy of the watchdogs for this lab controller, kept up to date with
+    the changes returned by recipes.tasks.watchdog_changes.
+    """
+
+    def __init__(self):
+        self.cursor = None
+        self.watchdogs = {} #: dict of (recipe id -> watchdog dict with deadline)
+
+    def update(self, result, now=None):
+        if now is None:
+            now = time.time()
+        if result['resync']:
+            self.watchdogs.clear()
+        for change in result['changes']:
+            recipe_id = change['recipe_id']
+            if change['kill_time'] is None:
+                self.watchdogs.pop(recipe_id, None)
+                continue
+            watchdog = self.watchdogs.get(recipe_id)
+            if watchdog is not None and watchdog['kill_time'] == change['kill_time']:
+                continue # repeated, keep the deadline we already have
+            watchdog = dict((key, change[key]) for key in ['recipe_id',
+                    'recipe_set_id', 'system', 'is_virt_recipe', 'kill_time'])
+            # Beaker tells us how long is left rather than the kill time
+            # itself, so that our clock does not need to agree with it.
+            watchdog['deadline'] = now + change['expires_in']
+            self.watchdogs[recipe_id] = watchdog
+        self.cursor = result['cursor']
+
+    def _active_recipe_sets(self, now):
+        return set(w['recipe_set_id'] for w in self.watchdogs.itervalues()
+                if w['deadline'] > now)
+
+    def active(self, now=None):
+        """
+        Returns the watchdogs for every recipe set which has any watchdog
+        which has not expired, like recipes.tasks.watchdogs('active').
+        """
+        if now is None:
+            now = time.time()
+        active_recipe_sets = self._active_recipe_sets(now)
+        return [w for w in self.watchdogs.itervalues()
+                if w['recipe_set_id'] in active_recipe_sets]
+
+    def any_expired(self, now=None):
+        if now is None:
+            now = time.time()
+        active_recipe_sets = self._active_recipe_sets(now)
+        return any(w['recipe_set_id'] not in active_recipe_sets
+                for w in self.watchdogs.itervalues())
+
 
 class Watchdog(ProxyHelper):
 
     def __init__(self, *args, **kwargs):
         super(Watchdog, self).__init__(*args, **kwargs)
         self.monitor_greenlets = {} #: dict of (recipe id -> greenlet which is monitoring its console log)
+        self.console_watcher = None
+        self.watchdog_state = WatchdogState()
+        #: False if the server does not support recipes.tasks.watchdog_changes
+        self.watchdog_changes_supported = True
+
+    def sync_watchdogs(self):
+        """
+        Fetches the changes since the last call into self.watchdog_state.
+        Returns False if the server does not support this.
+        """
+        if not self.watchdog_changes_supported:
+            return False
+        logger.debug('Polling for watchdog changes')
+        cursor = self.watchdog_state.cursor
+        try:
+            try:
+                result = self.hub.recipes.tasks.watchdog_changes(cursor)
+            except xmlrpclib.Fault as fault:
+                if 'not currently logged in' in fault.faultString:
+                    logger.debug('Session expired, re-authenticating')
+                    self.hub._login()
+                    result = self.hub.recipes.tasks.watchdog_changes(cursor)
+                else:
+                    raise
+        except xmlrpclib.Fault as fault:
+            if 'not implemented by this server' in fault.faultString:
+                logger.info('Server does not support watchdog changes, '
+                        'polling for full lists of watchdogs instead')
+                self.watchdog_changes_supported = False
+                return False
+            raise
+        if result['resync']:
+            logger.debug('Fetched all %d watchdogs', len(result['changes']))
+        self.watchdog_state.update(result)
+        return True
 
     def get_active_watchdogs(self):
+        if self.sync_watchdogs():
+            return self.watchdog_state.active()
         logger.debug('Polling for active watchdogs')
         try:
             return self.hub.recipes.tasks.watchdogs('active')
@@ -73,6 +181,8 @@ def get_active_watchdogs(self):
                 raise
 
     def get_expired_watchdogs(self):
+        if self.sync_watchdogs() and not self.watchdog_state.any_expired():
+            return []
         logger.debug('Polling for expired watchdogs')
         try:
             return self.hub.recipes.tasks.watchdogs('expired')
@@ -122,8 +232,17 @@ def abort(self, recipe_id, system):
                     return
         self.recipe_stop(recipe_id, 'abort', 'External Watchdog Expired')
 
+    def start_console_watcher(self):
+        if not self.conf.get('CONSOLE_INOTIFY', True):
+            return
+        if self.console_watcher is None:
+            self.console_watcher = ConsoleLogWatcher(self.conf['CONSOLE_LOGS'])
+        # If this fails (for example, the directory does not exist yet) the
+        # monitors poll instead, and we try again next time.
+        self.console_watcher.start()
+
     def spawn_monitor(self, watchdog):
-        monitor = Monitor(watchdog, self)
+        monitor = Monitor(watchdog, self, console_watcher=self.console_watcher)
         greenlet = gevent.spawn(run_monitor, monitor)
         self.monitor_greenlets[watchdog['recipe_id']] = greenlet
         def completion_callback(greenlet):
@@ -134,6 +253,7 @@ def completion_callback(greenlet):
         greenlet.link(completion_callback)
 
     def poll(self):
+        self.start_console_watcher()
         for expired_watchdog in self.get_expired_watchdogs():
             try:
                 recipe_id = expired_watchdog['recipe_id']
@@ -0,0 +1,41 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Add watchdog_change table
+
+Revision ID: 3c5510511fd9
+Revises: 4b3a6065eba2
+Create Date: 2026-10-18 09:12:40.118305
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '3c5510511fd9'
+down_revision = '4b3a6065eba2'
+
+
+def upgrade():
+    op.create_table('watchdog_change',
+        sa.Column('id', sa.Integer, nullable=False, primary_key=True),
+        sa.Column('lab_controller_id', sa.Integer, sa.ForeignKey('lab_controller.id',
+            name='watchdog_change_lab_controller_id_fk', ondelete='CASCADE'),
+            nullable=False),
+        sa.Column('recipe_id', sa.Integer, sa.ForeignKey('recipe.id',
+            name='watchdog_change_recipe_id_fk', ondelete='CASCADE'),
+            nullable=False),
+        sa.Column('kill_time', sa.DateTime),
+        sa.Column('created', sa.DateTime, nullable=False),
+        mysql_engine='InnoDB'
+    )
+    op.create_index('ix_watchdog_change_lab_controller_id_id', 'watchdog_change',
+            ['lab_controller_id', 'id'])
+    op.create_index('ix_watchdog_change_created', 'watchdog_change', ['created'])
+
+
+def downgrade():
+    op.drop_table('watchdog_change')
@@ -0,0 +1,175 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+In-memory index of queued recipes and their candidate systems, used by beakerd
+to pick the next recipe for a system which has become free without running
+the full MachineRecipe.runnable_on_system() query.
+
+The index is only a hint. Every recipe it returns must still be verified
+against the database before it is scheduled, because other processes (the web
+application, lab controllers importing distros) can change the underlying
+rows at any time. Beakerd keeps it current from its own state transitions and
+rebuilds it periodically to pick up everything else.
+"""
+
+import logging
+import threading
+import time
+from collections import defaultdict
+from sqlalchemy.sql import not_
+from turbogears.database import session
+from bkr.server.model import Recipe, RecipeSet, Job, TaskStatus, TaskPriority
+from bkr.server.model.scheduler import system_recipe_map
+
+log = logging.getLogger(__name__)
+
+
+class _IndexedRecipe(object):
+
+    __slots__ = ['id', 'sort_key', 'lab_controller_id', 'owner_id', 'system_ids']
+
+    def __init__(self, id, sort_key, lab_controller_id, owner_id):
+        self.id = id
+        self.sort_key = sort_key
+        self.lab_controller_id = lab_controller_id
+        self.owner_id = owner_id
+        self.system_ids = set()
+
+
+class EligibilityIndex(object):
+    """
+    Bidirectional mapping of system id <-> queued recipe ids, built from
+    system_recipe_map.
+
+    Recipes are returned in the same effective priority order used by
+    schedule_pending_system:
+
+    * multi-host recipes with already scheduled siblings
+    * priority level (i.e Normal, High etc)
+    * recipe set id
+    * recipe id
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._recipes = {}
+        self._recipes_by_system = defaultdict(set)
+        self.last_rebuilt = None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._recipes)
+
+    @staticmethod
+    def _sort_key(recipe_id, recipeset_id, priority, lab_controller_id):
+        return (lab_controller_id is None, -TaskPriority.index(priority),
+                recipeset_id, recipe_id)
+
+    @staticmethod
+    def _query():
+        return session.query(system_recipe_map.c.system_id, Recipe.id,
+                    RecipeSet.id, RecipeSet.priority, RecipeSet.lab_controller_id,
+                    Job.owner_id)\
+                .select_from(system_recipe_map)\
+                .join(Recipe, Recipe.id == system_recipe_map.c.recipe_id)\
+                .join(Recipe.recipeset).join(RecipeSet.job)\
+                .filter(not_(Job.is_deleted))\
+                .filter(Recipe.status == TaskStatus.queued)
+
+    def _load_rows(self, rows):
+        for system_id, recipe_id, recipeset_id, priority, lab_controller_id, \
+                owner_id in rows:
+            entry = self._recipes.get(recipe_id)
+            if entry is None:
+                entry = self._recipes[recipe_id] = _IndexedRecipe(recipe_id,
+                        self._sort_key(recipe_id, recipeset_id, priority,
+                            lab_controller_id),
+                        lab_controller_id, owner_id)
+            entry.system_ids.add(system_id)
+            self._recipes_by_system[system_id].add(recipe_id)
+
+    def _remove(self, recipe_id):
+        entry = self._recipes.pop(recipe_id, None)
+        if entry is None:
+            return
+        for system_id in entry.system_ids:
+            recipe_ids = self._recipes_by_system.get(system_id)
+            if recipe_ids is not None:
+                recipe_ids.discard(recipe_id)
+                if not recipe_ids:
+                    del self._recipes_by_system[system_id]
+
+    def rebuild(self):
+        """
+        Discards the current contents and reloads every queued recipe and its
+        candidate systems from the database. Must be called inside
+        a transaction.
+        """
+        start = time.time()
+        rows = self._query().all()
+        with self._lock:
+            self._recipes = {}
+            self._recipes_by_system = defaultdict(set)
+            self._load_rows(rows)
+            self.last_rebuilt = time.time()
+            log.debug('Rebuilt eligibility index with %d recipes on %d systems '
+                    'in %0.2f seconds', len(self._recipes),
+                    len(self._recipes_by_system), self.last_rebuilt - start)
+
+    def needs_rebuild(self, interval):
+        return (self.last_rebuilt is None
+                or time.time() - self.last_rebuilt >= interval)
+
+    def refresh_recipesets(self, recipeset_ids):
+        """
+        Reloads the recipes belonging to the given recipe sets. Called after
+        beakerd has committed a state transition affecting them (queued,
+        scheduled, aborted, locked to a lab). Must be called inside
+        a transaction.
+        """
+        if not recipeset_ids:
+            return
+        recipeset_ids = list(recipeset_ids)
+        recipe_ids = [recipe_id for recipe_id, in
+                session.query(Recipe.id).filter(Recipe.recipe_set_id.in_(recipeset_ids))]
+        rows = self._query().filter(RecipeSet.id.in_(recipeset_ids)).all()
+        with self._lock:
+            for recipe_id in recipe_ids:
+                self._remove(recipe_id)
+            self._load_rows(rows)
+
+    def discard_recipe(self, recipe_id):
+        with self._lock:
+            self._remove(recipe_id)
+
+    def discard_candidate(self, recipe_id, system_id):
+        with self._lock:
+            entry = self._recipes.get(recipe_id)
+            if entry is not None:
+                entry.system_ids.discard(system_id)
+            recipe_ids = self._recipes_by_system.get(system_id)
+            if recipe_ids is not None:
+                recipe_ids.discard(recipe_id)
+                if not recipe_ids:
+                    del self._recipes_by_system[system_id]
+
+    def candidate_recipe_ids(self, system):
+        """
+        Returns the ids of queued recipes which may be runnable on the given
+        system, in effective priority order. Lab controller locks and loans
+        are checked here; everything else is left to the caller.
+        """
+        lab_controller_id = system.lab_controller_id
+        loaned_id = system.loan_id
+        with self._lock:
+            entries = [self._recipes[recipe_id] for recipe_id
+                    in self._recipes_by_system.get(system.id, ())]
+        entries = [entry for entry in entries
+                if (entry.lab_controller_id is None
+                    or entry.lab_controller_id == lab_controller_id)
+                and (loaned_id is None or entry.owner_id == loaned_id)]
+        entries.sort(key=lambda entry: entry.sort_key)
+        return [entry.id for entry in entries]
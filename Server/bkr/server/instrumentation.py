@@ -0,0 +1,115 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Timing of blocks of code along with the SQL statements they issue, used by
+beakerd to report where each pass of the scheduler spends its time.
+
+Timers are kept in a per-thread stack. Every statement executed by a thread
+is counted towards all the timers in its stack, so the statements issued
+while processing one item are counted for that item as well as for the phase
+which is processing it.
+"""
+
+import time
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_CONNECTION_INFO_KEY = 'instrumentation_statement_start'
+
+_local = threading.local()
+
+
+class Timer(object):
+
+    def __init__(self, name, item_id=None):
+        self.name = name
+        self.item_id = item_id
+        self.elapsed = 0.0
+        self.statements = 0
+        self.statement_time = 0.0
+        #: Finished timers which were nested inside this one, by name.
+        self.children = defaultdict(list)
+        # Worker threads may be counting statements towards the same timer.
+        self._lock = threading.Lock()
+
+    def _record_statement(self, duration):
+        with self._lock:
+            self.statements += 1
+            self.statement_time += duration
+
+    def _record_child(self, timer):
+        with self._lock:
+            self.children[timer.name].append(timer)
+
+
+def _active_timers():
+    try:
+        return _local.timers
+    except AttributeError:
+        _local.timers = []
+        return _local.timers
+
+def current_timer():
+    """
+    Returns the innermost timer running in this thread, or None.
+    """
+    timers = _active_timers()
+    return timers[-1] if timers else None
+
+@contextmanager
+def timed(name, item_id=None):
+    """
+    Times the enclosed block, yielding a Timer which is filled in when the
+    block exits. If another timer is already running in this thread, the new
+    one is added to its children.
+    """
+    timers = _active_timers()
+    parent = timers[-1] if timers else None
+    timer = Timer(name, item_id)
+    timers.append(timer)
+    start = time.time()
+    try:
+        yield timer
+    finally:
+        timer.elapsed = time.time() - start
+        timers.pop()
+        if parent is not None:
+            parent._record_child(timer)
+
+@contextmanager
+def attributed_to(timer):
+    """
+    Counts statements issued by this thread towards the given timer (which
+    was started in some other thread) for the duration of the block.
+    """
+    timers = _active_timers()
+    if timer is None or timer in timers:
+        yield
+        return
+    timers.append(timer)
+    try:
+        yield
+    finally:
+        timers.remove(timer)
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+        executemany):
+    if _active_timers():
+        conn.info[_CONNECTION_INFO_KEY] = time.time()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+        executemany):
+    start = conn.info.pop(_CONNECTION_INFO_KEY, None)
+    if start is None:
+        return
+    duration = time.time() - start
+    for timer in _active_timers():
+        timer._record_statement(duration)
@@ -461,6 +461,91 @@ def get_queued_command_details(self):
             result.append(d)
         return result
 
+    @cherrypy.expose
+    @identity.require(identity.in_group('lab_controller'))
+    def has_new_queued_commands(self, known_command_ids):
+        """
+        Checks whether :meth:`get_queued_command_details` would return any
+        commands other than those given in *known_command_ids* (which the lab
+        controller is already handling). This is much cheaper than fetching
+        the command details, so lab controllers can call it between polls.
+
+        :param known_command_ids: list of command IDs to ignore
+        :returns: True if there are new queued commands
+
+        .. versionadded:: 29
+        """
+        lab_controller = identity.current.user.lab_controller
+        known_command_ids = set(int(id) for id in known_command_ids)
+        max_running_commands = config.get('beaker.max_running_commands')
+        if max_running_commands:
+            running_commands = Command.query\
+                    .join(Command.system)\
+                    .filter(System.lab_controller == lab_controller)\
+                    .filter(Command.status == CommandStatus.running)\
+                    .count()
+            if running_commands >= max_running_commands:
+                return False
+        query = session.query(Command.id)\
+                .join(Command.system)\
+                .filter(System.lab_controller == lab_controller)\
+                .filter(Command.status == CommandStatus.queued)\
+                .order_by(Command.id)
+        if max_running_commands:
+            query = query.limit(max_running_commands - running_commands)
+            return any(id not in known_command_ids for id, in query)
+        if known_command_ids:
+            query = query.filter(~Command.id.in_(known_command_ids))
+        return query.first() is not None
+
+    @cherrypy.expose
+    @identity.require(identity.in_group('lab_controller'))
+    def mark_commands(self, updates):
+        """
+        Updates the status of a batch of commands, as if
+        :meth:`mark_command_running`, :meth:`mark_command_completed`,
+        :meth:`mark_command_failed` or :meth:`mark_command_aborted` had been
+        called for each one in order.
+
+        :param updates: list of dicts, each with the command ``id``, its new
+            ``status`` (``'running'``, ``'completed'``, ``'failed'`` or
+            ``'aborted'``) and optionally a ``message``, and
+            ``system_broken`` for failed commands. Finished power commands
+            may also give ``power_queue_wait`` and ``power_runtime`` (in
+            seconds) and ``power_attempts``, which are recorded as metrics.
+        :returns: list with an entry for each update, in the same order, which
+            is the error message if the update failed or else an empty string
+
+        .. versionadded:: 29
+        """
+        outcomes = []
+        for update in updates:
+            try:
+                if Command.query.get(update['id']) is None:
+                    raise ValueError('Invalid command ID: %s' % update['id'])
+                status = update['status']
+                if status == u'running':
+                    self.mark_command_running(update['id'])
+                elif status == u'completed':
+                    self.mark_command_completed(update['id'])
+                elif status == u'failed':
+                    self.mark_command_failed(update['id'], update.get('message'),
+                            update.get('system_broken', True))
+                elif status == u'aborted':
+                    self.mark_command_aborted(update['id'], update.get('message'))
+                else:
+                    raise ValueError('Invalid command status: %s' % status)
+                if 'power_runtime' in update:
+                    Command.query.get(update['id']).record_power_timings(
+                            update.get('power_queue_wait', 0),
+                            update['power_runtime'],
+                            update.get('power_attempts', 1))
+            except (ValueError, KeyError), e:
+                outcomes.append(unicode(e))
+            else:
+                outcomes.append(u'')
+        return outcomes
+
     @cherrypy.expose
     def get_installation_for_system(self, fqdn):
         system = System.by_fqdn(fqdn, identity.current.user)
@@ -0,0 +1,162 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Bipartite matching, used by the scheduler to decide whether the recipes in
+a multi-host recipe set can all be given distinct systems in a lab.
+
+Graphs are given as a dict mapping each left vertex (recipe) to an iterable of
+right vertices (systems).
+"""
+
+from collections import deque, OrderedDict
+
+
+def maximum_matching(graph):
+    """
+    Finds a maximum matching using the Hopcroft-Karp algorithm. Returns a dict
+    mapping each matched left vertex to its right vertex.
+
+    Left vertices are tried in the order they appear in the graph, so if it is
+    an OrderedDict the vertices which are left unmatched (when not all of them
+    can be) are predictable.
+    """
+    graph = OrderedDict((left, list(rights)) for left, rights in graph.iteritems())
+    match_left = {}
+    match_right = {}
+
+    def augment(left, dist):
+        for right in graph[left]:
+            other = match_right.get(right)
+            if other is None or (dist.get(other) == dist[left] + 1
+                                 and augment(other, dist)):
+                match_left[left] = right
+                match_right[right] = left
+                return True
+        # No augmenting path through here, don't try it again in this phase.
+        dist[left] = None
+        return False
+
+    while True:
+        # Breadth-first search from the free left vertices to layer the graph.
+        dist = {}
+        queue = deque()
+        for left in graph:
+            if left not in match_left:
+                dist[left] = 0
+                queue.append(left)
+        found_free_right = False
+        while queue:
+            left = queue.popleft()
+            for right in graph[left]:
+                other = match_right.get(right)
+                if other is None:
+                    found_free_right = True
+                elif other not in dist:
+                    dist[other] = dist[left] + 1
+                    queue.append(other)
+        if not found_free_right:
+            break
+        augmented = False
+        for left in graph:
+            if left not in match_left and augment(left, dist):
+                augmented = True
+        if not augmented:
+            break
+    return match_left
+
+
+def _strongly_connected_components(nodes, edges):
+    """
+    Tarjan's algorithm, without recursion. Returns a dict mapping each node to
+    a component number.
+    """
+    index = {}
+    lowlink = {}
+    component = {}
+    stack = []
+    on_stack = set()
+    counter = 0
+    for root in nodes:
+        if root in index:
+            continue
+        work = [(root, iter(edges.get(root, ())))]
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in index:
+                    index[child] = lowlink[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(edges.get(child, ()))))
+                    break
+                elif child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component[member] = index[node]
+                        if member == node:
+                            break
+    return component
+
+
+def usable_edges(graph, matching):
+    """
+    Given a matching which covers every left vertex in the graph (as returned
+    by maximum_matching() when one exists), returns the set of (left, right)
+    edges which appear in at least one such matching. Every other edge can be
+    removed without making the graph any less matchable.
+    """
+    assert len(matching) == len(graph)
+    match_right = dict((right, left) for left, right in matching.iteritems())
+    # Alternating graph: unmatched edges go left -> right, matched edges go
+    # right -> left. Vertices are tagged because the two sides may share ids.
+    edges = {}
+    reverse_edges = {}
+    nodes = []
+    for left, rights in graph.iteritems():
+        nodes.append(('L', left))
+        for right in rights:
+            if matching[left] == right:
+                src, dst = ('R', right), ('L', left)
+            else:
+                src, dst = ('L', left), ('R', right)
+            edges.setdefault(src, []).append(dst)
+            reverse_edges.setdefault(dst, []).append(src)
+    rights = set(right for rights in graph.itervalues() for right in rights)
+    nodes.extend(('R', right) for right in rights)
+
+    # An unmatched edge (left, right) can be swapped in if right can reach
+    # a free right vertex, or can reach back to left (an alternating cycle).
+    reaches_free = set(('R', right) for right in rights if right not in match_right)
+    queue = deque(reaches_free)
+    while queue:
+        node = queue.popleft()
+        for src in reverse_edges.get(node, ()):
+            if src not in reaches_free:
+                reaches_free.add(src)
+                queue.append(src)
+    component = _strongly_connected_components(nodes, edges)
+
+    usable = set()
+    for left, rights in graph.iteritems():
+        for right in rights:
+            if (matching[left] == right
+                    or ('R', right) in reaches_free
+                    or component[('R', right)] == component[('L', left)]):
+                usable.add((left, right))
+    return usable
@@ -1,4 +1,3 @@
-
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
 # the Free Software Foundation; either version 2 of the License, or
@@ -6,28 +5,150 @@
 
 """
 Routines for sending Beaker metrics to Graphite.
+
+Metrics are aggregated in memory, in the same way as statsd, and sent to
+carbon in batches every carbon.flush_interval seconds:
+
+* counters passed to increment() are summed
+* gauges passed to measure() keep their latest value
+* values passed to timing() or measure_distribution() are summarised as
+  name.count, name.mean, name.median, name.upper_90 and name.upper
 """
 
+import math
 import socket
+import struct
+import cPickle as pickle
 import time
+import atexit
 import logging
+import threading
+from collections import defaultdict
 from turbogears import config
 
 log = logging.getLogger(__name__)
 
 class CarbonSender(object):
+    """
+    Sends batches of metrics to carbon using the plaintext protocol over UDP
+    (the default) or TCP, or using the pickle protocol over TCP.
+    """
+
+    # Keep datagrams under a typical MTU so they are not fragmented.
+    max_datagram_size = 1400
+    # Carbon refuses pickles which are too large, so send them in chunks.
+    max_pickle_batch = 500
 
-    def __init__(self, address, prefix):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    def __init__(self, address, prefix, protocol='udp'):
+        if protocol not in ('udp', 'tcp', 'pickle'):
+            raise ValueError('Unrecognised carbon protocol %r' % protocol)
         self.address = address
         self.prefix = prefix
+        self.protocol = protocol
+        self.sock = None
+        if protocol == 'udp':
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
     def send(self, name, value, timestamp):
+        self.send_many([(name, value, timestamp)])
+
+    def send_many(self, metrics):
+        if not metrics:
+            return
         try:
-            msg = '%s%s %s %s' % (self.prefix, name, value, timestamp)
-            self.sock.sendto(msg, self.address)
+            if self.protocol == 'udp':
+                self._send_datagrams(metrics)
+            elif self.protocol == 'tcp':
+                self._send_stream(''.join(self._line(*metric) for metric in metrics))
+            else:
+                self._send_stream(''.join(self._pickled(metrics[i:i + self.max_pickle_batch])
+                        for i in range(0, len(metrics), self.max_pickle_batch)))
         except socket.error:
             log.exception('Error writing to carbon')
+            if self.protocol != 'udp':
+                # Reconnect for the next batch.
+                self.close()
+
+    def _line(self, name, value, timestamp):
+        return '%s%s %s %s\n' % (self.prefix, name, value, timestamp)
+
+    def _pickled(self, metrics):
+        payload = pickle.dumps([('%s%s' % (self.prefix, name), (timestamp, value))
+                for name, value, timestamp in metrics], protocol=2)
+        return struct.pack('!L', len(payload)) + payload
+
+    def _send_datagrams(self, metrics):
+        datagram = ''
+        for metric in metrics:
+            line = self._line(*metric)
+            if datagram and len(datagram) + len(line) > self.max_datagram_size:
+                self.sock.sendto(datagram, self.address)
+                datagram = ''
+            datagram += line
+        if datagram:
+            self.sock.sendto(datagram, self.address)
+
+    def _send_stream(self, data):
+        if self.sock is None:
+            self.sock = socket.create_connection(self.address, timeout=10)
+        self.sock.sendall(data)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class MetricsBuffer(object):
+    """
+    Aggregates metrics between flushes. Safe to use from multiple threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+        self._gauges = {}
+        self._timings = defaultdict(list)
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def timing(self, name, values):
+        with self._lock:
+            self._timings[name].extend(values)
+
+    def drain(self, timestamp):
+        """
+        Returns a list of (name, value, timestamp) for everything recorded
+        since the last call, and resets the buffer.
+        """
+        with self._lock:
+            counters, self._counters = self._counters, defaultdict(int)
+            gauges, self._gauges = self._gauges, {}
+            timings, self._timings = self._timings, defaultdict(list)
+        metrics = []
+        for name, value in counters.iteritems():
+            metrics.append((name, value, timestamp))
+        for name, value in gauges.iteritems():
+            metrics.append((name, value, timestamp))
+        for name, values in timings.iteritems():
+            if not values:
+                continue
+            values.sort()
+            count = len(values)
+            metrics.extend([
+                ('%s.count' % name, count, timestamp),
+                ('%s.mean' % name, sum(values) / float(count), timestamp),
+                ('%s.median' % name, values[(count - 1) // 2], timestamp),
+                ('%s.upper_90' % name, values[int(math.ceil(count * 0.9)) - 1], timestamp),
+                ('%s.upper' % name, values[-1], timestamp),
+            ])
+        return metrics
 
 _carbon = None
 def get_carbon():
@@ -35,19 +156,77 @@ def get_carbon():
     if _carbon is not None:
         return _carbon
     _carbon = CarbonSender(config.get('carbon.address'),
-            config.get('carbon.prefix', 'beaker.'))
+            config.get('carbon.prefix', 'beaker.'),
+            config.get('carbon.protocol', 'udp'))
     return _carbon
 
-def increment(name):
+_buffer = MetricsBuffer()
+_flush_thread = None
+_flush_thread_lock = threading.Lock()
+# Held while sending, so that batches sent over TCP are not interleaved.
+_send_lock = threading.Lock()
+
+def _flush_loop():
+    while True:
+        time.sleep(config.get('carbon.flush_interval', 10))
+        try:
+            flush()
+        except Exception:
+            log.exception('Error flushing metrics')
+
+def _get_buffer():
+    # The flush thread is started on first use, so that it is running in
+    # whichever process (after any forking) is recording metrics.
+    global _flush_thread
+    if _flush_thread is None:
+        with _flush_thread_lock:
+            if _flush_thread is None:
+                thread = threading.Thread(target=_flush_loop, name='metrics-flush')
+                thread.daemon = True
+                thread.start()
+                _flush_thread = thread
+    return _buffer
+
+def flush():
+    """
+    Sends everything recorded since the last flush to carbon. This happens
+    periodically in the background, but can be called to send metrics
+    immediately (for example after a batch of gauges has been measured).
+    """
     if not config.get('carbon.address'):
         return
-    carbon = get_carbon()
-    carbon.send(name, 1, int(time.time()))
+    with _send_lock:
+        get_carbon().send_many(_buffer.drain(int(time.time())))
+
+atexit.register(flush)
+
+def increment(name, value=1):
+    if not config.get('carbon.address'):
+        return
+    _get_buffer().increment(name, value)
 
 def measure(name, value):
     if not config.get('carbon.address'):
         return
     if not isinstance(value, (long, int, float)):
         raise TypeError('value %r should be a number' % value)
-    carbon = get_carbon()
-    carbon.send(name, value, int(time.time()))
+    _get_buffer().gauge(name, value)
+
+def timing(name, value):
+    """
+    Records one value (for example, the duration of a request) for the
+    summary statistics sent at the next flush.
+    """
+    measure_distribution(name, [value])
+
+def measure_distribution(name, values):
+    """
+    Records a batch of values (for example, the time taken by each item
+    handled in one pass of a loop) for the summary statistics sent at the
+    next flush.
+    """
+    if not config.get('carbon.address'):
+        return
+    if not values:
+        return
+    _get_buffer().timing(name, values)
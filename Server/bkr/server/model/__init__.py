@@ -39,7 +39,7 @@
         SystemAccessPolicy, SystemAccessPolicyRule, Reservation,
         SystemActivity, Command, SystemPool, SystemPoolActivity)
 from .installation import Installation, RenderedKickstart
-from .scheduler import (Watchdog, TaskBase, Job, RecipeSet, Recipe,
+from .scheduler import (Watchdog, WatchdogChange, TaskBase, Job, RecipeSet, Recipe,
         RecipeTaskResult, MachineRecipe, GuestRecipe, RecipeTask, Log,
         LogRecipe, LogRecipeTask, LogRecipeTaskResult, JobCc, RecipeResource,
         SystemResource, GuestResource, VirtResource, RetentionTag,
@@ -28,7 +28,7 @@
 from turbogears import url, config
 from turbogears.config import get
 from turbogears.database import session
-from bkr.server import identity, metrics, mail
+from bkr.server import identity, metrics, mail, wakeup
 from bkr.server.bexceptions import (BX, InsufficientSystemPermissions,
         StaleCommandStatusException, StaleSystemUserException)
 from bkr.server.helpers import make_link
@@ -134,6 +134,33 @@ def init_group_stats():
             result[group][status.name] = count
         return result
 
+    @classmethod
+    def get_queue_stats_by_groups(cls, groupings, query):
+        """
+        Equivalent to get_queue_stats() followed by get_queue_stats_by_group()
+        for each of the given groupings (a dict of name -> column), but using
+        a single query. Commands for which a grouping column is NULL are left
+        out of that grouping. Returns a tuple of (totals, dict of name ->
+        grouped stats).
+        """
+        active_statuses = [s for s in CommandStatus if not s.finished]
+        names = list(groupings)
+        columns = [groupings[name] for name in names]
+        query = query.filter(cls.status.in_(active_statuses))\
+                .group_by(cls.status, *columns)\
+                .with_entities(cls.status, *columns + [func.count(cls.id)])
+        def init_group_stats():
+            return dict((status.name, 0) for status in active_statuses)
+        totals = init_group_stats()
+        result = dict((name, defaultdict(init_group_stats)) for name in names)
+        for row in query:
+            status, groups, count = row[0], row[1:-1], row[-1]
+            totals[status.name] += count
+            for name, group in zip(names, groups):
+                if group is not None:
+                    result[name][group][status.name] += count
+        return totals, result
+
     def __json__(self):
         return {
             'id': self.id,
@@ -172,18 +199,36 @@ def change_status(self, new_status):
             self.finish_time = datetime.utcnow()
         # update metrics counters if command has finished
         if self.status.finished:
-            categories = ['all']
-            if self.system.lab_controller:
-                categories.append('by_lab.%s'
-                        % self.system.lab_controller.fqdn.replace('.', '_'))
-            if self.system.power and self.system.power.power_type:
-                categories.append('by_power_type.%s'
-                        % self.system.power.power_type.name)
-            categories.extend('by_arch.%s' % arch.arch for arch in self.system.arch)
-            for category in categories:
+            for category in self._metrics_categories():
                 metrics.increment('counters.system_commands_%s.%s'
                         % (self.status.name, category))
 
+    def _metrics_categories(self):
+        categories = ['all']
+        if self.system.lab_controller:
+            categories.append('by_lab.%s'
+                    % self.system.lab_controller.fqdn.replace('.', '_'))
+        if self.system.power and self.system.power.power_type:
+            categories.append('by_power_type.%s'
+                    % self.system.power.power_type.name)
+        categories.extend('by_arch.%s' % arch.arch for arch in self.system.arch)
+        return categories
+
+    def record_power_timings(self, queue_wait, runtime, attempts):
+        """
+        Records how long the lab controller waited before running the power
+        script for this command, how long the script ran for, and how many
+        times it was retried.
+        """
+        for category in self._metrics_categories():
+            metrics.timing('durations.power_command_queue_wait.%s' % category,
+                    queue_wait)
+            metrics.timing('durations.power_command_runtime.%s' % category,
+                    runtime)
+            if attempts > 1:
+                metrics.increment('counters.power_command_retries.%s' % category,
+                        attempts - 1)
+
     def log_to_system_history(self):
         self.system.record_activity(user=self.user, service=self.service,
                 action=self.action, field=u'Power', old=u'',
@@ -1909,6 +1954,7 @@ def mark_systems_pending_when_distro_tree_added_to_lab(distro_tree, lab_controll
                     .where(guestrecipe.c.distro_tree_id == distro_tree.id)
                     .where(system_recipe_map.c.system_id == System.id)))\
             .update(dict(scheduler_status=SystemSchedulerStatus.pending), synchronize_session=False)
+    wakeup.notify(wakeup.PENDING_SYSTEMS)
 
 system_pool_map = Table('system_pool_map', DeclarativeMappedObject.metadata,
         Column('system_id', Integer,
@@ -31,8 +31,9 @@
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.orm import (relationship, object_mapper,
                             dynamic_loader, validates, synonym, contains_eager, aliased)
+from sqlalchemy.orm.attributes import NO_VALUE, NEVER_SET
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy.sql import select, union, and_, or_, not_, func, literal, exists, delete
+from sqlalchemy.sql import select, union, and_, or_, not_, func, literal, exists, delete, false
 from turbogears import url
 from turbogears.config import get
 from turbogears.database import session
@@ -205,7 +206,7 @@ class Watchdog(DeclarativeMappedObject):
     __table_args__ = {'mysql_engine': 'InnoDB'}
     id = Column(Integer, autoincrement=True, primary_key=True)
     recipe_id = Column(Integer, ForeignKey('recipe.id'), nullable=False)
-    recipe = relationship('Recipe')
+    recipe = relationship('Recipe', back_populates='watchdog')
     recipetask_id = Column(Integer, ForeignKey('recipe_task.id'))
     recipetask = relationship('RecipeTask')
     subtask = Column(Unicode(255))
@@ -262,6 +263,54 @@ def __repr__(self):
                                                           self.id, self.recipe_id, self.kill_time)
 
 
+class WatchdogChange(DeclarativeMappedObject):
+    """
+    Records every change to a watchdog's kill time, and every watchdog which
+    is removed (with no kill time), so that beaker-watchdog can fetch only
+    the watchdogs which have changed since it last polled. Changes are only
+    kept for a limited time, see bkr.server.recipetasks.
+    """
+
+    __tablename__ = 'watchdog_change'
+    __table_args__ = (
+        Index('ix_watchdog_change_lab_controller_id_id', 'lab_controller_id', 'id'),
+        {'mysql_engine': 'InnoDB'}
+    )
+    id = Column(Integer, autoincrement=True, primary_key=True)
+    lab_controller_id = Column(Integer, ForeignKey('lab_controller.id',
+            name='watchdog_change_lab_controller_id_fk', ondelete='CASCADE'),
+            nullable=False)
+    lab_controller = relationship(LabController)
+    recipe_id = Column(Integer, ForeignKey('recipe.id',
+            name='watchdog_change_recipe_id_fk', ondelete='CASCADE'),
+            nullable=False)
+    recipe = relationship('Recipe')
+    kill_time = Column(DateTime)
+    created = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    @classmethod
+    def record(cls, recipe, kill_time):
+        lab_controller = recipe.recipeset.lab_controller
+        if lab_controller is None:
+            return
+        session.add(cls(lab_controller=lab_controller, recipe=recipe,
+                kill_time=kill_time))
+
+    def __repr__(self):
+        return '%s(id=%r, recipe_id=%r, kill_time=%r)' % (self.__class__.__name__,
+                                                          self.id, self.recipe_id, self.kill_time)
+
+
+# With active_history the old value is loaded first, so it is only missing
+# when a new watchdog is given its first kill time.
+@event.listens_for(Watchdog.kill_time, 'set', active_history=True)
+def record_watchdog_kill_time_change(watchdog, new_value, old_value, initiator):
+    if old_value in (NO_VALUE, NEVER_SET):
+        old_value = None
+    if new_value != old_value and watchdog.recipe is not None:
+        WatchdogChange.record(watchdog.recipe, new_value)
+
+
 class Log(DeclarativeMappedObject):
     __abstract__ = True
 
@@ -632,6 +681,39 @@ def t_id(self):
     t_id = property(t_id)
 
 
+class TaskSummary(object):
+    """
+    Task counts, minimum status and maximum result for the tasks in a recipe,
+    as used by Recipe._update_status(). See Recipe.summarize_tasks().
+    """
+
+    def __init__(self):
+        self.ntasks = 0
+        self.ptasks = 0
+        self.wtasks = 0
+        self.ftasks = 0
+        self.ktasks = 0
+        self.min_status = TaskStatus.max()
+        self.max_result = TaskResult.min()
+
+    def add(self, status, result, count=1):
+        if status.finished:
+            if result == TaskResult.pass_:
+                self.ptasks += count
+            elif result == TaskResult.warn:
+                self.wtasks += count
+            elif result == TaskResult.fail:
+                self.ftasks += count
+            elif result == TaskResult.panic:
+                self.ktasks += count
+            else:
+                self.ntasks += count
+        if status.severity < self.min_status.severity:
+            self.min_status = status
+        if result.severity > self.max_result.severity:
+            self.max_result = result
+
+
 class Job(TaskBase, ActivityMixin):
     """
     Container to hold like recipe sets.
@@ -1311,8 +1393,10 @@ def _update_status(self):
         self.ktasks = 0
         max_result = TaskResult.min()
         min_status = TaskStatus.max()
+        task_summaries = Recipe.summarize_tasks([recipe.id
+                for recipeset in self.recipesets for recipe in recipeset.recipes])
         for recipeset in self.recipesets:
-            recipeset._update_status()
+            recipeset._update_status(task_summaries)
             self.ntasks += recipeset.ntasks
             self.ptasks += recipeset.ptasks
             self.wtasks += recipeset.wtasks
@@ -1831,7 +1915,7 @@ def abort(self, msg=None):
     def is_dirty(self):
         return self.job.is_dirty
 
-    def _update_status(self):
+    def _update_status(self, task_summaries=None):
         """
         Update number of passes, failures, warns, panics..
         """
@@ -1842,8 +1926,10 @@ def _update_status(self):
         self.ktasks = 0
         max_result = TaskResult.min()
         min_status = TaskStatus.max()
+        if task_summaries is None:
+            task_summaries = Recipe.summarize_tasks([recipe.id for recipe in self.recipes])
         for recipe in self.recipes:
-            recipe._update_status()
+            recipe._update_status(task_summaries[recipe.id])
             self.ntasks += recipe.ntasks
             self.ptasks += recipe.ptasks
             self.wtasks += recipe.wtasks
@@ -2016,7 +2102,7 @@ class Recipe(TaskBase, ActivityMixin):
                          nullable=False, default=RecipeVirtStatus.possible)
     __mapper_args__ = {'polymorphic_on': type, 'polymorphic_identity': u'recipe'}
     resource = relationship('RecipeResource', uselist=False, back_populates='recipe')
-    watchdog = relationship(Watchdog, uselist=False,
+    watchdog = relationship(Watchdog, uselist=False, back_populates='recipe',
                             cascade='all, delete, delete-orphan')
     systems = relationship(System, secondary=system_recipe_map,
                            back_populates='queued_recipes')
@@ -2489,44 +2575,56 @@ def abort(self, msg=None):
     def is_dirty(self):
         return self.recipeset.job.is_dirty
 
-    def _update_status(self):
+    @classmethod
+    def summarize_tasks(cls, recipe_ids):
+        """
+        Returns a dict of recipe id -> TaskSummary for the given recipes,
+        computed with one grouped query rather than by loading every task.
+        """
+        summaries = defaultdict(TaskSummary)
+        if not recipe_ids:
+            return summaries
+        session.flush()
+        # Finished tasks whose result has not been computed yet. The result
+        # only needs computing once, so there are normally very few of these.
+        unresolved_tasks = RecipeTask.query\
+            .filter(RecipeTask.recipe_id.in_(recipe_ids))\
+            .filter(RecipeTask.is_finished())\
+            .filter(RecipeTask.result == TaskResult.new)
+        for task in unresolved_tasks:
+            task._update_status()
+            session.flush()
+        rows = session.query(RecipeTask.recipe_id, RecipeTask.status,
+                             RecipeTask.result, func.count(RecipeTask.id))\
+            .filter(RecipeTask.recipe_id.in_(recipe_ids))\
+            .group_by(RecipeTask.recipe_id, RecipeTask.status, RecipeTask.result)
+        for recipe_id, status, result, count in rows:
+            summaries[recipe_id].add(status, result, count)
+        return summaries
+
+    def _update_status(self, task_summary=None):
         """
         Update number of passes, failures, warns, panics..
         """
-        self.ntasks = 0
-        self.ptasks = 0
-        self.wtasks = 0
-        self.ftasks = 0
-        self.ktasks = 0
+        if task_summary is None:
+            task_summary = Recipe.summarize_tasks([self.id])[self.id]
+        self.ntasks = task_summary.ntasks
+        self.ptasks = task_summary.ptasks
+        self.wtasks = task_summary.wtasks
+        self.ftasks = task_summary.ftasks
+        self.ktasks = task_summary.ktasks
 
-        max_result = TaskResult.min()
-        min_status = TaskStatus.max()
+        max_result = task_summary.max_result
+        min_status = task_summary.min_status
 
         if self.installation \
                 and (self.installation.rebooted or self.installation.install_started) \
                 and not self.installation.postinstall_finished \
                 and not self.first_task.start_time \
                 and not self.first_task.is_finished():
-            min_status = TaskStatus.installing
+            if TaskStatus.installing.severity < min_status.severity:
+                min_status = TaskStatus.installing
 
-        # I think this loop could be replaced with some sql which would be more efficient.
-        for task in self.tasks:
-            task._update_status()
-            if task.is_finished():
-                if task.result == TaskResult.pass_:
-                    self.ptasks += 1
-                elif task.result == TaskResult.warn:
-                    self.wtasks += 1
-                elif task.result == TaskResult.fail:
-                    self.ftasks += 1
-                elif task.result == TaskResult.panic:
-                    self.ktasks += 1
-                else:
-                    self.ntasks += 1
-            if task.status.severity < min_status.severity:
-                min_status = task.status
-            if task.result.severity > max_result.severity:
-                max_result = task.result
         if self.status.finished and not min_status.finished:
             min_status = self._fix_zombie_tasks()
 
@@ -2734,6 +2832,8 @@ def cleanup(self):
         if self.resource:
             self.resource.release()
         if self.watchdog:
+            if self.watchdog.kill_time is not None:
+                WatchdogChange.record(self, None)
             session.delete(self.watchdog)
             self.watchdog = None
 
@@ -3230,6 +3330,38 @@ def init_group_stats():
             result[group][status.name] = count
         return result
 
+    @classmethod
+    def get_queue_stats_by_groups(cls, groupings, recipes=None):
+        """
+        Equivalent to get_queue_stats() followed by get_queue_stats_by_group()
+        for each of the given groupings (a dict of name -> column), but using
+        a single query. Recipes for which a grouping column is NULL are left
+        out of that grouping. Returns a tuple of (totals, dict of name ->
+        grouped stats).
+        """
+        if recipes is None:
+            recipes = cls.query
+        active_statuses = [s for s in TaskStatus if not s.finished]
+        names = list(groupings)
+        query = (recipes.with_entities(cls.status,
+                                       *[groupings[name] for name in names]
+                                       + [func.count(cls.id)])
+                 .filter(cls.status.in_(active_statuses))
+                 .group_by(cls.status, *[groupings[name] for name in names]))
+
+        def init_group_stats():
+            return dict((status.name, 0) for status in active_statuses)
+
+        totals = init_group_stats()
+        result = dict((name, defaultdict(init_group_stats)) for name in names)
+        for row in query:
+            status, groups, count = row[0], row[1:-1], row[-1]
+            totals[status.name] += count
+            for name, group in zip(names, groups):
+                if group is not None:
+                    result[name][group][status.name] += count
+        return totals, result
+
     def _get_distro_requires(self):
         return self._distro_requires
 
@@ -3250,11 +3382,18 @@ def candidate_systems(self, only_in_lab=True):
         systems = System.all(self.recipeset.job.owner)
         systems = systems.filter(System.can_reserve(self.recipeset.job.owner))
         # delayed import to avoid circular dependency
-        from bkr.server.needpropertyxml import XmlHost
+        from bkr.server.needpropertyxml import XmlHost, system_ids_cache_enabled
         host_filter = XmlHost.from_string(self.host_requires)
         if not host_filter.force:
-            systems = host_filter.apply_filter(systems). \
-                filter(System.status == SystemStatus.automated)
+            if system_ids_cache_enabled():
+                system_ids = host_filter.matching_system_ids()
+                if system_ids:
+                    systems = systems.filter(System.id.in_(system_ids))
+                else:
+                    systems = systems.filter(false())
+            else:
+                systems = host_filter.apply_filter(systems)
+            systems = systems.filter(System.status == SystemStatus.automated)
             systems = systems.filter(System.compatible_with_distro_tree(arch=self.installation.arch,
                                                                         osmajor=self.installation.osmajor,
                                                                         osminor=self.installation.osminor))
@@ -3267,6 +3406,51 @@ def candidate_systems(self, only_in_lab=True):
         systems = System.scheduler_ordering(self.recipeset.job.owner, query=systems)
         return systems
 
+    def candidate_systems_key(self):
+        """
+        Returns a hashable key covering every input to .candidate_systems().
+        Recipes which have the same key are guaranteed to have the same
+        candidate systems, so the query only needs to be evaluated once for
+        all of them.
+        """
+        # delayed import to avoid circular dependency
+        from bkr.server.needpropertyxml import canonical_xml
+        return (self.recipeset.job.owner_id,
+                canonical_xml(self.host_requires),
+                self.installation.arch_id,
+                self.installation.osmajor,
+                self.installation.osminor,
+                self.distro_tree_id)
+
+    @classmethod
+    def set_candidate_systems(cls, recipes, systems):
+        """
+        Replaces the candidate systems for all of the given recipes with the
+        systems matched by the given query, using a single INSERT...SELECT
+        instead of appending each system to recipe.systems in Python. If
+        *systems* is None the candidate systems are just cleared.
+
+        Returns the number of candidate systems for each recipe.
+        """
+        recipe_ids = [recipe.id for recipe in recipes]
+        if not recipe_ids:
+            return 0
+        connection = session.connection(cls)
+        connection.execute(delete(system_recipe_map)
+                           .where(system_recipe_map.c.recipe_id.in_(recipe_ids)))
+        for recipe in recipes:
+            session.expire(recipe, ['systems'])
+        if systems is None:
+            return 0
+        system_ids = systems.with_entities(System.id.label('system_id'))\
+            .order_by(None).distinct().subquery()
+        # Cartesian product of the matching systems with the recipes
+        matches = select([system_ids.c.system_id, Recipe.id])\
+            .where(Recipe.id.in_(recipe_ids))
+        result = connection.execute(system_recipe_map.insert().from_select(
+            ['system_id', 'recipe_id'], matches))
+        return result.rowcount // len(recipe_ids)
+
     @classmethod
     def hypothetical_candidate_systems(cls, user, distro_tree=None, lab_controller=None,
                                        force=False):
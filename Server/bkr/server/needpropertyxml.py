@@ -5,20 +5,28 @@
 # (at your option) any later version.
 
 import operator
+from itertools import chain
+import threading
+import time
+from collections import OrderedDict
 
 import datetime
 from lxml import etree
-from sqlalchemy import or_, and_, not_, exists, func
-from sqlalchemy.orm import aliased
+from sqlalchemy import or_, and_, not_, exists, func, event, inspect
+from sqlalchemy.orm import aliased, Session
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql import false
+from turbogears import config
 
+from bkr.server import metrics
 from bkr.server.model import (Arch, Distro, DistroTree, DistroTag,
                               OSMajor, OSVersion, SystemPool, System, User,
                               Key, Key_Value_Int, Key_Value_String,
                               LabController, LabControllerDistroTree,
                               Hypervisor, Cpu, CpuFlag, Numa, Device,
-                              DeviceClass, Disk, Power, PowerType)
+                              DeviceClass, Disk, Power, PowerType,
+                              SystemAccessPolicy, SystemAccessPolicyRule,
+                              ExcludeOSMajor, ExcludeOSVersion)
 
 
 # This follows the SI conventions used in disks and networks --
@@ -49,6 +57,17 @@ def get_dtrange(dt):
     return start_dt, end_dt
 
 
+def canonical_xml(xml_string):
+    """
+    Returns the canonical (C14N) serialization of the given XML fragment, with
+    insignificant whitespace removed. Two filters which differ only in
+    formatting or attribute order will produce the same string.
+    """
+    parser = etree.XMLParser(remove_blank_text=True)
+    root = etree.fromstring(xml_string, parser)
+    return etree.tostring(root, method='c14n')
+
+
 # Common special query processing specific to
 # System.date_added and System.date_lastcheckin
 def date_filter(col, op, value):
@@ -1310,10 +1329,23 @@ class XmlHost(XmlAnd):
     @classmethod
     def from_string(cls, xml_string):
         try:
-            return cls(etree.fromstring(xml_string))
+            return _compiled_filter(cls, xml_string)
         except etree.XMLSyntaxError as e:
             raise ValueError('Invalid XML syntax for host filter: %s' % e)
 
+    def matching_system_ids(self):
+        """
+        Returns the set of IDs of all systems matched by this filter, ignoring
+        visibility, access policies and system status. The result is cached
+        (keyed by the canonical XML) until the next inventory change, see
+        :func:`invalidate_system_ids_cache`.
+        """
+        key = etree.tostring(self.wrappedEl, method='c14n')
+        return _get_system_ids_cache().get_or_create(key,
+                lambda: frozenset(system_id for system_id, in
+                        self.apply_filter(System.query).values(System.id)),
+                'host_filter_system_ids')
+
     @property
     def force(self):
         """
@@ -1358,10 +1390,14 @@ class XmlDistro(XmlAnd):
         'distrolabcontroller': XmlDistroLabController,  # deprecated
     }
 
+    @classmethod
+    def from_string(cls, xml_string):
+        return _compiled_filter(cls, xml_string)
+
 
 def apply_distro_filter(filter, query):
     if isinstance(filter, basestring):
-        filter = XmlDistro(etree.fromstring(filter))
+        filter = XmlDistro.from_string(filter)
     clauses = []
     for child in filter:
         if callable(getattr(child, 'filter', None)):
@@ -1371,3 +1407,132 @@ def apply_distro_filter(filter, query):
     if clauses:
         query = query.filter(and_(*clauses))
     return query
+
+
+class _LRUCache(object):
+    """
+    Thread-safe LRU cache with an optional expiry time for entries.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict() #: key -> (value, time added)
+        self._lock = threading.Lock()
+
+    def get(self, key, metric_name=None):
+        """
+        Returns the cached value, or None. If *metric_name* is given, the hit
+        or miss is counted in Graphite.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and (not self.ttl
+                    or time.time() - entry[1] < self.ttl):
+                self._entries[key] = entry # move to the end
+                value = entry[0]
+            else:
+                value = None
+        if metric_name:
+            metrics.increment('counters.%s_cache_%s'
+                    % (metric_name, 'misses' if value is None else 'hits'))
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time())
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_create(self, key, create, metric_name=None):
+        value = self.get(key, metric_name)
+        if value is None:
+            value = create()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Parsed XmlHost/XmlDistro trees are never modified after they are created, so
+# it is safe for all threads to share them.
+_filter_cache = None
+def _get_filter_cache():
+    global _filter_cache
+    if _filter_cache is None:
+        _filter_cache = _LRUCache(config.get('beaker.host_filter_cache_size', 1000))
+    return _filter_cache
+
+
+def _compiled_filter(cls, xml_string):
+    cache = _get_filter_cache()
+    # Look up by the exact string first, to avoid parsing it at all in the
+    # common case of the same hostRequires being evaluated over and over.
+    compiled = cache.get((cls, xml_string), 'host_filter')
+    if compiled is None:
+        canonical = canonical_xml(xml_string)
+        compiled = cache.get_or_create((cls, canonical),
+                lambda: cls(etree.fromstring(canonical)))
+        cache.put((cls, xml_string), compiled)
+    return compiled
+
+
+# The second level cache of matching system IDs is disabled unless
+# beaker.host_filter_system_ids_ttl is set. Inventory changes made in this
+# process invalidate it immediately, changes made by other processes (for
+# example, the web application when beakerd is using the cache) are only
+# picked up when the entries expire.
+_system_ids_cache = None
+def _get_system_ids_cache():
+    global _system_ids_cache
+    if _system_ids_cache is None:
+        _system_ids_cache = _LRUCache(config.get('beaker.host_filter_cache_size', 1000),
+                ttl=config.get('beaker.host_filter_system_ids_ttl', 0))
+    return _system_ids_cache
+
+
+def system_ids_cache_enabled():
+    return bool(_get_system_ids_cache().ttl)
+
+
+def invalidate_system_ids_cache():
+    if _system_ids_cache is not None:
+        _system_ids_cache.clear()
+
+
+# Changes to any of these can affect which systems a host filter matches.
+_inventory_classes = (System, Cpu, CpuFlag, Numa, Device, Disk, Hypervisor,
+                      Power, Key_Value_Int, Key_Value_String, SystemPool,
+                      SystemAccessPolicy, SystemAccessPolicyRule,
+                      ExcludeOSMajor, ExcludeOSVersion, LabController)
+# System attributes which change often but are not used by host filters.
+_ignored_system_attrs = frozenset(['scheduler_status', 'date_modified',
+                                   'queued_recipes', 'dyn_queued_recipes',
+                                   'activity', 'dyn_activity',
+                                   'status_durations', 'reservations',
+                                   'dyn_reservations', 'command_queue',
+                                   'dyn_command_queue', 'installations',
+                                   'provisions', 'notes', 'dyn_notes'])
+
+
+def _affects_host_filters(obj):
+    if not isinstance(obj, _inventory_classes):
+        return False
+    if isinstance(obj, System):
+        state = inspect(obj)
+        return any(attr.history.has_changes() for attr in state.attrs
+                   if attr.key not in _ignored_system_attrs)
+    return True
+
+
+@event.listens_for(Session, 'before_flush')
+def _invalidate_system_ids_on_inventory_change(session, flush_context, instances):
+    if not system_ids_cache_enabled():
+        return
+    if (any(isinstance(obj, _inventory_classes)
+            for obj in chain(session.new, session.deleted))
+            or any(_affects_host_filters(obj) for obj in session.dirty)):
+        invalidate_system_ids_cache()
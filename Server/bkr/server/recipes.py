@@ -29,7 +29,8 @@
 import cherrypy
 
 from bkr.server.model import (Recipe, RecipeSet, TaskStatus, Job, System,
-                              MachineRecipe, SystemResource, VirtResource,
+                              MachineRecipe, RecipeTask, RecipeTaskResult,
+                              SystemResource, VirtResource,
                               LogRecipe, LogRecipeTask, LogRecipeTaskResult,
                               RecipeResource, TaskBase, RecipeReservationRequest,
                               RecipeReservationCondition)
@@ -44,6 +45,17 @@
 import lxml.etree
 logger = logging.getLogger(__name__)
 
+def _parse_id(id):
+    # Returns None for ids which are not numbers, so that they are reported
+    # the same way as ids which do not exist.
+    try:
+        return int(id)
+    except (TypeError, ValueError):
+        return None
+
+def _lookup_by_id(objects, id):
+    return objects.get(_parse_id(id))
+
 class Recipes(RPCRoot):
     # For XMLRPC methods in this class.
     exposed = True
@@ -68,7 +80,7 @@ class Recipes(RPCRoot):
 
     @cherrypy.expose
     @identity.require(identity.not_anonymous())
-    def by_log_server(self, server, limit=50):
+    def by_log_server(self, server, limit=50, after=None):
         """
         Returns a list of recipe IDs which have logs stored on the given 
         server. By default, returns at most 50 at a time.
@@ -76,6 +88,12 @@ def by_log_server(self, server, limit=50):
         Only returns recipes where the whole recipe set has completed. Also 
         excludes recently completed recipe sets, since the system may continue 
         uploading logs for a short while until beaker-provision powers it off.
+
+        If after is given, only recipes with a higher ID are returned, in order 
+        of ID, so that the caller can page through all of them.
+
+        .. versionchanged:: 29
+           Added the after parameter.
         """
         finish_threshold = datetime.utcnow() - timedelta(minutes=2)
         recipes = Recipe.query.join(Recipe.recipeset)\
@@ -83,8 +101,10 @@ def by_log_server(self, server, limit=50):
                 .filter(not_(Job.is_deleted))\
                 .filter(RecipeSet.status.in_([s for s in TaskStatus if s.finished]))\
                 .filter(not_(RecipeSet.recipes.any(Recipe.finish_time >= finish_threshold)))\
-                .filter(Recipe.log_server == server)\
-                .limit(limit)
+                .filter(Recipe.log_server == server)
+        if after is not None:
+            recipes = recipes.filter(Recipe.id > int(after)).order_by(Recipe.id)
+        recipes = recipes.limit(limit)
         return [recipe_id for recipe_id, in recipes.values(Recipe.id)]
 
     @cherrypy.expose
@@ -97,6 +117,10 @@ def register_file(self, server, recipe_id, path, filename, basepath):
             recipe = Recipe.by_id(recipe_id, lockmode='update')
         except NoResultFound:
             raise BX(_('Invalid recipe ID: %s' % recipe_id))
+        return self._register_file(recipe, server, path, filename, basepath)
+
+    def _register_file(self, recipe, server, path, filename, basepath):
+        # The caller must have locked the recipe.
         if recipe.is_finished():
             raise BX('Cannot register file for finished recipe %s'
                     % recipe.t_id)
@@ -112,6 +136,77 @@ def register_file(self, server, recipe_id, path, filename, basepath):
         recipe.log_server = urlparse.urlparse(server)[1]
         return '%s' % recipe.filepath
 
+    @cherrypy.expose
+    @identity.require(identity.not_anonymous())
+    def register_files(self, files):
+        """
+        Registers a batch of log files, as if :meth:`register_file`,
+        :meth:`tasks.register_file` or :meth:`tasks.register_result_file` had
+        been called for each one. The rows for all the recipes, tasks and
+        results involved are locked once, up front, instead of once per file.
+
+        :param files: list of dicts with keys 'type' (one of 'recipe', 'task'
+            or 'result'), 'id', 'server', 'path', 'filename' and 'basepath'
+        :returns: list with an entry for each file, in the same order, which
+            is the error message if the file could not be registered or else
+            an empty string
+
+        .. versionadded:: 29
+        """
+        ids = {'recipe': set(), 'task': set(), 'result': set()}
+        for f in files:
+            id = _parse_id(f.get('id'))
+            if f.get('type') in ids and id is not None:
+                ids[f['type']].add(id)
+        # Lock in the same order as the single file methods: result, then
+        # task, then recipe. Sorting by ID avoids deadlocks between batches.
+        results = {}
+        if ids['result']:
+            for result in RecipeTaskResult.query\
+                    .filter(RecipeTaskResult.id.in_(ids['result']))\
+                    .order_by(RecipeTaskResult.id).with_lockmode('update'):
+                results[result.id] = result
+                ids['task'].add(result.recipe_task_id)
+        recipetasks = {}
+        if ids['task']:
+            for recipetask in RecipeTask.query\
+                    .filter(RecipeTask.id.in_(ids['task']))\
+                    .order_by(RecipeTask.id).with_lockmode('update'):
+                recipetasks[recipetask.id] = recipetask
+                ids['recipe'].add(recipetask.recipe_id)
+        recipes = {}
+        if ids['recipe']:
+            for recipe in Recipe.query.filter(Recipe.id.in_(ids['recipe']))\
+                    .order_by(Recipe.id).with_lockmode('update'):
+                recipes[recipe.id] = recipe
+
+        outcomes = []
+        for f in files:
+            try:
+                args = (f['server'], f['path'], f['filename'], f['basepath'])
+                if f['type'] == 'recipe':
+                    recipe = _lookup_by_id(recipes, f['id'])
+                    if recipe is None:
+                        raise BX(_('Invalid recipe ID: %s' % f['id']))
+                    self._register_file(recipe, *args)
+                elif f['type'] == 'task':
+                    recipetask = _lookup_by_id(recipetasks, f['id'])
+                    if recipetask is None:
+                        raise BX(_('Invalid task ID: %s' % f['id']))
+                    self.tasks._register_file(recipetask, *args)
+                elif f['type'] == 'result':
+                    result = _lookup_by_id(results, f['id'])
+                    if result is None:
+                        raise BX(_('Invalid result ID: %s' % f['id']))
+                    self.tasks._register_result_file(result, *args)
+                else:
+                    raise BX(_('Invalid log type: %s' % f['type']))
+            except (BX, KeyError), e:
+                outcomes.append(unicode(e))
+            else:
+                outcomes.append(u'')
+        return outcomes
+
     @cherrypy.expose
     @identity.require(identity.not_anonymous())
     def files(self, recipe_id):
@@ -158,11 +253,49 @@ def change_files(self, recipe_id, server, basepath):
             recipe = Recipe.by_id(recipe_id, lockmode='update')
         except NoResultFound:
             raise BX(_('Invalid recipe ID: %s' % recipe_id))
+        self._change_files(recipe, server, basepath)
+        return True
+
+    def _change_files(self, recipe, server, basepath):
         for mylog in recipe.all_logs():
             mylog.server = '%s/%s/' % (server, mylog.parent.filepath)
             mylog.basepath = '%s/%s/' % (basepath, mylog.parent.filepath)
         recipe.log_server = urlparse.urlparse(server)[1]
-        return True
+
+    @cherrypy.expose
+    @identity.require(identity.in_group('lab_controller'))
+    def change_files_batch(self, recipe_ids, server, basepath):
+        """
+        Changes the server and basepath for the log files of a batch of
+        recipes, as if :meth:`change_files` had been called for each one.
+
+        :param recipe_ids: list of recipe IDs
+        :returns: list with an entry for each recipe, in the same order, which
+            is the error message if its files could not be changed or else an
+            empty string
+
+        .. versionadded:: 29
+        """
+        ids = set(_parse_id(recipe_id) for recipe_id in recipe_ids)
+        ids.discard(None)
+        recipes = {}
+        if ids:
+            # Sorting by ID avoids deadlocks between batches.
+            for recipe in Recipe.query.filter(Recipe.id.in_(ids))\
+                    .order_by(Recipe.id).with_lockmode('update'):
+                recipes[recipe.id] = recipe
+        outcomes = []
+        for recipe_id in recipe_ids:
+            try:
+                recipe = _lookup_by_id(recipes, recipe_id)
+                if recipe is None:
+                    raise BX(_('Invalid recipe ID: %s' % recipe_id))
+                self._change_files(recipe, server, basepath)
+            except BX, e:
+                outcomes.append(unicode(e))
+            else:
+                outcomes.append(u'')
+        return outcomes
 
     @cherrypy.expose
     @identity.require(identity.not_anonymous())
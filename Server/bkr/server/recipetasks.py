@@ -4,14 +4,16 @@
 # the Free Software Foundation; either version 2 of the License, or
 # (at your option) any later version.
 
+from datetime import datetime, timedelta
 from turbogears import expose, config
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, or_
 from sqlalchemy.exc import InvalidRequestError
 from sqlalchemy.orm.exc import NoResultFound
 from bkr.server import identity
 from bkr.server.xmlrpccontroller import RPCRoot
 #from bkr.server.helpers import *
 from bkr.common.bexceptions import BX
+from bkr.common.helpers import total_seconds
 import urlparse
 #from turbogears.scheduler import add_interval_task
 
@@ -19,9 +21,9 @@
 
 from bkr.server.model import (session, RecipeTask, LogRecipeTask,
                               RecipeTaskResult, LogRecipeTaskResult,
-                              LabController, Watchdog, ResourceType,
-                              RecipeTaskComment, RecipeTaskResultComment,
-                              Recipe)
+                              LabController, Watchdog, WatchdogChange,
+                              ResourceType, RecipeTaskComment,
+                              RecipeTaskResultComment, Recipe, RecipeSet)
 from flask import redirect, request, jsonify
 from bkr.server.app import app
 from bkr.server.flask_util import auth_required, convert_internal_errors, \
@@ -84,6 +86,10 @@ def register_file(self, server, task_id, path, filename, basepath):
         except NoResultFound:
             raise BX(_('Invalid task ID: %s' % task_id))
         Recipe.by_id(recipetask.recipe_id, lockmode='update')
+        return self._register_file(recipetask, server, path, filename, basepath)
+
+    def _register_file(self, recipetask, server, path, filename, basepath):
+        # The caller must have locked the task and its recipe.
         if recipetask.is_finished():
             raise BX('Cannot register file for finished task %s'
                     % recipetask.t_id)
@@ -111,6 +117,10 @@ def register_result_file(self, server, result_id, path, filename, basepath):
             raise BX(_('Invalid result ID: %s' % result_id))
         RecipeTask.by_id(result.recipe_task_id, lockmode='update')
         Recipe.by_id(result.recipetask.recipe_id, lockmode='update')
+        return self._register_result_file(result, server, path, filename, basepath)
+
+    def _register_result_file(self, result, server, path, filename, basepath):
+        # The caller must have locked the result, its task and its recipe.
         if result.recipetask.is_finished():
             raise BX('Cannot register file for finished task %s'
                     % result.recipetask.t_id)
@@ -151,6 +161,95 @@ def watchdogs(self, status='active',lc=None):
                      system = w.recipe.resource.fqdn,
                      is_virt_recipe = (w.recipe.resource.type == ResourceType.virt)) for w in Watchdog.by_status(labcontroller, status)]
 
+    # Watchdog changes are kept for this long (beakerd deletes older ones). A
+    # cursor older than this may have missed some, so the caller has to start
+    # again with a full list.
+    watchdog_change_retention = timedelta(days=1)
+    # Changes are returned again for this long after they are made, in case
+    # a transaction which allocated a lower change ID commits after a caller
+    # has already seen a higher one. Replaying a change is harmless.
+    watchdog_change_overlap = timedelta(seconds=60)
+
+    def _watchdog_change(self, recipe, kill_time, now):
+        return dict(recipe_id=recipe.id,
+                    recipe_set_id=recipe.recipe_set_id,
+                    system=recipe.resource.fqdn if recipe.resource else None,
+                    is_virt_recipe=(recipe.resource is not None and
+                                    recipe.resource.type == ResourceType.virt),
+                    kill_time=kill_time.strftime('%Y-%m-%d %H:%M:%S')
+                              if kill_time else None,
+                    expires_in=total_seconds(kill_time - now)
+                               if kill_time else None)
+
+    @cherrypy.expose
+    @identity.require(identity.not_anonymous())
+    def watchdog_changes(self, cursor=None):
+        """
+        Returns the watchdogs for this lab controller which have changed since
+        the given cursor, so that they can be tracked without fetching the
+        full list on every poll. Pass None to start with the full list. The
+        return value is a dict with the following keys:
+
+        ``cursor``
+            To be passed in the next call.
+        ``resync``
+            True if ``changes`` is the full list of watchdogs, in which case
+            the caller should forget any others it knows about. This happens
+            when no cursor is given or the cursor is too old.
+        ``changes``
+            A list of dicts with ``recipe_id``, ``recipe_set_id``,
+            ``system``, ``is_virt_recipe``, ``kill_time`` and ``expires_in``
+            (seconds until the kill time, which may be negative). The last two
+            are None if the watchdog was removed because the recipe finished.
+            Changes are in order, and may repeat ones returned before.
+
+        A recipe set has expired once the watchdogs for all its recipes have
+        expired, see :meth:`watchdogs`.
+
+        .. versionadded:: 29
+        """
+        try:
+            labcontroller = identity.current.user.lab_controller
+        except AttributeError:
+            raise BX(_('Not currently logged in'))
+        if not labcontroller:
+            raise BX(_(u'Invalid login: %s, must log in as a lab controller'
+                    % identity.current.user))
+        now = datetime.utcnow()
+        last_id = None
+        if cursor:
+            try:
+                last_id, issued = [int(part) for part in cursor.split(':')]
+            except ValueError:
+                last_id = None
+            else:
+                if datetime.utcfromtimestamp(issued) < (now
+                        - self.watchdog_change_retention + self.watchdog_change_overlap):
+                    last_id = None
+        if last_id is None:
+            # Changes made after this are returned next time.
+            last_id = session.query(func.max(WatchdogChange.id)).scalar() or 0
+            watchdogs = Watchdog.query.join(Watchdog.recipe).join(Recipe.recipeset)\
+                .filter(RecipeSet.lab_controller == labcontroller)\
+                .filter(Watchdog.kill_time != None)
+            changes = [self._watchdog_change(w.recipe, w.kill_time, now)
+                       for w in watchdogs]
+            resync = True
+        else:
+            query = WatchdogChange.query\
+                .filter(WatchdogChange.lab_controller == labcontroller)\
+                .filter(or_(WatchdogChange.id > last_id,
+                            WatchdogChange.created >= now - self.watchdog_change_overlap))\
+                .order_by(WatchdogChange.id)
+            changes = []
+            for change in query:
+                changes.append(self._watchdog_change(change.recipe,
+                        change.kill_time, now))
+                last_id = max(last_id, change.id)
+            resync = False
+        return dict(cursor='%d:%d' % (last_id, total_seconds(now - datetime(1970, 1, 1))),
+                    resync=resync, changes=changes)
+
     @cherrypy.expose
     @identity.require(identity.not_anonymous())
     def start(self, task_id, watchdog_override=None):
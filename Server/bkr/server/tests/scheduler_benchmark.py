@@ -0,0 +1,288 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Replays a synthetic workload through the scheduler, for measuring changes to
+beakerd.
+
+A lab of systems spread across several lab controllers is created with
+data_setup, along with a queue of (mostly multi-host) jobs with a mix of
+hostRequires. Then beakerd's _main_recipes() is run until it has nothing left
+to do, optionally cancelling the scheduled jobs and repeating to simulate
+systems being freed up. The time spent and queries issued in each scheduler
+phase are reported, along with the number of recipes scheduled per second.
+
+The database named in the configuration is used, so point it at a scratch
+MySQL/MariaDB database (Beaker's schema does not support SQLite). For example:
+
+    python -m bkr.server.tests.scheduler_benchmark -c benchmark.cfg \\
+        --create-db --systems 2000 --lab-controllers 4 --jobs 1000
+"""
+
+import sys
+import time
+import random
+import logging
+import threading
+from optparse import OptionParser
+from sqlalchemy import event
+from turbogears import config
+from turbogears.database import session, get_engine
+from bkr.log import log_to_stream
+from bkr.server import wakeup
+from bkr.server.eligibility import EligibilityIndex
+from bkr.server.model import Job, Task, TaskStatus, TaskPriority, Cpu, \
+        RecipeResource
+from bkr.server.tests import data_setup
+from bkr.server.tools import beakerd
+from bkr.server.util import load_config_or_exit
+
+log = logging.getLogger(__name__)
+
+PHASES = ['refresh_eligibility_index', 'update_dirty_jobs',
+        'abort_dead_recipes', 'process_new_recipes',
+        'queue_processed_recipesets', 'provision_virt_recipes',
+        'schedule_pending_systems', 'provision_scheduled_recipesets']
+
+MEMORY_SIZES = [2048, 4096, 8192, 16384, 65536]
+PROCESSOR_COUNTS = [1, 2, 4, 8, 32]
+
+HOST_REQUIRES = [
+    u'<hostRequires/>',
+    u'<hostRequires><system><memory op="&gt;=" value="{memory}"/></system>'
+        u'</hostRequires>',
+    u'<hostRequires><cpu><processors op="&gt;=" value="{processors}"/></cpu>'
+        u'</hostRequires>',
+    u'<hostRequires><and><labcontroller op="=" value="{lab}"/>'
+        u'<system><memory op="&gt;=" value="{memory}"/></system></and>'
+        u'</hostRequires>',
+    u'<hostRequires><hostname op="like" value="%{digit}.benchmark.invalid"/>'
+        u'</hostRequires>',
+]
+
+
+class PhaseStats(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.queries = 0
+        self.query_seconds = 0.0
+
+
+class SchedulerProfiler(object):
+    """
+    Times each beakerd phase and counts the queries issued while it runs.
+    Queries issued by worker threads are attributed to the phase which
+    started them, since phases never overlap.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.stats = dict((phase, PhaseStats()) for phase in PHASES)
+        self.current_phase = None
+        self._lock = threading.Lock()
+        self._originals = {}
+
+    def _wrap(self, phase, func):
+        def wrapper(*args, **kwargs):
+            self.current_phase = phase
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats = self.stats[phase]
+                stats.calls += 1
+                stats.seconds += time.time() - start
+                self.current_phase = None
+        return wrapper
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+            context, executemany):
+        conn.info.setdefault('benchmark_query_start', []).append(time.time())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters,
+            context, executemany):
+        elapsed = time.time() - conn.info['benchmark_query_start'].pop()
+        phase = self.current_phase
+        if phase is None:
+            return
+        with self._lock:
+            stats = self.stats[phase]
+            stats.queries += 1
+            stats.query_seconds += elapsed
+
+    def start(self):
+        for phase in PHASES:
+            func = getattr(beakerd, phase)
+            self._originals[phase] = func
+            setattr(beakerd, phase, self._wrap(phase, func))
+        event.listen(self.engine, 'before_cursor_execute',
+                self._before_cursor_execute)
+        event.listen(self.engine, 'after_cursor_execute',
+                self._after_cursor_execute)
+
+    def stop(self):
+        event.remove(self.engine, 'before_cursor_execute',
+                self._before_cursor_execute)
+        event.remove(self.engine, 'after_cursor_execute',
+                self._after_cursor_execute)
+        for phase, func in self._originals.iteritems():
+            setattr(beakerd, phase, func)
+        self._originals.clear()
+
+
+def populate(num_systems, num_lab_controllers, num_jobs, max_recipes, seed):
+    rng = random.Random(seed)
+    with session.begin():
+        if not Task.query.filter(Task.name == u'/distribution/reservesys').count():
+            data_setup.create_task(name=u'/distribution/reservesys')
+        owner = data_setup.create_user()
+        lab_controllers = [data_setup.create_labcontroller(
+                fqdn=u'lab%d.benchmark.invalid' % i)
+                for i in range(num_lab_controllers)]
+        distro_tree = data_setup.create_distro_tree(
+                osmajor=u'BenchmarkLinux7', distro_name=u'BenchmarkLinux7.0',
+                arch=u'x86_64', lab_controllers=lab_controllers)
+        log.info('Creating %d systems', num_systems)
+        for i in range(num_systems):
+            system = data_setup.create_system(arch=u'x86_64', owner=owner,
+                    fqdn=u'system%d.benchmark.invalid' % i,
+                    lab_controller=lab_controllers[i % num_lab_controllers],
+                    memory=rng.choice(MEMORY_SIZES))
+            system.cpu = Cpu(processors=rng.choice(PROCESSOR_COUNTS))
+            if i % 100 == 0:
+                session.flush()
+        log.info('Creating %d jobs', num_jobs)
+        for i in range(num_jobs):
+            job = data_setup.create_job(owner=owner, distro_tree=distro_tree,
+                    num_recipes=rng.randint(1, max_recipes),
+                    priority=TaskPriority.from_string(
+                        rng.choice(TaskPriority.values())),
+                    whiteboard=u'benchmark job %d' % i)
+            for recipe in job.all_recipes:
+                recipe.host_requires = rng.choice(HOST_REQUIRES).format(
+                        memory=rng.choice(MEMORY_SIZES),
+                        processors=rng.choice(PROCESSOR_COUNTS),
+                        lab=rng.choice(lab_controllers).fqdn,
+                        digit=rng.randint(0, 9))
+
+def release_systems():
+    """
+    Cancels every job which has been given systems, so that they are freed
+    up for the recipes still queued.
+    """
+    with session.begin():
+        jobs = Job.query.filter(Job.status.in_([TaskStatus.scheduled,
+                TaskStatus.waiting, TaskStatus.installing, TaskStatus.running]))
+        count = 0
+        for job in jobs:
+            job.cancel(msg=u'Cancelled by scheduler benchmark')
+            count += 1
+    return count
+
+def scheduled_recipe_count():
+    with session.begin():
+        return RecipeResource.query.count()
+
+def run_until_idle(max_passes):
+    passes = 0
+    while passes < max_passes:
+        passes += 1
+        if not beakerd._main_recipes():
+            break
+    return passes
+
+def print_report(profiler, passes, scheduled, elapsed, out=sys.stdout):
+    out.write('%-32s %7s %10s %9s %12s\n' % ('phase', 'calls', 'seconds',
+            'queries', 'query secs'))
+    for phase in PHASES:
+        stats = profiler.stats[phase]
+        if not stats.calls:
+            continue
+        out.write('%-32s %7d %10.2f %9d %12.2f\n' % (phase, stats.calls,
+                stats.seconds, stats.queries, stats.query_seconds))
+    total_queries = sum(stats.queries for stats in profiler.stats.itervalues())
+    out.write('\n%d passes, %d queries, %d recipes scheduled in %0.2f seconds '
+            '(%0.1f recipes/second)\n' % (passes, total_queries, scheduled,
+            elapsed, scheduled / elapsed if elapsed else 0))
+
+def get_parser():
+    parser = OptionParser(usage='usage: %prog [options]',
+            description='Benchmark the Beaker scheduler against a synthetic lab')
+    parser.add_option('-c', '--config', dest='configfile',
+            help='location of config file')
+    parser.add_option('--create-db', action='store_true',
+            help='drop and re-create the configured database first')
+    parser.add_option('--no-populate', dest='populate', action='store_false',
+            help='re-use the jobs and systems already in the database')
+    parser.add_option('--systems', type='int',
+            help='number of systems to create [default: %default]')
+    parser.add_option('--lab-controllers', type='int',
+            help='number of lab controllers to create [default: %default]')
+    parser.add_option('--jobs', type='int',
+            help='number of queued jobs to create [default: %default]')
+    parser.add_option('--max-recipes', type='int',
+            help='maximum number of recipes per job [default: %default]')
+    parser.add_option('--seed', type='int',
+            help='random seed for the generated data [default: %default]')
+    parser.add_option('--rounds', type='int',
+            help='number of times to free up all systems and let the '
+                 'scheduler fill them again [default: %default]')
+    parser.add_option('--max-passes', type='int',
+            help='give up on reaching steady state after this many scheduler '
+                 'passes in a round [default: %default]')
+    parser.add_option('--workers', type='int',
+            help='override beaker.scheduler_workers')
+    parser.add_option('--no-eligibility-index', dest='eligibility_index',
+            action='store_false', help='schedule without the eligibility index')
+    parser.add_option('-v', '--verbose', action='store_true',
+            help='show debug messages from the scheduler')
+    parser.set_defaults(populate=True, systems=500, lab_controllers=2,
+            jobs=500, max_recipes=4, seed=0, rounds=3, max_passes=100,
+            eligibility_index=True)
+    return parser
+
+def main():
+    parser = get_parser()
+    opts, args = parser.parse_args()
+    load_config_or_exit(opts.configfile)
+    log_to_stream(sys.stderr, level=logging.DEBUG if opts.verbose else logging.INFO)
+    if opts.workers is not None:
+        config.update({'beaker.scheduler_workers': opts.workers})
+
+    if opts.create_db:
+        data_setup.setup_model()
+    if opts.populate:
+        populate(opts.systems, opts.lab_controllers, opts.jobs,
+                opts.max_recipes, opts.seed)
+
+    # Same setup as beakerd's schedule(), minus the threads.
+    if opts.eligibility_index:
+        beakerd._eligibility_index = EligibilityIndex()
+    wakeup.set_local_handler(lambda phases: None)
+
+    profiler = SchedulerProfiler(get_engine())
+    initial_scheduled = scheduled_recipe_count()
+    passes = 0
+    elapsed = 0.0
+    profiler.start()
+    try:
+        for round in range(opts.rounds + 1):
+            if round:
+                log.info('Round %d: released systems from %d jobs',
+                        round, release_systems())
+            start = time.time()
+            passes += run_until_idle(opts.max_passes)
+            elapsed += time.time() - start
+    finally:
+        profiler.stop()
+    print_report(profiler, passes, scheduled_recipe_count() - initial_scheduled,
+            elapsed)
+    if beakerd._worker_executor:
+        beakerd._worker_executor.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import threading
+import unittest
+
+from sqlalchemy import create_engine
+
+from bkr.server import instrumentation
+
+
+class TimedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+
+    def test_counts_statements(self):
+        with instrumentation.timed('outer') as timer:
+            self.engine.execute('SELECT 1')
+            self.engine.execute('SELECT 2')
+        self.assertEquals(timer.statements, 2)
+        self.assertTrue(timer.elapsed >= timer.statement_time)
+        # Statements outside the block are not counted.
+        self.engine.execute('SELECT 3')
+        self.assertEquals(timer.statements, 2)
+
+    def test_nested_timers(self):
+        with instrumentation.timed('phase') as phase:
+            self.engine.execute('SELECT 1')
+            for item_id in [1, 2]:
+                with instrumentation.timed('item', item_id):
+                    self.engine.execute('SELECT 2')
+        self.assertEquals(phase.statements, 3)
+        items = phase.children['item']
+        self.assertEquals([item.item_id for item in items], [1, 2])
+        self.assertEquals([item.statements for item in items], [1, 1])
+        self.assertEquals(instrumentation.current_timer(), None)
+
+    def test_attributed_to_timer_in_other_thread(self):
+        def worker(timer):
+            with instrumentation.attributed_to(timer):
+                self.engine.execute('SELECT 1')
+        with instrumentation.timed('phase') as phase:
+            thread = threading.Thread(target=worker,
+                    args=(instrumentation.current_timer(),))
+            thread.start()
+            thread.join()
+            # Already running in this thread, so not counted twice.
+            with instrumentation.attributed_to(phase):
+                self.engine.execute('SELECT 2')
+        self.assertEquals(phase.statements, 2)
@@ -0,0 +1,52 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import unittest
+
+from bkr.server.matching import maximum_matching, usable_edges
+
+
+class MaximumMatchingTest(unittest.TestCase):
+
+    def test_perfect_matching_needs_augmenting_path(self):
+        # A greedy assignment of 1 -> 'a' would leave 2 with nothing.
+        graph = {1: ['a', 'b'], 2: ['a']}
+        self.assertEquals(maximum_matching(graph), {1: 'b', 2: 'a'})
+
+    def test_no_perfect_matching(self):
+        # Three recipes competing for two systems.
+        graph = {1: ['a', 'b'], 2: ['a', 'b'], 3: ['a', 'b']}
+        self.assertEquals(len(maximum_matching(graph)), 2)
+
+    def test_empty_candidates(self):
+        self.assertEquals(maximum_matching({1: [], 2: ['a']}), {2: 'a'})
+
+
+class UsableEdgesTest(unittest.TestCase):
+
+    def test_edges_which_cannot_be_used_are_pruned(self):
+        # 2 can only use 'a', so 1 can never use it.
+        graph = {1: ['a', 'b'], 2: ['a']}
+        usable = usable_edges(graph, maximum_matching(graph))
+        self.assertEquals(usable, set([(1, 'b'), (2, 'a')]))
+
+    def test_free_systems_keep_all_edges(self):
+        graph = {1: ['a', 'b', 'c'], 2: ['a', 'b']}
+        usable = usable_edges(graph, maximum_matching(graph))
+        self.assertEquals(usable, set([(1, 'a'), (1, 'b'), (1, 'c'),
+                                       (2, 'a'), (2, 'b')]))
+
+    def test_alternating_cycle(self):
+        # Two recipes sharing exactly two systems can use either of them.
+        graph = {1: ['a', 'b'], 2: ['a', 'b'], 3: ['c']}
+        usable = usable_edges(graph, maximum_matching(graph))
+        self.assertEquals(usable, set([(1, 'a'), (1, 'b'), (2, 'a'),
+                                       (2, 'b'), (3, 'c')]))
+
+    def test_overlapping_ids_on_each_side(self):
+        # Recipe ids and system ids are both integers.
+        graph = {1: [1, 2], 2: [1]}
+        usable = usable_edges(graph, maximum_matching(graph))
+        self.assertEquals(usable, set([(1, 2), (2, 1)]))
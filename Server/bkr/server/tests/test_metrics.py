@@ -0,0 +1,54 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import socket
+import unittest
+
+from bkr.server.metrics import CarbonSender, MetricsBuffer
+
+
+class MetricsBufferTest(unittest.TestCase):
+
+    def test_aggregation(self):
+        buffer = MetricsBuffer()
+        buffer.increment('counters.a')
+        buffer.increment('counters.a', 2)
+        buffer.gauge('gauges.b', 5)
+        buffer.gauge('gauges.b', 7)
+        buffer.timing('durations.c', [4, 1, 3, 2])
+        metrics = dict((name, value) for name, value, timestamp
+                in buffer.drain(1000))
+        self.assertEquals(metrics, {
+            'counters.a': 3,
+            'gauges.b': 7,
+            'durations.c.count': 4,
+            'durations.c.mean': 2.5,
+            'durations.c.median': 2,
+            'durations.c.upper_90': 4,
+            'durations.c.upper': 4,
+        })
+        # Draining resets everything.
+        self.assertEquals(buffer.drain(1001), [])
+
+
+class CarbonSenderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.settimeout(5)
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_lines_are_batched_into_datagrams(self):
+        sender = CarbonSender(self.server.getsockname(), 'beaker.')
+        sender.max_datagram_size = 60
+        sender.send_many([('counters.x%d' % i, i, 1000) for i in range(4)])
+        datagrams = [self.server.recv(4096), self.server.recv(4096)]
+        self.assertEquals(datagrams, [
+            'beaker.counters.x0 0 1000\nbeaker.counters.x1 1 1000\n',
+            'beaker.counters.x2 2 1000\nbeaker.counters.x3 3 1000\n',
+        ])
@@ -33,3 +33,40 @@ def check_bytes_multiplier(units, expected):
     actual = needpropertyxml.bytes_multiplier(units)
     assert actual == expected, 'Units %s, expected %s, actual %s' % (
             units, expected, actual)
+
+def test_canonical_xml_ignores_formatting():
+    a = needpropertyxml.canonical_xml(
+            '<hostRequires><hostname op="=" value="a"/></hostRequires>')
+    b = needpropertyxml.canonical_xml(
+            '<hostRequires>\n  <hostname value="a"  op="=" />\n</hostRequires>')
+    assert a == b, (a, b)
+    c = needpropertyxml.canonical_xml(
+            '<hostRequires><hostname op="=" value="b"/></hostRequires>')
+    assert a != c, a
+
+def test_compiled_host_filters_are_shared():
+    first = needpropertyxml.XmlHost.from_string(
+            '<hostRequires><memory op="&gt;" value="1"/></hostRequires>')
+    second = needpropertyxml.XmlHost.from_string(
+            '<hostRequires> <memory value="1" op="&gt;"/> </hostRequires>')
+    assert first is second
+    distro = needpropertyxml.XmlDistro.from_string(
+            '<hostRequires><memory op="&gt;" value="1"/></hostRequires>')
+    assert isinstance(distro, needpropertyxml.XmlDistro)
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = needpropertyxml._LRUCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEquals(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(cache.get('c'), 3)
+
+    def test_entries_expire(self):
+        cache = needpropertyxml._LRUCache(maxsize=2, ttl=-1)
+        cache.put('a', 1)
+        self.assertEquals(cache.get('a'), None)
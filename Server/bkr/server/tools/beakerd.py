@@ -17,17 +17,21 @@
 import random
 from bkr.common import __version__
 from bkr.log import log_to_stream, log_to_syslog
-from bkr.server import needpropertyxml, utilisation, metrics, dynamic_virt
+from bkr.server import needpropertyxml, utilisation, metrics, dynamic_virt, \
+        wakeup, instrumentation
+from bkr.server.eligibility import EligibilityIndex
+from bkr.server.matching import maximum_matching, usable_edges
 from bkr.server.bexceptions import BX, \
     StaleTaskStatusException, InsufficientSystemPermissions, \
     StaleSystemUserException
 from bkr.server.model import (Job, RecipeSet, Recipe, MachineRecipe,
         GuestRecipe, RecipeVirtStatus, TaskStatus, TaskPriority, LabController,
-        Watchdog, System, DistroTree, LabControllerDistroTree, SystemStatus,
+        Watchdog, WatchdogChange, System, DistroTree, LabControllerDistroTree,
+        SystemStatus,
         SystemResource, GuestResource, Arch,
         SystemAccessPolicy, SystemPermission, ConfigItem, Command,
         Power, PowerType, DataMigration, SystemSchedulerStatus)
-from bkr.server.model.scheduler import machine_guest_map
+from bkr.server.model.scheduler import machine_guest_map, system_recipe_map
 from bkr.server.needpropertyxml import XmlHost
 from bkr.server.util import load_config_or_exit, log_traceback, \
         get_reports_engine
@@ -38,11 +42,10 @@
 from xmlrpclib import ProtocolError
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.sql import exists
-from sqlalchemy.sql.expression import func, select, and_, or_, not_
-from sqlalchemy.orm import create_session
+from sqlalchemy.sql.expression import func, select, and_, or_, not_, case
+from sqlalchemy.orm import create_session, joinedload, joinedload_all
 
 import socket
-import exceptions
 from datetime import datetime, timedelta
 import time
 import daemon
@@ -53,12 +56,35 @@
 import threading
 import os
 import concurrent.futures
+import functools
 import logging
+from collections import OrderedDict, defaultdict
 
 log = logging.getLogger(__name__)
 running = True
 event = threading.Event()
+# Phases of _main_recipes() which have been asked to run, see request_phases().
+_requested_phases = set()
+_full_pass_requested = True
+_requested_phases_lock = threading.Lock()
 _threadpool_executor = None
+# Pool of scheduler workers, see _run_sharded().
+_worker_executor = None
+_worker_state = threading.local()
+# Guest MAC addresses are allocated by looking for a gap in the addresses
+# already in use, so two workers allocating at the same time could pick the
+# same one. Workers hold this lock from allocation until their transaction ends.
+# It is only ever waited for outside a transaction, see
+# _hold_guest_allocation_lock().
+_guest_allocation_lock = threading.Lock()
+
+# In-memory index of queued recipes and their candidate systems, created by
+# schedule() if enabled. When it is None we fall back to querying
+# MachineRecipe.runnable_on_system() for every pending system.
+_eligibility_index = None
+# Recipe sets whose queued recipes have changed since the index was last
+# refreshed.
+_eligibility_index_dirty = set()
 
 from optparse import OptionParser
 
@@ -89,56 +115,231 @@ def get_virt_executor():
        _threadpool_executor = concurrent.futures.ThreadPoolExecutor(max_workers=5)
     return _threadpool_executor
 
+def _scheduler_workers():
+    return max(1, int(config.get('beaker.scheduler_workers', 1)))
+
+def get_worker_executor():
+    global _worker_executor
+    if _worker_executor is None:
+        _worker_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=_scheduler_workers())
+    return _worker_executor
+
+def shard_work(items, keys, num_shards):
+    """
+    Splits items into at most num_shards lists, preserving their order.
+    keys[i] is an iterable of the rows (job ids, system ids) which items[i]
+    will modify. Items sharing a key are kept in the same shard, so that
+    workers do not contend for the same rows. If an item's keys already
+    belong to different shards it goes to the first one, and row locking
+    has to sort it out.
+    """
+    shards = [[] for _ in range(num_shards)]
+    shard_by_key = {}
+    for item, item_keys in zip(items, keys):
+        item_keys = list(item_keys)
+        for key in item_keys:
+            if key in shard_by_key:
+                shard = shard_by_key[key]
+                break
+        else:
+            shard = min(range(num_shards), key=lambda i: len(shards[i]))
+        shards[shard].append(item)
+        for key in item_keys:
+            shard_by_key.setdefault(key, shard)
+    return [s for s in shards if s]
+
+def _run_shard(handler, items, interruptible, timer=None):
+    # Statements issued by workers count towards the phase which started them.
+    with instrumentation.attributed_to(timer):
+        for item in items:
+            handler(item)
+            # Only shutting down interrupts a shard. The event is also set
+            # whenever a phase is requested, which happens on most commits.
+            if interruptible and not running:
+                break
+
+def _run_sharded(handler, items, keys=None, interruptible=False):
+    """
+    Calls handler(item) for each of the given items. If beaker.scheduler_workers
+    is greater than one, the items are split by shard_work() (using the items
+    themselves as keys if none are given) and each shard is handled in order
+    by a worker thread. Returns only once every item has been handled, so the
+    ordering of phases in _main_recipes() is unaffected.
+    """
+    workers = _scheduler_workers()
+    if workers == 1 or len(items) <= 1:
+        _run_shard(handler, items, interruptible)
+        return
+    if keys is None:
+        keys = [[item] for item in items]
+    timer = instrumentation.current_timer()
+    futures = [get_worker_executor().submit(_run_shard, handler, shard,
+                                            interruptible, timer)
+               for shard in shard_work(items, keys, workers)]
+    concurrent.futures.wait(futures)
+    for future in futures:
+        future.result()
+
+def _run_in_transaction(handler, item_id):
+    """
+    Calls handler(item_id) in its own transaction, logging and rolling back on
+    failure. Returns True if the transaction was committed.
+    """
+    with instrumentation.timed(handler.__name__, item_id) as timer:
+        try:
+            while True:
+                session.begin()
+                try:
+                    handler(item_id)
+                    session.commit()
+                    break
+                except _GuestAllocationLockBusy:
+                    # Wait for the lock without holding any rows, then start
+                    # over with the lock already held.
+                    session.rollback()
+                    session.close()
+                    _guest_allocation_lock.acquire()
+                    _worker_state.holds_guest_lock = True
+                except Exception:
+                    log.exception('Error in %s(%s)', handler.__name__, item_id)
+                    session.rollback()
+                    return False
+        finally:
+            session.close()
+            _release_guest_allocation_lock()
+            _log_if_slow(timer)
+    return True
+
+def _log_if_slow(timer):
+    threshold = config.get('beaker.scheduler_slow_item_threshold', 5)
+    if threshold and timer.elapsed >= threshold:
+        log.warning('Slow %s(%s): took %0.2f seconds, '
+                '%d SQL statements taking %0.2f seconds', timer.name,
+                timer.item_id, timer.elapsed, timer.statements,
+                timer.statement_time)
+
+def _phase(phase_func):
+    """
+    Decorator for the phases of _main_recipes(). Each call is timed, and the
+    timings for the phase and for each item it handled are sent to Graphite.
+    """
+    @functools.wraps(phase_func)
+    def wrapper(*args, **kwargs):
+        with instrumentation.timed(phase_func.__name__) as timer:
+            result = phase_func(*args, **kwargs)
+        if result:
+            log.debug('%s took %0.2f seconds, %d SQL statements taking '
+                    '%0.2f seconds', timer.name, timer.elapsed,
+                    timer.statements, timer.statement_time)
+        metrics.measure('durations.beakerd.%s' % timer.name, timer.elapsed)
+        metrics.measure('durations.beakerd_sql.%s' % timer.name,
+                timer.statement_time)
+        metrics.measure('counters.beakerd_sql_statements.%s' % timer.name,
+                timer.statements)
+        for name, children in timer.children.iteritems():
+            metrics.measure_distribution('durations.beakerd_items.%s' % name,
+                    [child.elapsed for child in children])
+            metrics.measure_distribution(
+                    'counters.beakerd_item_sql_statements.%s' % name,
+                    [child.statements for child in children])
+        return result
+    return wrapper
+
+class _GuestAllocationLockBusy(Exception):
+    pass
+
+def _hold_guest_allocation_lock():
+    """
+    Takes the guest allocation lock for the rest of the current transaction.
+    By now the transaction holds row locks which another worker holding the
+    guest allocation lock may be waiting for, and InnoDB cannot see a deadlock
+    involving our lock, so we must not block here. If the lock is busy the
+    transaction is rolled back and retried by _run_in_transaction() once the
+    lock is free.
+    """
+    if _scheduler_workers() > 1 and not getattr(_worker_state, 'holds_guest_lock', False):
+        if not _guest_allocation_lock.acquire(False):
+            raise _GuestAllocationLockBusy()
+        _worker_state.holds_guest_lock = True
+
+def _release_guest_allocation_lock():
+    if getattr(_worker_state, 'holds_guest_lock', False):
+        _worker_state.holds_guest_lock = False
+        _guest_allocation_lock.release()
+
+@_phase
 def update_dirty_jobs():
-    work_done = False
     with session.begin():
         dirty_jobs = Job.query.filter(Job.is_dirty)
         job_ids = [job_id for job_id, in dirty_jobs.values(Job.id)]
     if job_ids:
         log.debug('Updating dirty jobs [%s ... %s] (%d total)',
                   job_ids[0], job_ids[-1], len(job_ids))
-    for job_id in job_ids:
-        session.begin()
-        try:
-            update_dirty_job(job_id)
-            session.commit()
-        except Exception as e:
-            log.exception('Error in update_dirty_job(%s)', job_id)
-            session.rollback()
-        finally:
-            session.close()
-        work_done = True
-        if event.is_set():
-            break
-    return work_done
+    _run_sharded(lambda job_id: _run_in_transaction(update_dirty_job, job_id),
+                 job_ids, interruptible=True)
+    return bool(job_ids)
 
 def update_dirty_job(job_id):
     log.debug('Updating dirty job %s', job_id)
     job = Job.query.filter(Job.id == job_id).with_lockmode('update').one()
     job.update_status()
 
+@_phase
 def process_new_recipes(*args):
-    work_done = False
     with session.begin():
         recipes = MachineRecipe.query\
                 .join(MachineRecipe.recipeset).join(RecipeSet.job)\
                 .filter(Recipe.status == TaskStatus.new)
-        recipe_ids = [recipe_id for recipe_id, in recipes.values(MachineRecipe.id)]
+        job_ids = OrderedDict(recipes.values(MachineRecipe.id, RecipeSet.job_id))
+        recipe_ids = list(job_ids)
     if recipe_ids:
         log.debug('Processing new recipes [%s ... %s] (%d total)',
                   recipe_ids[0], recipe_ids[-1], len(recipe_ids))
-    for recipe_id in recipe_ids:
-        session.begin()
-        try:
-            process_new_recipe(recipe_id)
-            session.commit()
-        except Exception as e:
-            log.exception('Error in process_new_recipe(%s)', recipe_id)
-            session.rollback()
-        finally:
-            session.close()
-        work_done = True
-    return work_done
+    if config.get('beaker.batched_candidate_matching', True):
+        groups = group_new_recipes(recipe_ids)
+    else:
+        groups = [[recipe_id] for recipe_id in recipe_ids]
+    _run_sharded(_process_new_recipes_in_group, groups,
+                 keys=[set(job_ids[recipe_id] for recipe_id in group)
+                       for group in groups])
+    return bool(groups)
+
+def _process_new_recipes_in_group(group):
+    if len(group) == 1:
+        _run_in_transaction(process_new_recipe, group[0])
+    elif not _run_in_transaction(process_new_recipe_group, group):
+        # Fall back to processing them one at a time, so that one bad
+        # recipe does not prevent the rest of its group from running.
+        for recipe_id in group:
+            _run_in_transaction(process_new_recipe, recipe_id)
+
+def group_new_recipes(recipe_ids, batch_size=1000):
+    """
+    Groups new recipes which share the same candidate_systems_key(), so that
+    their candidate systems can be matched once per group. The order of
+    recipes is preserved within each group, and groups are ordered by their
+    first recipe.
+    """
+    groups = OrderedDict()
+    for start in range(0, len(recipe_ids), batch_size):
+        batch = recipe_ids[start:start + batch_size]
+        with session.begin():
+            recipes = MachineRecipe.query\
+                    .filter(MachineRecipe.id.in_(batch))\
+                    .options(joinedload(MachineRecipe.installation),
+                             joinedload_all('recipeset.job'))
+            recipes_by_id = dict((recipe.id, recipe) for recipe in recipes)
+            for recipe_id in batch:
+                try:
+                    key = recipes_by_id[recipe_id].candidate_systems_key()
+                except Exception:
+                    # Let process_new_recipe report the problem for this
+                    # recipe on its own.
+                    key = ('recipe', recipe_id)
+                groups.setdefault(key, []).append(recipe_id)
+        session.close()
+    return groups.values()
 
 def process_new_recipe(recipe_id):
     recipe = MachineRecipe.by_id(recipe_id)
@@ -164,9 +365,37 @@ def process_new_recipe(recipe_id):
         for system in all_systems:
             # Add matched systems to recipe.
             recipe.systems.append(system)
+    _finish_processing_new_recipe(recipe, len(recipe.systems))
 
+def process_new_recipe_group(recipe_ids):
+    """
+    Like process_new_recipe, but for a group of recipes which all have the
+    same candidate_systems_key(). The candidate systems queries are evaluated
+    once for the whole group and system_recipe_map is filled in bulk.
+    """
+    recipes = [MachineRecipe.by_id(recipe_id) for recipe_id in recipe_ids]
+    # See process_new_recipe for why there are two queries.
+    systems = recipes[0].candidate_systems(only_in_lab=True)
+    log.debug('Counting candidate systems for recipes %s (%d total)',
+              recipe_ids[0], len(recipe_ids))
+    if systems.count():
+        log.debug('Computing all candidate systems for recipes %s (%d total)',
+                  recipe_ids[0], len(recipe_ids))
+        all_systems = recipes[0].candidate_systems(only_in_lab=False)
+        system_count = MachineRecipe.set_candidate_systems(recipes, all_systems)
+    else:
+        system_count = MachineRecipe.set_candidate_systems(recipes, None)
+    for recipe in recipes:
+        if recipe.status != TaskStatus.new:
+            # An earlier recipe in the same recipe set was aborted, which
+            # took this one down with it.
+            log.debug('Recipe %s is no longer New, skipping', recipe.id)
+            continue
+        _finish_processing_new_recipe(recipe, system_count)
+
+def _finish_processing_new_recipe(recipe, system_count):
     # If the recipe only matches one system then bump its priority.
-    if config.get('beaker.priority_bumping_enabled', True) and len(recipe.systems) == 1:
+    if config.get('beaker.priority_bumping_enabled', True) and system_count == 1:
         old_prio = recipe.recipeset.priority
         try:
             new_prio = TaskPriority.by_index(TaskPriority.index(old_prio) + 1)
@@ -180,7 +409,7 @@ def process_new_recipe(recipe_id):
                     old=unicode(old_prio), new=unicode(new_prio))
             recipe.recipeset.priority = new_prio
     recipe.virt_status = recipe.check_virtualisability()
-    if not recipe.systems and not _virt_possible(recipe):
+    if not system_count and not _virt_possible(recipe):
         log.info("recipe ID %s moved from New to Aborted" % recipe.id)
         recipe.recipeset.abort(u'Recipe ID %s does not match any systems' % recipe.id)
         return
@@ -189,123 +418,90 @@ def process_new_recipe(recipe_id):
     for guestrecipe in recipe.guests:
         guestrecipe.process()
 
+@_phase
 def queue_processed_recipesets(*args):
-    work_done = False
     with session.begin():
         recipesets = RecipeSet.by_recipe_status(TaskStatus.processed)\
                 .order_by(RecipeSet.priority.desc())\
                 .order_by(RecipeSet.id)
-        recipeset_ids = [rs_id for rs_id, in recipesets.values(RecipeSet.id)]
+        rows = list(recipesets.values(RecipeSet.id, RecipeSet.job_id))
+        recipeset_ids, job_ids = zip(*rows) if rows else ((), ())
     if recipeset_ids:
         log.debug('Queuing processed recipe sets [%s ... %s] (%d total)',
                   recipeset_ids[0], recipeset_ids[-1], len(recipeset_ids))
-    for rs_id in recipeset_ids:
-        session.begin()
-        try:
-            queue_processed_recipeset(rs_id)
-            session.commit()
-        except Exception as e:
-            log.exception('Error in queue_processed_recipeset(%s)', rs_id)
-            session.rollback()
-        finally:
-            session.close()
-        work_done = True
-    return work_done
+    _run_sharded(lambda rs_id: _run_in_transaction(queue_processed_recipeset, rs_id),
+                 list(recipeset_ids), keys=[[job_id] for job_id in job_ids])
+    _eligibility_index_dirty.update(recipeset_ids)
+    refresh_eligibility_index()
+    return bool(recipeset_ids)
 
 def queue_processed_recipeset(recipeset_id):
     recipeset = RecipeSet.by_id(recipeset_id)
 
     # We only need to check "not enough systems" logic for multi-host recipe sets
-    if len(list(recipeset.machine_recipes)) > 1:
-        bad_l_controllers = set()
-        # Find all the lab controllers that this recipeset may run.
-        rsl_controllers = set(LabController.query\
-                                      .join('systems',
-                                            'queued_recipes',
-                                            'recipeset')\
-                                      .filter(RecipeSet.id==recipeset.id).all())
-
-        # Any lab controllers that are not associated to all recipes in the
-        # recipe set must have those systems on that lab controller removed
-        # from any recipes.  For multi-host all recipes must be schedulable
-        # on one lab controller
-        for recipe in recipeset.machine_recipes:
-            rl_controllers = set(LabController.query\
-                                       .join('systems',
-                                             'queued_recipes')\
-                                       .filter(Recipe.id==recipe.id).all())
-            bad_l_controllers = bad_l_controllers.union(rl_controllers.difference(rsl_controllers))
-
-        for l_controller in rsl_controllers:
-            enough_systems = False
-            for recipe in recipeset.machine_recipes:
-                systems = recipe.dyn_systems.filter(
-                                          System.lab_controller==l_controller
-                                                   ).all()
-                if len(systems) < len(recipeset.recipes):
-                    break
-            else:
-                # There are enough choices We don't need to worry about dead
-                # locks
-                enough_systems = True
-            if not enough_systems:
-                log.debug("recipe: %s labController:%s entering not enough systems logic" %
-                                      (recipe.id, l_controller))
-                # Eliminate bad choices.
-                for recipe in recipeset.machine_recipes_orderby(l_controller)[:]:
-                    for tmprecipe in recipeset.machine_recipes:
-                        systemsa = set(recipe.dyn_systems.filter(
-                                          System.lab_controller==l_controller
-                                                                ).all())
-                        systemsb = set(tmprecipe.dyn_systems.filter(
-                                          System.lab_controller==l_controller
-                                                                   ).all())
-
-                        if systemsa.difference(systemsb):
-                            for rem_system in systemsa.intersection(systemsb):
-                                if rem_system in recipe.systems:
-                                    log.debug("recipe: %s labController:%s Removing system %s" % (recipe.id, l_controller, rem_system))
-                                    recipe.systems.remove(rem_system)
-                for recipe in recipeset.machine_recipes:
-                    count = 0
-                    systems = recipe.dyn_systems.filter(
-                                      System.lab_controller==l_controller
-                                                       ).all()
-                    for tmprecipe in recipeset.machine_recipes:
-                        tmpsystems = tmprecipe.dyn_systems.filter(
-                                          System.lab_controller==l_controller
-                                                                 ).all()
-                        if recipe != tmprecipe and \
-                           systems == tmpsystems:
-                            count += 1
-                    if len(systems) <= count:
-                        # Remove all systems from this lc on this rs.
-                        log.debug("recipe: %s labController:%s %s <= %s Removing lab" % (recipe.id, l_controller, len(systems), count))
-                        bad_l_controllers = bad_l_controllers.union([l_controller])
-
-        # Remove systems that are on bad lab controllers
-        # This means one of the recipes can be fullfilled on a lab controller
-        # but not the rest of the recipes in the recipeSet.
+    machine_recipes = list(recipeset.machine_recipes)
+    if len(machine_recipes) > 1:
+        # For multi-host all recipes must be schedulable on one lab
+        # controller, each on a different system. For each lab, find
+        # a matching of recipes to distinct systems. If there is none, remove
+        # the lab's systems from every recipe, otherwise remove just the
+        # systems which could never be part of such a matching.
         # This could very well remove ALL systems from all recipes in this
         # recipeSet.  If that happens then the recipeSet cannot be scheduled
         # and will be aborted by the abort process.
-        for recipe in recipeset.machine_recipes:
-            for l_controller in bad_l_controllers:
-                systems = (recipe.dyn_systems.filter(
-                                          System.lab_controller==l_controller
-                                                ).all()
-                              )
-                log.debug("recipe: %s labController: %s Removing lab" % (recipe.id, l_controller))
-                for system in systems:
-                    if system in recipe.systems:
-                        log.debug("recipe: %s labController: %s Removing system %s" % (recipe.id, l_controller, system))
-                        recipe.systems.remove(system)
-        # Make the removal of systems visible to subsequent queries which use .dyn_systems
-        session.flush()
+        recipe_ids = [recipe.id for recipe in machine_recipes]
+        candidates = session.query(system_recipe_map.c.recipe_id,
+                    system_recipe_map.c.system_id, System.lab_controller_id)\
+                .select_from(system_recipe_map)\
+                .join(System, System.id == system_recipe_map.c.system_id)\
+                .filter(system_recipe_map.c.recipe_id.in_(recipe_ids))\
+                .filter(System.lab_controller_id != None)
+        graphs = defaultdict(lambda: dict((recipe_id, set()) for recipe_id in recipe_ids))
+        for recipe_id, system_id, lab_controller_id in candidates:
+            graphs[lab_controller_id][recipe_id].add(system_id)
+        removals = defaultdict(set)
+        unmatched_recipe_ids = set()
+        for lab_controller_id, graph in graphs.iteritems():
+            # Most constrained recipes first, so that if they cannot all fit
+            # it is the more flexible ones which are reported.
+            graph = OrderedDict(sorted(graph.iteritems(),
+                    key=lambda item: (len(item[1]), item[0])))
+            if all(len(system_ids) >= len(recipe_ids) for system_ids in graph.itervalues()):
+                # There are enough choices, we don't need to worry about dead
+                # locks (any recipe can take any of its systems and the
+                # rest will still fit).
+                continue
+            log.debug('%s lab controller %s entering not enough systems logic',
+                    recipeset.t_id, lab_controller_id)
+            matching = maximum_matching(graph)
+            if len(matching) < len(recipe_ids):
+                log.debug('%s lab controller %s cannot fit all recipes, removing lab',
+                        recipeset.t_id, lab_controller_id)
+                unmatched_recipe_ids.update(recipe_id for recipe_id in graph
+                        if recipe_id not in matching and graph[recipe_id])
+                usable = set()
+            else:
+                usable = usable_edges(graph, matching)
+            for recipe_id, system_ids in graph.iteritems():
+                for system_id in system_ids:
+                    if (recipe_id, system_id) not in usable:
+                        log.debug('recipe: %s labController: %s Removing system %s',
+                                recipe_id, lab_controller_id, system_id)
+                        removals[recipe_id].add(system_id)
+        if removals:
+            for recipe_id, system_ids in removals.iteritems():
+                session.execute(system_recipe_map.delete()
+                        .where(system_recipe_map.c.recipe_id == recipe_id)
+                        .where(system_recipe_map.c.system_id.in_(system_ids)))
+            for recipe in machine_recipes:
+                session.expire(recipe, ['systems'])
 
         # Are we left with any recipes having no candidate systems?
-        dead_recipes = [recipe for recipe in recipeset.machine_recipes if not recipe.systems]
+        dead_recipes = [recipe for recipe in machine_recipes if not recipe.systems]
         if dead_recipes:
+            # Blame the recipes which could not be fitted in, if we know them.
+            dead_recipes = [recipe for recipe in dead_recipes
+                    if recipe.id in unmatched_recipe_ids] or dead_recipes
             # Set status to Aborted
             log.debug('Not enough systems logic for %s left %s with no candidate systems',
                     recipeset.t_id, ', '.join(recipe.t_id for recipe in dead_recipes))
@@ -349,6 +545,7 @@ def queue_processed_recipeset(recipeset_id):
             for guestrecipe in recipe.guests:
                 guestrecipe.queue()
 
+@_phase
 def abort_dead_recipes(*args):
     work_done = False
     with session.begin():
@@ -377,15 +574,7 @@ def abort_dead_recipes(*args):
         log.debug('Aborting dead recipes [%s ... %s] (%d total)',
                   recipe_ids[0], recipe_ids[-1], len(recipe_ids))
     for recipe_id in recipe_ids:
-        session.begin()
-        try:
-            abort_dead_recipe(recipe_id)
-            session.commit()
-        except exceptions.Exception as e:
-            log.exception('Error in abort_dead_recipe(%s)', recipe_id)
-            session.rollback()
-        finally:
-            session.close()
+        _run_in_transaction(abort_dead_recipe, recipe_id)
         work_done = True
     return work_done
 
@@ -402,8 +591,8 @@ def abort_dead_recipe(recipe_id):
         log.info(msg)
         recipe.recipeset.abort(msg)
 
+@_phase
 def schedule_pending_systems():
-    work_done = False
     with session.begin():
         systems = System.query\
                 .join(System.lab_controller)\
@@ -412,34 +601,29 @@ def schedule_pending_systems():
         system_ids = [system_id for system_id, in systems.values(System.id)]
     if system_ids:
         log.debug('Scheduling pending systems (%d total)', len(system_ids))
-    for system_id in system_ids:
-        session.begin()
-        try:
-            schedule_pending_system(system_id)
-            session.commit()
-        except Exception as e:
-            log.exception('Error in schedule_pending_system(%s)', system_id)
-            session.rollback()
-        finally:
-            session.close()
-        work_done = True
-    return work_done
+    _run_sharded(lambda system_id: _run_in_transaction(schedule_pending_system, system_id),
+                 system_ids)
+    refresh_eligibility_index()
+    return bool(system_ids)
 
 def schedule_pending_system(system_id):
     system = System.query.get(system_id)
     # Do we have any queued recipes which could run on this system?
     log.debug('Checking for queued recipes which are runnable on %s', system.fqdn)
-    recipes = MachineRecipe.runnable_on_system(system)
-    # Effective priority is given in the following order:
-    # * Multi host recipes with already scheduled siblings
-    # * Priority level (i.e Normal, High etc)
-    # * RecipeSet id
-    # * Recipe id
-    recipes = recipes.order_by(RecipeSet.lab_controller == None)\
-        .order_by(RecipeSet.priority.desc())\
-        .order_by(RecipeSet.id)\
-        .order_by(Recipe.id)
-    recipe = recipes.first()
+    if _eligibility_index is not None:
+        recipe = _next_indexed_recipe(system)
+    else:
+        recipes = MachineRecipe.runnable_on_system(system)
+        # Effective priority is given in the following order:
+        # * Multi host recipes with already scheduled siblings
+        # * Priority level (i.e Normal, High etc)
+        # * RecipeSet id
+        # * Recipe id
+        recipes = recipes.order_by(RecipeSet.lab_controller == None)\
+            .order_by(RecipeSet.priority.desc())\
+            .order_by(RecipeSet.id)\
+            .order_by(Recipe.id)
+        recipe = recipes.first()
     if not recipe:
         log.debug('No recipes runnable on %s, returning to idle', system.fqdn)
         system.scheduler_status = SystemSchedulerStatus.idle
@@ -451,10 +635,105 @@ def schedule_pending_system(system_id):
         log.debug("System : %s recipe: %s no longer has access. removing" % (system,
                                                                              recipe.id))
         recipe.systems.remove(system)
+        if _eligibility_index is not None:
+            _eligibility_index.discard_candidate(recipe.id, system.id)
         # Try again on the next pass.
         return
+    if _scheduler_workers() > 1 and not _lock_recipe_for_system(recipe, system):
+        log.debug('Recipe %s was claimed by another worker, will retry %s',
+                recipe.id, system.fqdn)
+        # Leave the system pending so it is tried again on the next pass.
+        return
     schedule_recipe_on_system(recipe, system)
 
+def _lock_recipe_for_system(recipe, system):
+    """
+    With several workers scheduling pending systems at once, two of them may
+    pick the same recipe, or sibling recipes in a multi-host recipe set for
+    systems in different labs. Locks the recipe set and recipe rows (in that
+    order) and checks that the recipe can still be scheduled on the system.
+    """
+    recipeset = RecipeSet.query.filter(RecipeSet.id == recipe.recipe_set_id)\
+            .with_lockmode('update').populate_existing().one()
+    recipe = MachineRecipe.query.filter(MachineRecipe.id == recipe.id)\
+            .with_lockmode('update').populate_existing().one()
+    return (recipe.status == TaskStatus.queued and
+            recipeset.lab_controller_id in (None, system.lab_controller_id))
+
+# How many candidates from the eligibility index are verified per query.
+_INDEX_CANDIDATE_BATCH_SIZE = 100
+
+def _next_indexed_recipe(system):
+    """
+    Returns the highest priority recipe runnable on the given system, using
+    the eligibility index to find candidates. Candidates are verified against
+    the database since the index may be out of date.
+    """
+    candidate_ids = _eligibility_index.candidate_recipe_ids(system)
+    for start in range(0, len(candidate_ids), _INDEX_CANDIDATE_BATCH_SIZE):
+        batch = candidate_ids[start:start + _INDEX_CANDIDATE_BATCH_SIZE]
+        runnable = dict((recipe.id, recipe) for recipe in
+                MachineRecipe.runnable_on_system(system)
+                .filter(Recipe.id.in_(batch)))
+        skipped = []
+        for recipe_id in batch:
+            if recipe_id in runnable:
+                break
+            skipped.append(recipe_id)
+        # Skipped candidates are not runnable here. If they are no longer
+        # queued at all (cancelled, aborted, scheduled elsewhere) forget about
+        # them, otherwise they may become runnable later (for example once
+        # their distro tree is imported into this lab).
+        if skipped:
+            queued_ids = set(recipe_id for recipe_id, in
+                    session.query(Recipe.id)
+                    .filter(Recipe.id.in_(skipped))
+                    .filter(Recipe.status == TaskStatus.queued))
+            for recipe_id in skipped:
+                if recipe_id not in queued_ids:
+                    _eligibility_index.discard_recipe(recipe_id)
+        if len(skipped) < len(batch):
+            return runnable[batch[len(skipped)]]
+    return None
+
+def reindex_recipesets(recipeset_ids):
+    """
+    Marks recipe sets changed by other processes (see bkr.server.wakeup) for
+    refreshing in the eligibility index on the next pass. If recipeset_ids is
+    None the whole index is rebuilt.
+    """
+    if _eligibility_index is None:
+        return
+    if recipeset_ids is None:
+        _eligibility_index.last_rebuilt = None
+    else:
+        _eligibility_index_dirty.update(recipeset_ids)
+
+def refresh_eligibility_index():
+    """
+    Brings the eligibility index up to date with the recipe sets which
+    beakerd has changed, or rebuilds it entirely if it is due for
+    reconciliation with the database.
+    """
+    if _eligibility_index is None:
+        _eligibility_index_dirty.clear()
+        return
+    interval = config.get('beaker.eligibility_index_rebuild_interval', 300)
+    # The wakeup listener thread may add more recipe sets while we refresh.
+    dirty = set(_eligibility_index_dirty)
+    try:
+        with session.begin():
+            if _eligibility_index.needs_rebuild(interval):
+                _eligibility_index.rebuild()
+            elif dirty:
+                _eligibility_index.refresh_recipesets(dirty)
+        _eligibility_index_dirty.difference_update(dirty)
+    except Exception:
+        log.exception('Error refreshing eligibility index, will rebuild')
+        _eligibility_index.last_rebuilt = None
+    finally:
+        session.close()
+
 def schedule_recipe_on_system(recipe, system):
     log.debug('Assigning recipe %s to system %s', recipe.id, system.fqdn)
     recipe.resource = SystemResource(system=system)
@@ -465,11 +744,14 @@ def schedule_recipe_on_system(recipe, system):
     recipe.createRepo()
     recipe.recipeset.lab_controller = system.lab_controller
     recipe.clear_candidate_systems()
+    _eligibility_index_dirty.add(recipe.recipeset.id)
     # Create the watchdog without an Expire time.
     log.debug("Created watchdog for recipe id: %s and system: %s" % (recipe.id, system))
     recipe.watchdog = Watchdog()
     log.info("recipe ID %s moved from Queued to Scheduled" % recipe.id)
 
+    if recipe.guests:
+        _hold_guest_allocation_lock()
     for guestrecipe in recipe.guests:
         guestrecipe.resource = GuestResource()
         guestrecipe.resource.allocate()
@@ -479,6 +761,7 @@ def schedule_recipe_on_system(recipe, system):
         log.info('recipe ID %s guest %s moved from Queued to Scheduled',
                 recipe.id, guestrecipe.id)
 
+@_phase
 def provision_virt_recipes(*args):
     work_done = False
     with session.begin():
@@ -563,30 +846,22 @@ def provision_virt_recipe(recipe_id):
     finally:
         session.close()
 
+@_phase
 def provision_scheduled_recipesets(*args):
     """
     if All recipes in a recipeSet are in Scheduled state then move them to
      Running.
     """
-    work_done = False
     with session.begin():
         recipesets = RecipeSet.by_recipe_status(TaskStatus.scheduled)
-        recipeset_ids = [rs_id for rs_id, in recipesets.values(RecipeSet.id)]
+        rows = list(recipesets.values(RecipeSet.id, RecipeSet.job_id))
+        recipeset_ids, job_ids = zip(*rows) if rows else ((), ())
     if recipeset_ids:
         log.debug('Provisioning scheduled recipe sets [%s ... %s] (%d total)',
                   recipeset_ids[0], recipeset_ids[-1], len(recipeset_ids))
-    for rs_id in recipeset_ids:
-        session.begin()
-        try:
-            provision_scheduled_recipeset(rs_id)
-            session.commit()
-        except exceptions.Exception:
-            log.exception('Error in provision_scheduled_recipeset(%s)', rs_id)
-            session.rollback()
-        finally:
-            session.close()
-        work_done = True
-    return work_done
+    _run_sharded(lambda rs_id: _run_in_transaction(provision_scheduled_recipeset, rs_id),
+                 list(recipeset_ids), keys=[[job_id] for job_id in job_ids])
+    return bool(recipeset_ids)
 
 def provision_scheduled_recipeset(recipeset_id):
     recipeset = RecipeSet.by_id(recipeset_id)
@@ -623,41 +898,57 @@ def run_data_migrations():
         _outstanding_data_migrations.pop(0)
     return True
 
+# Old watchdog changes are deleted at most this often, see
+# RecipeTasks.watchdog_changes().
+_watchdog_change_purge_interval = 3600
+_last_watchdog_change_purge = 0
+
+@_phase
+def purge_watchdog_changes():
+    global _last_watchdog_change_purge
+    _last_watchdog_change_purge = time.time()
+    with session.begin():
+        purged = WatchdogChange.query\
+            .filter(WatchdogChange.created < datetime.utcnow()
+                    - RecipeTasks.watchdog_change_retention)\
+            .delete(synchronize_session=False)
+    if purged:
+        log.debug('Purged %s old watchdog changes', purged)
+    return bool(purged)
+
 # Real-time metrics reporting
 
 # Recipe queue
-def _recipe_count_metrics_for_query(name, query=None):
-    for status, count in MachineRecipe.get_queue_stats(query).items():
+def _recipe_count_metrics_for_query(name, counts):
+    for status, count in counts.iteritems():
         metrics.measure('gauges.recipes_%s.%s' % (status, name), count)
 
-def _recipe_count_metrics_for_query_grouped(name, grouping, query):
-    group_counts = MachineRecipe.get_queue_stats_by_group(grouping, query)
+def _recipe_count_metrics_for_query_grouped(name, group_counts):
     for group, counts in group_counts.iteritems():
         for status, count in counts.iteritems():
             metrics.measure('gauges.recipes_%s.%s.%s' %
                                    (status, name, group), count)
 
 def recipe_count_metrics():
-    _recipe_count_metrics_for_query('all')
-    _recipe_count_metrics_for_query(
-            'dynamic_virt_possible',
-            MachineRecipe.query.filter(
-                MachineRecipe.virt_status == RecipeVirtStatus.possible)
-            )
-    _recipe_count_metrics_for_query_grouped(
-            'by_arch', Arch.arch,
-            MachineRecipe.query.join(DistroTree).join(Arch))
+    totals, grouped = MachineRecipe.get_queue_stats_by_groups({
+            'dynamic_virt_possible': case(
+                [(MachineRecipe.virt_status == RecipeVirtStatus.possible, 1)]),
+            'by_arch': Arch.arch,
+        }, MachineRecipe.query.outerjoin(MachineRecipe.distro_tree)
+                .outerjoin(DistroTree.arch))
+    _recipe_count_metrics_for_query('all', totals)
+    _recipe_count_metrics_for_query('dynamic_virt_possible',
+            grouped['dynamic_virt_possible'][1])
+    _recipe_count_metrics_for_query_grouped('by_arch', grouped['by_arch'])
 
 
 # System utilisation
-def _system_count_metrics_for_query(name, query):
-    counts = utilisation.system_utilisation_counts(query)
+def _system_count_metrics_for_query(name, counts):
     for state, count in counts.iteritems():
         if state != 'idle_removed':
             metrics.measure('gauges.systems_%s.%s' % (state, name), count)
 
-def _system_count_metrics_for_query_grouped(name, grouping, query):
-    group_counts = utilisation.system_utilisation_counts_by_group(grouping, query)
+def _system_count_metrics_for_query_grouped(name, group_counts):
     for group, counts in group_counts.iteritems():
         for state, count in counts.iteritems():
             if state != 'idle_removed':
@@ -665,36 +956,45 @@ def _system_count_metrics_for_query_grouped(name, grouping, query):
                         group.replace('.', '_')), count)
 
 def system_count_metrics():
-    _system_count_metrics_for_query('all', System.query)
-    _system_count_metrics_for_query('shared', System.query
-            .outerjoin(System.active_access_policy)
-            .filter(SystemAccessPolicy.grants_everybody(SystemPermission.reserve)))
-    _system_count_metrics_for_query_grouped('by_arch', Arch.arch,
-            System.query.join(System.arch))
-    _system_count_metrics_for_query_grouped('by_lab', LabController.fqdn,
-            System.query.join(System.lab_controller))
+    # Arches are many-to-many so they need their own query, everything else
+    # comes from one pass over the system table.
+    totals, grouped = utilisation.system_utilisation_counts_by_groups({
+            'shared': case([(SystemAccessPolicy.grants_everybody(
+                SystemPermission.reserve), 1)]),
+            'by_lab': LabController.fqdn,
+        }, System.query.outerjoin(System.lab_controller)
+                .outerjoin(System.active_access_policy))
+    _system_count_metrics_for_query('all', totals)
+    _system_count_metrics_for_query('shared', grouped['shared'][1])
+    _system_count_metrics_for_query_grouped('by_lab', grouped['by_lab'])
+    _system_count_metrics_for_query_grouped('by_arch',
+            utilisation.system_utilisation_counts_by_group(Arch.arch,
+                System.query.join(System.arch)))
 
 # System power commands
-def _system_command_metrics_for_query(name, query):
-    for status, count in Command.get_queue_stats(query).items():
+def _system_command_metrics_for_query(name, counts):
+    for status, count in counts.iteritems():
         metrics.measure('gauges.system_commands_%s.%s' % (status, name), count)
 
-def _system_command_metrics_for_query_grouped(name, grouping, query):
-    group_counts = Command.get_queue_stats_by_group(grouping, query)
+def _system_command_metrics_for_query_grouped(name, group_counts):
     for group, counts in group_counts.iteritems():
         for status, count in counts.iteritems():
             metrics.measure('gauges.system_commands_%s.%s.%s'
                     % (status, name, group.replace('.', '_')), count)
 
 def system_command_metrics():
-    _system_command_metrics_for_query('all', Command.query)
-    _system_command_metrics_for_query_grouped('by_lab', LabController.fqdn,
-            Command.query.join(Command.system).join(System.lab_controller))
-    _system_command_metrics_for_query_grouped('by_arch', Arch.arch,
-            Command.query.join(Command.system).join(System.arch))
-    _system_command_metrics_for_query_grouped('by_power_type', PowerType.name,
-            Command.query.join(Command.system).join(System.power)
-                .join(Power.power_type))
+    totals, grouped = Command.get_queue_stats_by_groups({
+            'by_lab': LabController.fqdn,
+            'by_power_type': PowerType.name,
+        }, Command.query.join(Command.system).outerjoin(System.lab_controller)
+                .outerjoin(System.power).outerjoin(Power.power_type))
+    _system_command_metrics_for_query('all', totals)
+    _system_command_metrics_for_query_grouped('by_lab', grouped['by_lab'])
+    _system_command_metrics_for_query_grouped('by_power_type',
+            grouped['by_power_type'])
+    _system_command_metrics_for_query_grouped('by_arch',
+            Command.get_queue_stats_by_group(Arch.arch,
+                Command.query.join(Command.system).join(System.arch)))
 
 # Dirty jobs
 def dirty_job_metrics():
@@ -721,52 +1021,94 @@ def metrics_loop(*args, **kwargs):
             log.exception('Exception in metrics loop')
         finally:
             session.close()
+        # Send this batch of gauges together instead of waiting for the next
+        # periodic flush.
+        metrics.flush()
         end = time.time()
         duration = end - start
         if duration >= 30.0:
             log.debug("Metrics collection took %d seconds", duration)
         time.sleep(max(30.0 - duration, 5.0))
 
-def _main_recipes():
+def request_phases(phases=None):
+    """
+    Wakes up the main recipes thread to run the given phases of
+    _main_recipes() (see bkr.server.wakeup), or every phase if none are given.
+    """
+    global _full_pass_requested
+    with _requested_phases_lock:
+        if phases is None:
+            _full_pass_requested = True
+        else:
+            _requested_phases.update(phases)
+        event.set()
+
+def _take_requested_phases():
+    global _full_pass_requested
+    with _requested_phases_lock:
+        event.clear()
+        if _full_pass_requested:
+            phases = None
+        else:
+            phases = frozenset(_requested_phases)
+        _requested_phases.clear()
+        _full_pass_requested = False
+    return phases
+
+def _main_recipes(phases=None):
+    """
+    Runs one pass of the scheduler. If phases is given, only those phases are
+    run, along with everything after the first phase which does some work
+    (since each phase feeds the ones after it). Dirty jobs are always updated.
+    """
     work_done = False
+    def wanted(phase):
+        return phases is None or work_done or phase in phases
+    refresh_eligibility_index()
     if update_dirty_jobs():
         work_done = True
-    if abort_dead_recipes():
+    if wanted('dead_recipes') and abort_dead_recipes():
         work_done = True
         update_dirty_jobs()
-    if process_new_recipes():
+    if wanted(wakeup.NEW_RECIPES) and process_new_recipes():
         work_done = True
         update_dirty_jobs()
-    if queue_processed_recipesets():
+    if wanted('processed_recipesets') and queue_processed_recipesets():
         work_done = True
         update_dirty_jobs()
-    if _virt_enabled():
+    if _virt_enabled() and wanted('virt_recipes'):
         if provision_virt_recipes():
             work_done = True
             update_dirty_jobs()
-    if schedule_pending_systems():
+    if wanted(wakeup.PENDING_SYSTEMS) and schedule_pending_systems():
         work_done = True
         update_dirty_jobs()
-    if provision_scheduled_recipesets():
+    if wanted('scheduled_recipesets') and provision_scheduled_recipesets():
         work_done = True
         # update_dirty_jobs() will be done at the start of the next loop
         # iteration, so no need to do it here at the end as well
     if _outstanding_data_migrations:
         run_data_migrations()
         work_done = True
+    if time.time() - _last_watchdog_change_purge >= _watchdog_change_purge_interval:
+        purge_watchdog_changes()
     return work_done
 
 @log_traceback(log)
 def main_recipes_loop(*args, **kwargs):
     while running:
-        work_done = _main_recipes()
-        if not work_done:
+        work_done = _main_recipes(_take_requested_phases())
+        if work_done:
+            # Keep doing full passes for as long as there is work to do.
+            request_phases()
+        else:
             event.wait()
     log.debug("main recipes thread exiting")
 
 def schedule():
     global running
     global _outstanding_data_migrations
+    global _eligibility_index
 
     _outstanding_data_migrations = [m for m in DataMigration.all() if not m.is_finished]
     if _outstanding_data_migrations:
@@ -775,12 +1117,33 @@ def schedule():
 
     interface.start(config)
 
+    if config.get('beaker.eligibility_index_enabled', True):
+        _eligibility_index = EligibilityIndex()
+
     if config.get('carbon.address'):
         log.debug('starting metrics thread')
         metrics_thread = threading.Thread(target=metrics_loop, name='metrics')
         metrics_thread.daemon = True
         metrics_thread.start()
 
+    # Work created by our own transactions is handled on the next pass,
+    # other processes tell us about theirs through the wakeup socket.
+    wakeup.set_local_handler(request_phases, reindex_recipesets)
+    wakeup_listener = None
+    if wakeup.socket_path():
+        wakeup_listener = wakeup.WakeupListener(wakeup.socket_path(),
+                request_phases, reindex_recipesets)
+        try:
+            wakeup_listener.start()
+        except (socket.error, OSError), e:
+            log.warning('Could not listen for wakeups on %s, relying on polling: %s',
+                    wakeup.socket_path(), e)
+            wakeup_listener = None
+    # With wakeups we only need to poll to catch anything which was missed.
+    poll_interval = config.get('beaker.scheduler_poll_interval',
+            60 if wakeup_listener else 20)
+    last_poll = time.time()
+
     beakerd_threads = set(["main_recipes"])
 
     log.debug("starting main recipes thread")
@@ -791,7 +1154,7 @@ def schedule():
 
     try:
         while True:
-            time.sleep(20)
+            time.sleep(min(20, poll_interval))
             running_threads = set([t.name for t in threading.enumerate()])
             if not running_threads.issuperset(beakerd_threads):
                 log.critical("a thread has died, shutting down")
@@ -799,8 +1162,9 @@ def schedule():
                 running = False
                 event.set()
                 break
-            event.set()
-            event.clear()
+            if time.time() - last_poll >= poll_interval:
+                request_phases()
+                last_poll = time.time()
     except (SystemExit, KeyboardInterrupt):
        log.info("shutting down")
        running = False
@@ -809,6 +1173,10 @@ def schedule():
 
     if _threadpool_executor:
         _threadpool_executor.shutdown()
+    if _worker_executor:
+        _worker_executor.shutdown()
+    if wakeup_listener:
+        wakeup_listener.close()
     interface.stop()
     main_recipes_thread.join(10)
 
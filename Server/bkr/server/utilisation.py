@@ -83,3 +83,31 @@ def system_utilisation_counts_by_group(grouping, systems):
     for group, state, count in query:
         retval[group][state] = count
     return retval
+
+def system_utilisation_counts_by_groups(groupings, systems):
+    """
+    Equivalent to system_utilisation_counts() followed by
+    system_utilisation_counts_by_group() for each of the given groupings (a
+    dict of name -> column), but using a single query. Systems for which
+    a grouping column is NULL are left out of that grouping. Returns a tuple
+    of (totals, dict of name -> grouped counts).
+    """
+    def init_counts():
+        return dict((k, 0) for k in
+                ['recipe', 'manual', 'idle_automated', 'idle_manual',
+                 'idle_broken', 'idle_removed'])
+    names = list(groupings)
+    query = systems.outerjoin(System.open_reservation)\
+            .with_entities(func.coalesce(Reservation.type,
+                func.concat('idle_', func.lower(System.status))),
+                *[groupings[name] for name in names] + [func.count(System.id)])\
+            .group_by(*[literal_column(str(i + 1)) for i in range(len(names) + 1)])
+    totals = init_counts()
+    retval = dict((name, defaultdict(init_counts)) for name in names)
+    for row in query:
+        state, groups, count = row[0], row[1:-1], row[-1]
+        totals[state] += count
+        for name, group in zip(names, groups):
+            if group is not None:
+                retval[name][group][state] += count
+    return totals, retval
@@ -0,0 +1,207 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+"""
+Wakeup notifications for beakerd.
+
+When a transaction which creates work for the scheduler (new recipes, dirty
+jobs, pending systems) commits, a datagram naming the affected phases is sent
+to a Unix socket bound by beakerd. Beakerd then runs just those phases instead
+of waiting for its next poll. If beakerd is not listening the notification is
+dropped, and the work is picked up by the poll as before.
+
+The same datagram also carries the ids of recipe sets whose priority has
+changed, so that beakerd can refresh its eligibility index for them.
+"""
+
+import os
+import errno
+import socket
+import logging
+import threading
+from itertools import chain
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from turbogears import config
+from turbogears.database import session
+
+log = logging.getLogger(__name__)
+
+DIRTY_JOBS = 'dirty_jobs'
+NEW_RECIPES = 'new_recipes'
+PENDING_SYSTEMS = 'pending_systems'
+PHASES = frozenset([DIRTY_JOBS, NEW_RECIPES, PENDING_SYSTEMS])
+
+_SESSION_INFO_KEY = 'beakerd_wakeup_phases'
+_REINDEX_SESSION_INFO_KEY = 'beakerd_wakeup_reindex'
+_REINDEX_PREFIX = 'recipeset:'
+# Sent instead of individual recipe set ids when there are too many of them
+# to fit in one datagram.
+_REINDEX_ALL = _REINDEX_PREFIX + '*'
+_MAX_DATAGRAM = 4096
+
+# Set by beakerd, so that work it creates for itself is recorded directly
+# instead of going through the socket.
+_local_handler = None
+_local_reindex_handler = None
+
+def socket_path():
+    return config.get('beaker.scheduler_wakeup_socket',
+            '/var/run/beaker/beakerd.sock')
+
+def set_local_handler(handler, reindex_handler=None):
+    """
+    Delivers notifications raised in this process to handler(phases) and
+    reindex_handler(recipeset_ids) instead of sending them to beakerd's
+    socket. recipeset_ids is None if every recipe set should be reindexed.
+    """
+    global _local_handler, _local_reindex_handler
+    _local_handler = handler
+    _local_reindex_handler = reindex_handler
+
+def notify(phase):
+    """
+    Wakes up the given beakerd phase once the current transaction commits.
+    Most callers do not need this, because it is done automatically for
+    objects which pass through the session, but bulk UPDATE statements
+    bypass that.
+    """
+    session().info.setdefault(_SESSION_INFO_KEY, set()).add(phase)
+
+def _encode(phases, recipeset_ids):
+    tokens = sorted(phases)
+    reindex = ['%s%d' % (_REINDEX_PREFIX, id) for id in sorted(recipeset_ids)]
+    data = ' '.join(tokens + reindex)
+    if len(data) > _MAX_DATAGRAM:
+        data = ' '.join(tokens + [_REINDEX_ALL])
+    return data
+
+def _decode(data):
+    tokens = data.split()
+    phases = PHASES.intersection(tokens)
+    recipeset_ids = set()
+    for token in tokens:
+        if token == _REINDEX_ALL:
+            recipeset_ids = None
+            break
+        if token.startswith(_REINDEX_PREFIX) and \
+                token[len(_REINDEX_PREFIX):].isdigit():
+            recipeset_ids.add(int(token[len(_REINDEX_PREFIX):]))
+    return phases, recipeset_ids
+
+def send(phases, recipeset_ids=()):
+    if _local_handler is not None:
+        if phases:
+            _local_handler(phases)
+        if recipeset_ids and _local_reindex_handler is not None:
+            _local_reindex_handler(set(recipeset_ids))
+        return
+    path = socket_path()
+    if not path:
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.setblocking(False)
+        sock.sendto(_encode(phases, recipeset_ids), path)
+    except socket.error, e:
+        # beakerd is not running, or is not keeping up. Either way its poll
+        # will find the work eventually.
+        if e.errno in (errno.ENOENT, errno.ECONNREFUSED, errno.EAGAIN):
+            log.debug('Could not wake beakerd at %s: %s', path, e)
+        else:
+            log.warning('Could not wake beakerd at %s: %s', path, e)
+    finally:
+        sock.close()
+
+def _value_added(obj, attr, value):
+    return value in inspect(obj).attrs[attr].history.added
+
+@event.listens_for(Session, 'before_flush')
+def collect_wakeups(session, flush_context, instances):
+    # delayed import to avoid circular dependency
+    from bkr.server.model import Job, Recipe, RecipeSet, System, \
+            SystemSchedulerStatus
+    phases = set()
+    reindex = set()
+    for obj in session.new:
+        if isinstance(obj, Recipe):
+            phases.add(NEW_RECIPES)
+    for obj in chain(session.new, session.dirty):
+        if isinstance(obj, Job) and _value_added(obj, 'is_dirty', True):
+            phases.add(DIRTY_JOBS)
+        elif isinstance(obj, System) and _value_added(obj, 'scheduler_status',
+                SystemSchedulerStatus.pending):
+            phases.add(PENDING_SYSTEMS)
+        elif isinstance(obj, RecipeSet) and obj.id is not None and \
+                inspect(obj).attrs['priority'].history.added:
+            # Priority changes reorder queued recipes in beakerd's
+            # eligibility index.
+            reindex.add(obj.id)
+    if phases:
+        session.info.setdefault(_SESSION_INFO_KEY, set()).update(phases)
+    if reindex:
+        session.info.setdefault(_REINDEX_SESSION_INFO_KEY, set()).update(reindex)
+
+@event.listens_for(Session, 'after_commit')
+def send_wakeups(session):
+    phases = session.info.pop(_SESSION_INFO_KEY, None)
+    recipeset_ids = session.info.pop(_REINDEX_SESSION_INFO_KEY, None)
+    if phases or recipeset_ids:
+        send(phases or (), recipeset_ids or ())
+
+@event.listens_for(Session, 'after_rollback')
+def discard_wakeups(session):
+    session.info.pop(_SESSION_INFO_KEY, None)
+    session.info.pop(_REINDEX_SESSION_INFO_KEY, None)
+
+
+class WakeupListener(object):
+    """
+    Receives notifications on the given socket path and passes the requested
+    phases to handler(phases), and recipe sets to reindex to
+    reindex_handler(recipeset_ids), from a background thread.
+    """
+
+    def __init__(self, path, handler, reindex_handler=None):
+        self.path = path
+        self.handler = handler
+        self.reindex_handler = reindex_handler
+        self.sock = None
+
+    def start(self):
+        try:
+            os.unlink(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        # The web application and lab controller proxies usually run as
+        # a different user in the same group.
+        os.chmod(self.path, 0660)
+        thread = threading.Thread(target=self._run, name='wakeup')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                data = self.sock.recv(4096)
+            except socket.error, e:
+                if e.errno == errno.EINTR:
+                    continue
+                log.debug('Wakeup listener stopping: %s', e)
+                return
+            phases, recipeset_ids = _decode(data)
+            if (recipeset_ids is None or recipeset_ids) and \
+                    self.reindex_handler is not None:
+                self.reindex_handler(recipeset_ids)
+            if phases:
+                self.handler(phases)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None